@@ -2,16 +2,20 @@ import os
 import io
 import sys
 import pathlib
+import hashlib
+import argparse
 import logging
 import traceback
 import multiprocessing
-import queue
+import multiprocessing.connection
 
 import numpy
 import pandas
 
 from lib.mosthosts_desi import MostHostsDesi
-from lib.desi_specfinder import TargetNotFound, SpectrumFinder
+from lib.desi_specfinder import SpectrumFinder
+from lib.export_manifest import ExportManifest
+from lib.telemetry import Telemetry
 
 outdir = pathlib.Path( 'exported_spectra' )
 
@@ -27,40 +31,128 @@ _logger.setLevel( logging.INFO )
 
 # ======================================================================
 
+# https://en.wikipedia.org/wiki/Pearson_hashing
+# I did this with random.shuffle(), proving that 77 is the most random 8-bit number
+_pearson_byteperm = numpy.array( [77, 130, 147, 35, 240, 54, 126, 114, 153, 101, 146, 155, 237, 148, 231, 80, 86,
+                                  216, 74, 90, 133, 107, 223, 154, 42, 12, 245, 193, 28, 16, 180, 174, 58, 69, 33,
+                                  105, 125, 182, 73, 238, 191, 100, 150, 254, 1, 135, 242, 10, 251, 30, 5, 88, 81,
+                                  221, 36, 31, 131, 185, 8, 98, 97, 190, 247, 112, 123, 234, 219, 120, 60, 222, 66,
+                                  96, 83, 13, 4, 144, 253, 19, 24, 172, 45, 179, 93, 11, 46, 207, 59, 99, 39, 44,
+                                  53, 220, 118, 34, 189, 41, 55, 109, 25, 40, 57, 229, 250, 102, 27, 183, 164, 178,
+                                  82, 212, 129, 197, 79, 186, 252, 116, 75, 134, 187, 94, 23, 0, 89, 2, 132, 206,
+                                  217, 151, 249, 175, 210, 194, 181, 127, 61, 171, 49, 142, 233, 68, 255, 37, 62,
+                                  244, 92, 152, 196, 21, 202, 248, 124, 7, 84, 227, 218, 176, 17, 199, 110, 103,
+                                  63, 149, 115, 170, 47, 50, 243, 85, 140, 67, 228, 137, 162, 95, 205, 169, 156,
+                                  166, 230, 157, 104, 15, 198, 111, 64, 241, 113, 209, 208, 215, 14, 18, 201, 239,
+                                  177, 70, 136, 72, 143, 87, 78, 203, 224, 3, 192, 225, 141, 119, 232, 168, 204,
+                                  188, 43, 165, 22, 76, 184, 145, 48, 211, 52, 106, 108, 51, 9, 91, 235, 167, 246,
+                                  32, 26, 200, 71, 226, 128, 56, 121, 163, 38, 195, 29, 161, 138, 213, 117, 139,
+                                  20, 122, 65, 236, 173, 6, 159, 158, 160, 214],
+                                dtype=numpy.ubyte )
+
+def pearson_hashes( strings ):
+    """Pearson-hash a whole list of strings at once.
+
+    Returns a numpy array of two-character hex strings (e.g. '57'), one
+    for each string.  The loop is over byte position rather than over
+    strings, so hashing all of mosthosts takes ~20 numpy operations
+    rather than ~100k Python ones.
+
+    """
+    blobs = [ s.encode( 'utf-8' ) for s in strings ]
+    if len( blobs ) == 0:
+        return numpy.array( [], dtype=str )
+    lengths = numpy.array( [ len(b) for b in blobs ] )
+    maxlen = lengths.max()
+    bytemat = numpy.zeros( ( len(blobs), maxlen ), dtype=numpy.ubyte )
+    for i, b in enumerate( blobs ):
+        bytemat[ i, :len(b) ] = numpy.frombuffer( b, dtype=numpy.ubyte )
+
+    hashes = numpy.zeros( len(blobs), dtype=numpy.ubyte )
+    for col in range( maxlen ):
+        w = lengths > col
+        hashes[w] = _pearson_byteperm[ hashes[w] ^ bytemat[w, col] ]
+
+    return numpy.char.mod( '%02x', hashes )
+
 def pearson_hash( string ):
-    # https://en.wikipedia.org/wiki/Pearson_hashing
-
-    # I did this with random.shuffle(), proving that 77 is the most random 8-bit number
-    byteperm = numpy.array( [77, 130, 147, 35, 240, 54, 126, 114, 153, 101, 146, 155, 237, 148, 231, 80, 86,
-                             216, 74, 90, 133, 107, 223, 154, 42, 12, 245, 193, 28, 16, 180, 174, 58, 69, 33,
-                             105, 125, 182, 73, 238, 191, 100, 150, 254, 1, 135, 242, 10, 251, 30, 5, 88, 81,
-                             221, 36, 31, 131, 185, 8, 98, 97, 190, 247, 112, 123, 234, 219, 120, 60, 222, 66,
-                             96, 83, 13, 4, 144, 253, 19, 24, 172, 45, 179, 93, 11, 46, 207, 59, 99, 39, 44,
-                             53, 220, 118, 34, 189, 41, 55, 109, 25, 40, 57, 229, 250, 102, 27, 183, 164, 178,
-                             82, 212, 129, 197, 79, 186, 252, 116, 75, 134, 187, 94, 23, 0, 89, 2, 132, 206,
-                             217, 151, 249, 175, 210, 194, 181, 127, 61, 171, 49, 142, 233, 68, 255, 37, 62,
-                             244, 92, 152, 196, 21, 202, 248, 124, 7, 84, 227, 218, 176, 17, 199, 110, 103,
-                             63, 149, 115, 170, 47, 50, 243, 85, 140, 67, 228, 137, 162, 95, 205, 169, 156,
-                             166, 230, 157, 104, 15, 198, 111, 64, 241, 113, 209, 208, 215, 14, 18, 201, 239,
-                             177, 70, 136, 72, 143, 87, 78, 203, 224, 3, 192, 225, 141, 119, 232, 168, 204,
-                             188, 43, 165, 22, 76, 184, 145, 48, 211, 52, 106, 108, 51, 9, 91, 235, 167, 246,
-                             32, 26, 200, 71, 226, 128, 56, 121, 163, 38, 195, 29, 161, 138, 213, 117, 139,
-                             20, 122, 65, 236, 173, 6, 159, 158, 160, 214],
-                            dtype=numpy.ubyte )
-    blob = string.encode( 'utf-8' )
-
-    hash = numpy.array( [0], dtype=numpy.ubyte )
-
-    for b in blob:
-        hash[0] = byteperm[ hash[0] ^ b ]
-
-    return f"{hash[0]:02x}"
+    return pearson_hashes( [ string ] )[0]
+
+# ======================================================================
+
+def parse_shards( spec ):
+    """Parse a shard specification into a sorted list of hash buckets (ints 0-255).
+
+    spec is a comma-separated list of hex buckets or inclusive hex
+    ranges, e.g. "57", "0-3f", or "00-0f,80-8f".
+
+    """
+    buckets = set()
+    for part in spec.split( ',' ):
+        part = part.strip()
+        if len( part ) == 0:
+            continue
+        if '-' in part:
+            lo, hi = part.split( '-', 1 )
+            lo = int( lo, 16 )
+            hi = int( hi, 16 )
+        else:
+            lo = hi = int( part, 16 )
+        if ( lo < 0 ) or ( hi > 255 ) or ( lo > hi ):
+            raise ValueError( f"Bad shard range {part}" )
+        buckets.update( range( lo, hi+1 ) )
+    return sorted( buckets )
+
+def slurm_shards( taskid=None, ntasks=None ):
+    """Return the contiguous range of hash buckets for one task of a SLURM job array.
+
+    The 256 buckets are split as evenly as possible among the ntasks
+    tasks.  taskid and ntasks default to $SLURM_ARRAY_TASK_ID and
+    $SLURM_ARRAY_TASK_COUNT (taskid is taken relative to
+    $SLURM_ARRAY_TASK_MIN, so --array=1-8 works as well as --array=0-7).
+
+    """
+    if taskid is None:
+        taskid = int( os.getenv( "SLURM_ARRAY_TASK_ID" ) ) - int( os.getenv( "SLURM_ARRAY_TASK_MIN", 0 ) )
+    if ntasks is None:
+        ntasks = int( os.getenv( "SLURM_ARRAY_TASK_COUNT" ) )
+    if ( ntasks < 1 ) or ( ntasks > 256 ) or ( taskid < 0 ) or ( taskid >= ntasks ):
+        raise ValueError( f"Can't split 256 buckets for task {taskid} of {ntasks}" )
+    lo = ( 256 * taskid ) // ntasks
+    hi = ( 256 * ( taskid + 1 ) ) // ntasks
+    return list( range( lo, hi ) )
+
+def shard_label( buckets ):
+    """A short label for a list of buckets, used to name per-shard manifests."""
+    buckets = sorted( buckets )
+    if len( buckets ) == 256:
+        return "all"
+    if buckets == list( range( buckets[0], buckets[-1]+1 ) ):
+        return f"{buckets[0]:02x}-{buckets[-1]:02x}"
+    return hashlib.sha256( ",".join( f"{b:02x}" for b in buckets ).encode( 'utf-8' ) ).hexdigest()[0:12]
 
 # ======================================================================
 
-def host_subprocessor( pipe, dbpasswd, logger ):
+def write_spectrum_file( spec, outfile ):
+    """Write the brz spectrum of a single-target desispec Spectra to outfile; return the file's sha256."""
+    dfluxen = numpy.sqrt( 1 / spec.ivar['brz'] )
+    #### dflux[ spec.ivar['brz'] <= 0 ] = sys.float_info.max
+    strio = io.StringIO()
+    strio.write( "lambda flux dflux\n" )
+    # TODO : figure out what the array of flux arrays means!
+    for wave, flux, dflux in zip( spec.wave['brz'], spec.flux['brz'][0], dfluxen[0] ):
+        strio.write( f"{wave:.2f} {flux:.5e} {dflux:.5e}\n" )
+    blob = strio.getvalue().encode( 'utf-8' )
+    with open( outfile, "wb" ) as ofp:
+        ofp.write( blob )
+    return hashlib.sha256( blob ).hexdigest()
+
+# ======================================================================
+
+def coadd_subprocessor( pipe, logger, reporter ):
     me = multiprocessing.current_process()
-    logger.info( f"host_subprocessor starting: {me.name} PID {me.pid}" )
+    logger.info( f"coadd_subprocessor starting: {me.name} PID {me.pid}" )
+    reporter.heartbeat( "starting" )
     try:
         done = False
         while not done:
@@ -70,58 +162,44 @@ def host_subprocessor( pipe, dbpasswd, logger ):
                 logger.info( f"{me.name} : got die command" )
                 done = True
 
-            elif command['command'] == 'snhost':
-                snname = command['snname']
-                cleansnname = snname.replace( "/", "_" )
-                host = command['host']
-                ra = command['ra']
-                dec = command['dec']
-                phash = pearson_hash( snname )
-
-                logger.info( f"{me.name} doing {snname} host {host}" )
-
-                # **** HACK ALERT ; only keep 57
-                if phash != '57':
-                    pipe.send( [] )
-                    continue
-                # ****
-                
-                dex = 0
+            elif command['command'] == 'coadd':
+                coaddfile = pathlib.Path( command['coaddfile'] )
+                logger.info( f"{me.name} doing {coaddfile.name} ({len(command['spectra'])} spectra)" )
+                reporter.heartbeat( f"reading {coaddfile.name}" )
                 retspec = []
+                nfailed = 0
+
+                try:
+                    allspec = SpectrumFinder.read_coadd( coaddfile )
+                except Exception as ex:
+                    logger.error( f"{me.name} failed to read {coaddfile}: {ex}" )
+                    reporter.increment( 'failed', len(command['spectra']) )
+                    pipe.send( { 'coaddfile': command['coaddfile'], 'status': 'failed',
+                                 'spectra': [], 'nfailed': len(command['spectra']) } )
+                    continue
 
-                finder = SpectrumFinder( ra, dec, names='{snname}_{host}',
-                                         desipasswd=dbpasswd, collection='daily', logger=logger )
-                for targid in finder.targetids:
-                    specinfos = finder.info_for_targetid( targid )
-                    logger.debug( f"...{len(specinfos)} spectra for targetid {targid} of {snname} {host}" )
-                    for i, specinfo in enumerate( specinfos ):
-                        try:
-                            spec = finder.get_spectrum( targid, specinfo['tileid'],
-                                                        specinfo['petal_loc'], specinfo['night'] )
-                        except FileNotFoundError as ex:
-                            logger.error( f"Failed to find file for {targid} of {snname}_{host}: {ex}; skipping" )
-                            continue
-                        night = str( specinfo['night'] )
-                        strnight = f'{night[0:4]}-{night[4:6]}-{night[6:8]}'
-                        try:
-                            outfile = outdir / phash[0] / phash[1] / f'{cleansnname}_host{host}_{dex}.csv'
-                        except Exception as ex:
-                            strio = io.StringIO()
-                            traceback.print_exc( file=strio )
-                            strio.write( f"\nphash={phash}" )
-                            logger.error( strio.getvalue() )
-                        dfluxen = numpy.sqrt( 1 / spec.ivar['brz'] )
-                        #### dflux[ spec.ivar['brz'] <= 0 ] = sys.float_info.max
-                        logger.debug( f"{me.name} writing spectrum {outfile.name} for "
-                                      f"{cleansnname} host {host} dex {dex}" )
-                        with open(outfile, "w") as ofp:
-                            ofp.write( "lambda flux dflux\n" )
-                            # TODO : figure out what the array of flux arrays means!
-                            for wave, flux, dflux in zip( spec.wave['brz'], spec.flux['brz'][0], dfluxen[0] ):
-                                ofp.write( f"{wave:.2f} {flux:.5e} {dflux:.5e}\n" )
-                        retspec.append( ( snname, host, targid, dex, strnight, phash[0], phash[1], outfile ) )
-                        dex += 1
-                pipe.send( retspec )
+                for sp in command['spectra']:
+                    try:
+                        spec = SpectrumFinder.spectrum_from_coadd( allspec, sp['targetid'] )
+                        logger.debug( f"{me.name} writing spectrum {pathlib.Path(sp['outfile']).name} for "
+                                      f"{sp['snname']} host {sp['host']} dex {sp['dex']}" )
+                        sha256 = write_spectrum_file( spec, sp['outfile'] )
+                    except Exception as ex:
+                        strio = io.StringIO()
+                        traceback.print_exc( file=strio )
+                        logger.error( f"{me.name} failed on targetid {sp['targetid']} of {sp['snname']} "
+                                      f"host {sp['host']} in {coaddfile.name}:\n{strio.getvalue()}" )
+                        nfailed += 1
+                        reporter.increment( 'failed' )
+                        continue
+                    retspec.append( ( sp['snname'], sp['host'], sp['targetid'], sp['tileid'], sp['petal'],
+                                      sp['night'], sp['dex'], sp['phash'][0], sp['phash'][1], sp['outfile'],
+                                      sha256 ) )
+                    reporter.increment( 'spectra' )
+
+                pipe.send( { 'coaddfile': command['coaddfile'], 'status': 'done',
+                             'spectra': retspec, 'nfailed': nfailed } )
+                reporter.heartbeat( "idle" )
             else:
                 logger.error( f"{me.name} unknown command {command['command']}, ignoring" )
 
@@ -131,204 +209,273 @@ def host_subprocessor( pipe, dbpasswd, logger ):
     except Exception as ex:
         strio = io.StringIO()
         strio.write( f"Process {me.name} PID {me.pid} returning after exception: {ex}\n" )
-        traceback.print_tb( file=strio )
+        traceback.print_exc( file=strio )
         logger.error( strio.getvalue() )
         return
 
     logger.info( f"{me.name} PID {me.pid} exiting" )
-    
+    reporter.finished()
+
 # ======================================================================
 
-def main():
+def resolve_coadd_paths( spectab, dbconn, collection='daily' ):
+    """Figure out which coadd file every spectrum lives in.
+
+    spectab — a DataFrame with (at least) columns tileid, petal, night
+    dbconn — a psycopg2 connection to the DESI database (with a RealDictCursor)
+    collection — the DESI collection (daily, iron, etc.)
+
+    Returns spectab with a coaddfile column added (as a string).  Rows
+    for which no file could be found are dropped (with an error logged).
+    This sends a single query for all distinct (tileid, petal, night).
+
+    """
+    keys = spectab[ [ 'tileid', 'petal', 'night' ] ].drop_duplicates()
+    cursor = dbconn.cursor()
+    q = ( f"SELECT c.tileid, c.petal, c.night, c.filename "
+          f"FROM {collection}.cumulative_tiles c "
+          f"INNER JOIN unnest( %(tiles)s::bigint[], %(petals)s::integer[], %(nights)s::integer[] ) "
+          f"  AS k(tileid, petal, night) "
+          f"  ON c.tileid=k.tileid AND c.petal=k.petal AND c.night=k.night" )
+    cursor.execute( q, { 'tiles': keys.tileid.astype( numpy.int64 ).tolist(),
+                         'petals': keys.petal.astype( numpy.int64 ).tolist(),
+                         'nights': keys.night.astype( numpy.int64 ).tolist() } )
+    files = pandas.DataFrame( cursor.fetchall(), columns=[ 'tileid', 'petal', 'night', 'filename' ] )
+    cursor.close()
+    files = files.drop_duplicates( [ 'tileid', 'petal', 'night' ] )
+    files['coaddfile'] = [ str( SpectrumFinder.coadd_path( f ) ) for f in files.filename ]
+    for col in [ 'tileid', 'petal', 'night' ]:
+        files[col] = files[col].astype( numpy.int64 )
+        spectab[col] = spectab[col].astype( numpy.int64 )
+
+    spectab = spectab.merge( files[ [ 'tileid', 'petal', 'night', 'coaddfile' ] ], how='left',
+                             on=[ 'tileid', 'petal', 'night' ] )
+    nofile = spectab.coaddfile.isnull()
+    if nofile.any():
+        for row in spectab[ nofile ].drop_duplicates( [ 'tileid', 'petal', 'night' ] ).itertuples():
+            _logger.error( f"Can't find a cumulative_tiles file for tile {row.tileid} petal {row.petal} "
+                           f"night {row.night}; skipping its spectra" )
+        spectab = spectab[ ~nofile ]
+    return spectab
 
-    # Make output directories
-    # To avoid having too big of directories, we're going to make two-level subdirectories
+# ======================================================================
 
-    _logger.info( "Making output directories" )
-    csvs = {}
-    for i in '0123456789abcdef':
-        csvs[i] = {}
-        for j in '0123456789abcdef':
-            direc = outdir / i / j
-            direc.mkdir( exist_ok=True, parents=True )
-            csvs[j] = []
-                            
-    with open( pathlib.Path(os.getenv("HOME")) / "secrets/decatdb_desi_desi" ) as ifp:
-        (dbuser, dbpasswd) = ifp.readline().strip().split()
+def export_spectra( mosthosts, haszdf, manifest, nprocs=numprocs, buckets=None, telemetry=None ):
+    """Write spectrum files for all hosts in haszdf, recording them in manifest.
+
+    Exports every spectrum in haszdf of every (sn, host) that has at
+    least one zwarn=0 redshift.  First, the coadd file of every spectrum
+    is found (with one database query); then work is handed to
+    coadd_subprocessor processes one coadd file at a time, so each file
+    is read exactly once no matter how many hosts have spectra in it.
+    As each file comes back, its spectra are recorded in the manifest,
+    so if this dies partway through, rerunning skips everything already
+    done.
+
+    mosthosts — a MostHostsDesi object (used for its database connection and release)
+    haszdf — the haszdf property of mosthosts (possibly sorted)
+    manifest — an ExportManifest
+
+    buckets — if not None, a list of Pearson-hash buckets (ints 0-255);
+              only SNe whose names hash into one of these buckets are
+              exported.  Use this to split one export across several
+              nodes (see parse_shards and slurm_shards).
+
+    telemetry — if not None, a Telemetry object (with main counter
+                'spectra') that will be told the total and fed progress
+                from the worker processes.
+
+    """
+    spectab = haszdf.reset_index()
+    spectab['hostnum'] = spectab['hostnum'].astype( numpy.int64 )
+    spectab['targetid'] = spectab['targetid'].astype( numpy.int64 )
+    keys = [ 'sn_name_sp', 'hostnum', 'targetid', 'tileid', 'petal', 'night' ]
+    spectab = spectab.drop_duplicates( keys )
+    spectab['goodz'] = ( spectab.zwarn == 0 ).fillna( False ).astype( bool )
+    spectab = spectab[ spectab.groupby( [ 'sn_name_sp', 'hostnum' ] )['goodz'].transform( 'any' ) ]
+    spectab = spectab.sort_values( keys ).reset_index( drop=True )
+    spectab['dex'] = spectab.groupby( [ 'sn_name_sp', 'hostnum' ] ).cumcount()
+
+    uniqnames = spectab.sn_name_sp.unique()
+    namehash = pandas.Series( pearson_hashes( uniqnames ), index=uniqnames )
+    spectab['phash'] = spectab.sn_name_sp.map( namehash )
+    if buckets is not None:
+        spectab = spectab[ spectab.phash.isin( [ f'{b:02x}' for b in buckets ] ) ]
+        _logger.info( f"{len(spectab)} spectra in {len(buckets)} hash buckets" )
+
+    nightstr = spectab.night.astype( numpy.int64 ).astype( str )
+    spectab['strnight'] = nightstr.str[0:4] + '-' + nightstr.str[4:6] + '-' + nightstr.str[6:8]
+    spectab['outfile'] = ( str(outdir) + '/' + spectab.phash.str[0] + '/' + spectab.phash.str[1] + '/'
+                           + spectab.sn_name_sp.str.replace( '/', '_' ) + '_host' + spectab.hostnum.astype( str )
+                           + '_' + spectab.dex.astype( str ) + '.csv' )
+
+    done = manifest.done_spectra()
+    isdone = numpy.array( [ ( r.sn_name_sp, r.hostnum, r.targetid, r.tileid, r.petal, r.strnight ) in done
+                            for r in spectab.itertuples() ], dtype=bool )
+    _logger.info( f"Manifest {manifest.path} has {isdone.sum()} of {len(spectab)} spectra already done" )
+    spectab = spectab[ ~isdone ]
+    if len( spectab ) == 0:
+        return
 
-    _logger.info( "Loading mosthosts" )
-    mosthosts = MostHostsDesi( dbuser=dbuser, dbpasswd=dbpasswd, logger=_logger, release='daily', force_regen=False )
-    haszdf = mosthosts.haszdf.sort_index( level=['sn_name_sp', 'hostnum', 'targetid', 'tileid', 'petal', 'night'] )
+    _logger.info( "Finding coadd files for all spectra" )
+    dbconn = mosthosts.connect_to_database()
+    spectab = resolve_coadd_paths( spectab, dbconn, collection=mosthosts.release )
+    dbconn.close()
+
+    units = []
+    for coaddfile, filespecs in spectab.groupby( 'coaddfile', sort=True ):
+        units.append( { 'command': 'coadd',
+                        'coaddfile': coaddfile,
+                        'spectra': [ { 'snname': r.sn_name_sp, 'host': int(r.hostnum), 'targetid': int(r.targetid),
+                                       'tileid': int(r.tileid), 'petal': int(r.petal), 'night': r.strnight,
+                                       'dex': int(r.dex), 'phash': r.phash, 'outfile': r.outfile }
+                                     for r in filespecs.itertuples() ] } )
+    _logger.info( f"{len(spectab)} spectra to write from {len(units)} coadd files" )
+    if telemetry is None:
+        telemetry = Telemetry( 'exportspectra', counter='spectra', logger=_logger )
+    telemetry.set_total( len(spectab) )
+    telemetry.start()
 
     _logger.info( "Launching processes" )
     procs = []
     pipes = []
-    for i in range( numprocs ):
+    for i in range( nprocs ):
         mypipe, theirpipe = multiprocessing.Pipe( True )
         pipes.append( mypipe )
-        proc = multiprocessing.Process( target=host_subprocessor, args=( theirpipe, dbpasswd, _logger ),
+        proc = multiprocessing.Process( target=coadd_subprocessor,
+                                        args=( theirpipe, _logger, telemetry.reporter( f'proc {i}' ) ),
                                         name=f'proc {i}' )
         proc.start()
-    idleprocs = list( range( numprocs ) )
+        procs.append( proc )
+    idleprocs = list( range( nprocs ) )
     busyprocs = []
 
+    nfilesread = 0
+    nspecwritten = 0
+    nfailed = 0
+
+    def handle_reply( which, reply ):
+        nonlocal nfilesread, nspecwritten, nfailed
+        nfailed += reply['nfailed']
+        if reply['status'] == 'done':
+            nfilesread += 1
+            telemetry.increment( 'files' )
+            nspecwritten += len( reply['spectra'] )
+            _logger.info( f"Got {len(reply['spectra'])} spectra from {pathlib.Path(reply['coaddfile']).name} "
+                          f"from proc {which}" )
+            manifest.record_spectra( reply['spectra'] )
+        else:
+            _logger.warning( f"Proc {which} failed on {reply['coaddfile']}; "
+                             f"its spectra will be retried on the next run" )
 
-    _logger.info( "Iterating" )
-    snnames = []
-    hosts = []
-    targids = []
-    dexen = []
-    nights = []
-    phash0s = []
-    phash1s = []
-    outfiles = []
-    lastsn = None
-    lasthost = None
-
-    def appendvals( rval ):
-        snnames.append( rval[0] )
-        hosts.append( rval[1] )
-        targids.append( rval[2] )
-        dexen.append( rval[3] )
-        nights.append( rval[4] )
-        phash0s.append( rval[5] )
-        phash1s.append( rval[6] )
-        outfiles.append( rval[7] )
-
-    done = False
-    # ****
-    # tmp = mosthosts.haszdf.iloc[0:30].reset_index()
-    # nl = '\n'
-    # _logger.info( f"Going to do:{nl}{nl.join([ f'{r.sn_name_sp} {r.hostnum} {r.targetid} {r.tileid} {r.petal} {r.night}' for r in tmp.itertuples()])} " )
-    # sys.exit(20)
-    # ****
-
-    irate = mosthosts.haszdf.itertuples()
-    # *** HACK ALERT: just do some
-    # irate = mosthosts.haszdf.iloc[15290:15790].itertuples()
-    # ****
-    while not done:
-
-        kaglorky = False
-        while len( idleprocs ) > 0:
-            if not kaglorky:
-                kaglorky = True
-                _logger.debug( "Starting idleprocs loop" )
-            try:
-                tup = next( irate )
-            except StopIteration as ex:
-                done = True
-                break
-
-            if not done:
-                if tup.zwarn != 0:
-                    continue
-
-                snname = tup.Index[0]
-                snhost = tup.Index[1]
-                if ( snname == lastsn ) and ( snhost == lasthost ):
-                    continue
-                lastsn = snname
-                lasthost = snhost
-
-                which = idleprocs.pop()
-                busyprocs.append( which )
-                _logger.info( f"Sending {snname} {snhost} to proc {which}" )
-                pipes[ which ].send( { 'command': 'snhost',
-                                       'snname': snname,
-                                       'host': snhost,
-                                       'ra': tup.ra,
-                                       'dec': tup.dec } )
-        if kaglorky:
-            _logger.debug( "Finished idleprocs loop" )
-
+    def collect_replies():
         busydex = 0
         while busydex < len( busyprocs ):
             if pipes[busyprocs[busydex]].poll():
-                rvals = pipes[busyprocs[busydex]].recv()
-                if len(rvals) > 0:
-                    _logger.info( f"Got {rvals[0][0]} {rvals[0][1]} ({len(rvals)} dexen) "
-                                  f"from proc {busyprocs[busydex]}" )
-                else:
-                    _logger.warning( f"Got empty return from proc {busyprocs[busydex]}" )
+                reply = pipes[busyprocs[busydex]].recv()
+                handle_reply( busyprocs[busydex], reply )
                 idleprocs.append( busyprocs[busydex] )
                 del busyprocs[busydex]
-                for rval in rvals:
-                    appendvals( rval )
             else:
                 busydex += 1
 
+    _logger.info( "Iterating" )
+    unitdex = 0
+    while unitdex < len( units ):
+        while ( len( idleprocs ) > 0 ) and ( unitdex < len( units ) ):
+            which = idleprocs.pop()
+            busyprocs.append( which )
+            _logger.debug( f"Sending {units[unitdex]['coaddfile']} to proc {which}" )
+            pipes[ which ].send( units[unitdex] )
+            unitdex += 1
+        if len( busyprocs ) > 0:
+            multiprocessing.connection.wait( [ pipes[i] for i in busyprocs ] )
+        collect_replies()
+
     _logger.info( "Done submitting jobs, waiting for running processes to finish." )
-    while len(busyprocs) > 0:
-        busydex = 0
-        while busydex < len( busyprocs ):
-            if pipes[busyprocs[busydex]].poll():
-                rvals = pipes[busyprocs[busydex]].recv()
-                del busyprocs[busydex]
-                idleprocs.append( busydex )
-                for rval in rvals:
-                    appendvals( rval )
-            else:
-                busydex += 1
+    while len( busyprocs ) > 0:
+        multiprocessing.connection.wait( [ pipes[i] for i in busyprocs ] )
+        collect_replies()
 
     _logger.info( "Telling processes to die" )
     for pipe in pipes:
         pipe.send( { 'command': 'die' } )
-                
+    for proc in procs:
+        proc.join()
+    telemetry.stop()
+
+    _logger.info( f"Read {nfilesread} coadd files, wrote {nspecwritten} spectra "
+                  f"({nspecwritten / max( nfilesread, 1 ):.2f} spectra per file read); "
+                  f"{nfailed} spectra failed." )
+
+# ======================================================================
+
+def write_tns_csvs( outmess, haszdf, mosthosts ):
+    """Write the {phash0}{phash1}.csv TNS bulk-upload index files.
+
+    outmess — DataFrame of spectra written, with columns phash0, phash1,
+              snname, host, targid, dex, night, outfile (e.g. from
+              ExportManifest.spectra())
+    haszdf — the haszdf property of a MostHostsDesi
+    mosthosts — a MostHostsDesi object
+
+    Everything is built a column at a time with joins against haszdf
+    and the mosthosts table, so there are no per-row lookups.
+
+    """
     _logger.info( "Building CSV files..." )
-    outmess = pandas.DataFrame( { 'phash0': phash0s, 'phash1': phash1s, 'snname': snnames, 'host': hosts,
-                                  'targid': targids, 'dex': dexen, 'night': nights, 'outfile': outfiles } )
-    outmess.sort_values( [ 'phash0', 'phash1', 'snname', 'host', 'targid', 'dex' ], inplace=True )
+    outmess = outmess.sort_values( [ 'phash0', 'phash1', 'snname', 'host', 'targid', 'dex' ] )
+    outmess = outmess.reset_index( drop=True )
 
     _logger.info( "...calculating variance-weighted redshifts for each targetid" )
-    snzs = []
-    snras = []
-    sndecs = []
-    zbars = []
-    dzbars = []
-    hostcomments = []
-    for tup in outmess.itertuples():
-        thismh = haszdf.xs( ( tup.snname, tup.host, tup.targid ),
-                            level=( 'sn_name_sp', 'hostnum', 'targetid' ) )
-
-        ok = True
-        if len( thismh ) == 0:
-            _logger.error( f"Didn't find {tup.snname} {tup.host} {tup.targid} in haszdf!" )
-            ok = False
-            snzs.append( -999. )
-            snras.append( -999. )
-            sndecs.append( -999. )
-            hostcomments.append( "Something is broken" )
-        else:
-            if not numpy.all( thismh.sn_z.values == thismh.sn_z.values[0] ):
-                _logger.warning( f"SN {sn_name_sp} host {hostnum} has divergent sn_z!" )
-            snzs.append( thismh.sn_z.values[0] )
-            snras.append( thismh.sn_ra.values[0] )
-            sndecs.append( thismh.sn_dec.values[0] )
-            hostcomments.append( f'host ra={thismh.iloc[0].ra:.5f} dec={thismh.iloc[0].dec:.5f}' )
-            thismh = thismh[ thismh.zwarn == 0 ]
-            if len( thismh ) == 0:
-                _logger.error( f"No zwarn=0 for {tup.sname} {tup.host} {tup.targid}" )
-                ok = False
-        
-        if ok and ( thismh.z.max() - thismh.z.min() > 0.001 ):
-            _logger.warning( f"{tup.snname} {tup.host} {tup.targid}; it has divergent zs: "
-                             f"{[ row.z for row in thismh.itertuples() ]}" )
-            # ok = False
-
-        if ok:
-            zbars.append( ( thismh.z / thismh.zerr**2 ).sum() / ( 1 / thismh.zerr**2 ).sum() )
-            dzbars.append( 1. / ( 1 / thismh.zerr**2 ).sum() )
-        else:
-            zbars.append( -999. )
-            dzbars.append( -999.)
-
-    outmess['z'] = zbars
-    outmess['dz'] = dzbars
-    outmess['snra'] = snras
-    outmess['sndec'] = sndecs
-    outmess['snz'] = snzs
-    outmess['hostcomment'] = hostcomments
+    keys = [ 'sn_name_sp', 'hostnum', 'targetid' ]
+    obs = haszdf.reset_index()
+    obs['hostnum'] = obs['hostnum'].astype( numpy.int64 )
+    obs['targetid'] = obs['targetid'].astype( numpy.int64 )
+    obsgrp = obs.groupby( keys, sort=False )
+    perhost = obs.drop_duplicates( keys, keep='first' ).set_index( keys )[ [ 'sn_z', 'sn_ra', 'sn_dec', 'ra', 'dec' ] ]
+    nsnz = obsgrp['sn_z'].nunique( dropna=False )
+    for ( snname, host, targid ) in nsnz[ nsnz > 1 ].index:
+        _logger.warning( f"SN {snname} host {host} targetid {targid} has divergent sn_z!" )
+
+    good = obs[ obs.zwarn == 0 ].copy()
+    good['w'] = 1. / good.zerr**2
+    good['wz'] = good.z * good.w
+    goodgrp = good.groupby( keys, sort=False )
+    zs = goodgrp[ [ 'w', 'wz' ] ].sum()
+    zs['zbar'] = zs.wz / zs.w
+    zs['dzbar'] = 1. / zs.w
+    zspread = goodgrp['z'].max() - goodgrp['z'].min()
+    for ( snname, host, targid ) in zspread[ zspread > 0.001 ].index:
+        _logger.warning( f"{snname} {host} {targid}; it has divergent zs: "
+                         f"{goodgrp.get_group( ( snname, host, targid ) ).z.tolist()}" )
+    perhost = perhost.join( zs[ [ 'zbar', 'dzbar' ] ], how='left' )
+
+    outmess = outmess.merge( perhost, how='left', left_on=[ 'snname', 'host', 'targid' ], right_index=True )
+    missing = outmess.sn_ra.isnull()
+    for row in outmess[ missing ].itertuples():
+        _logger.error( f"Didn't find {row.snname} {row.host} {row.targid} in haszdf!" )
+    nozwarn0 = ( ~missing ) & outmess.zbar.isnull()
+    for row in outmess[ nozwarn0 ].itertuples():
+        _logger.error( f"No zwarn=0 for {row.snname} {row.host} {row.targid}" )
+
+    outmess['z'] = outmess.zbar.fillna( -999. )
+    outmess['dz'] = outmess.dzbar.fillna( -999. )
+    outmess['snra'] = outmess.sn_ra.fillna( -999. )
+    outmess['sndec'] = outmess.sn_dec.fillna( -999. )
+    outmess['snz'] = outmess.sn_z.where( ~missing, -999. )
+    outmess['hostcomment'] = ( 'host ra=' + pandas.Series( numpy.char.mod( '%.5f', outmess.ra.values ) )
+                               + ' dec=' + pandas.Series( numpy.char.mod( '%.5f', outmess.dec.values ) ) )
+    outmess.loc[ missing, 'hostcomment' ] = "Something is broken"
+
+    # Per-SN info from the mosthosts table: number of host candidates, and IAU (or TNS) name from the first host
+
+    mh = mosthosts.mosthosts.reset_index()
+    nhosts = mh.groupby( 'sn_name_sp' ).size()
+    mh0 = mh.drop_duplicates( 'sn_name_sp', keep='first' ).set_index( 'sn_name_sp' )
+    iauname = mh0.sn_name_iau.where( mh0.sn_name_iau.notnull(), mh0.sn_name_tns ).fillna( 'NULL' )
+    outmess['nhosts'] = outmess.snname.map( nhosts ).fillna( 0 ).astype( int )
+    outmess['iauname'] = outmess.snname.map( iauname ).fillna( 'NULL' )
 
     fields = [ 'Obj. IAU-name*','Obj. internal-name*','Source Group-Id*',
                'RA','DEC','Obj. Type-Id','Redshift','Host-name','Host-redshift',
@@ -377,91 +524,161 @@ def main():
                   'Related-file2': 'NULL',
                   'RF2 Comments': 'NULL',
                  }
-    messkws = { 'Obj. internal-name*': 'snname',
-                'RA': 'snra',
-                'DEC': 'sndec',
-                'Redshift': 'snz',
-                'Host-redshift': 'z',
-                'Obs-date* [YYYY-MM-DD HH:MM:SS] / JD': 'night',
-                'Spec-Remarks': 'hostcomment',
+
+    def quoted( ser ):
+        return '"' + ser.astype( str ) + '"'
+
+    def fixed6( ser ):
+        return pandas.Series( numpy.char.mod( '%.6f', ser.values.astype( numpy.float64 ) ), index=ser.index )
+
+    hostname = '"host ' + outmess.host.astype( str )
+    multi = outmess.nhosts > 1
+    hostname[ multi ] += ' (' + outmess.nhosts[ multi ].astype( str ) + ' host candidates)'
+    hostname += '"'
+
+    redshift = fixed6( outmess.snz )
+    redshift[ outmess.snz < 0 ] = '"NULL"'
+
+    columns = { 'Obj. IAU-name*': quoted( outmess.iauname ),
+                'Obj. internal-name*': quoted( outmess.snname ),
+                'RA': outmess.snra.astype( numpy.float64 ).astype( str ),
+                'DEC': outmess.sndec.astype( numpy.float64 ).astype( str ),
+                'Redshift': redshift,
+                'Host-name': hostname,
+                'Host-redshift': fixed6( outmess.z ),
+                'Ascii-filename*': quoted( outmess.outfile.astype( str ).str.rsplit( '/', n=1 ).str[-1] ),
+                'Obs-date* [YYYY-MM-DD HH:MM:SS] / JD': quoted( outmess.night ),
+                'Spec-Remarks': quoted( outmess.hostcomment ),
                }
-    manuals = [ 'Host-name', 'Ascii-filename*', 'Obj. IAU-name*' ]
-
-    _logger.info( f"About to write csv files, outmess has len(outmess) rows" )
-    for phash0 in '0123456789abcdef':
-        for phash1 in '0123456789abcdef':
-            thismess = outmess[ ( outmess.phash0==phash0 ) & ( outmess.phash1==phash1 ) ]
-            if len(thismess) == 0:
-                continue
-            _logger.info( f"Writing {phash0}{phash1}.csv ; {len(thismess)} rows" )
-            with open( f'exported_spectra/{phash0}{phash1}.csv', 'w' ) as ofp:
-                ofp.write( '"Obj. IAU-name*"\t"Obj. internal-name*"\t"Source Group-Id*"\t'
-                           '"RA"\t"DEC"\t"Obj. Type-Id"\t"Redshift"\t"Host-name"\t"Host-redshift"\t'
-                           '"Obj. Prop-period value"\t"Prop-period units"\t"Assoc. Groups"\t'
-                           '"Ascii-filename*"\t"FITS-filename*"\t"Obs-date* [YYYY-MM-DD HH:MM:SS] / JD"\t'
-                           '"Instrument-Id*"\t"Exp-time (sec)"\t"WL Units-id"\t"WL Medium-Id"\t'
-                           '"Flux Unit Coeff"\t"Flux Units-Id"\t"Flux Calib. By-Id"\t"Extinction-Corrected-Id"\t'
-                           '"Observer/s"\t"Reducer/s"\t"Reduction-date [YYYY-MM-DD HH:MM:SS] / JD"\t'
-                           '"Aperture (Slit)"\t"Dichroic"\t"Grism"\t"Grating"\t"Blaze"\t"Airmass"\t"Hour Angle"\t'
-                           '"Spec Type-Id"\t"Spec Quality-Id"\t"Spec. Prop-period value"\t"Prop-period units"\t'
-                           '"Assoc. Groups"\t"Spec-Remarks"\t"Publish (bibcode)"\t"Contrib"\t"Related-file1"\t'
-                           '"RF1 Comments"\t"Related-file2"\t"RF2 Comments"\n' )
-
-                for row in thismess.itertuples():
-                    first = True
-                    _logger.debug( f"Adding to CSV for {pathlib.Path(getattr(row,'outfile')).name}" )
-                    for kw in fields:
-                        if first:
-                            first = False
-                        else:
-                            ofp.write( "\t" )
-                        if kw in constants.keys():
-                            if isinstance( constants[kw], str ):
-                                ofp.write( f'"{constants[kw]}"' )
-                            else:
-                                ofp.write( str(constants[kw]) )
-
-                        elif kw in messkws:
-                            val = getattr( row, messkws[kw] )
-                            if kw == 'Redshift':
-                                if val < 0:
-                                    ofp.write( f'"NULL"' )
-                                else:
-                                    ofp.write( f"{val:.6f}" )
-                            elif kw == 'Host-redshift':
-                                ofp.write( f"{val:.6f}" )
-                            else:
-                                if isinstance( val, str ):
-                                    ofp.write( f'"{val}"' )
-                                else:
-                                    ofp.write( str(val) )
-
-                        elif kw in manuals:
-                            mhentry = mosthosts.mosthosts.xs( row.snname, level='sn_name_sp' )
-                            if kw == 'Host-name':
-                                ofp.write( f'"host {getattr( row, "host" )}' )
-                                if len(mhentry) > 1:
-                                    ofp.write( f' ({len(mhentry)} host candidates)' )
-                                ofp.write( '"' )
-                            elif kw == 'Ascii-filename*':
-                                outfile = getattr( row, "outfile" )
-                                ofp.write( f'"{pathlib.Path(outfile).name}"' )
-                            elif kw == 'Obj. IAU-name*':
-                                mh0 = mhentry.iloc[0]
-                                if ( mh0.sn_name_iau is not None ):
-                                    ofp.write( f'"{mh0.sn_name_iau}"' )
-                                elif ( mh0.sn_name_tns is not None ):
-                                    ofp.write( f'"{mh0.sn_name_tns}"' )
-                                else:
-                                    ofp.write( '"NULL"' )
-                            else:
-                                _logger.error( "Error 27B/6" )
-
-                        else:
-                            _logger.error( f"Keyword not found: {kw}\n" )
-                    ofp.write( "\n" )
-            
-    
+    cols = []
+    for kw in fields:
+        if kw in columns:
+            cols.append( columns[kw] )
+        elif kw in constants:
+            val = f'"{constants[kw]}"' if isinstance( constants[kw], str ) else str( constants[kw] )
+            cols.append( pandas.Series( val, index=outmess.index ) )
+        else:
+            raise RuntimeError( f"Keyword not found: {kw}" )
+    lines = cols[0].str.cat( cols[1:], sep='\t' )
+
+    header = '\t'.join( f'"{kw}"' for kw in fields )
+    _logger.info( f"About to write csv files, outmess has {len(outmess)} rows" )
+    for ( phash0, phash1 ), thislines in lines.groupby( [ outmess.phash0, outmess.phash1 ], sort=True ):
+        _logger.info( f"Writing {phash0}{phash1}.csv ; {len(thislines)} rows" )
+        with open( outdir / f'{phash0}{phash1}.csv', 'w' ) as ofp:
+            ofp.write( header )
+            ofp.write( '\n' )
+            ofp.write( '\n'.join( thislines.values ) )
+            ofp.write( '\n' )
+
+
+# ======================================================================
+
+def main():
+    parser = argparse.ArgumentParser( "exportspectra.py",
+                                      description="Export DESI spectra of MostHosts hosts for TNS bulk upload" )
+    parser.add_argument( "-m", "--manifest", default=None,
+                         help=( f"SQLite manifest of what's been exported (default: "
+                                f"{outdir}/manifest.sqlite, or {outdir}/manifest_<shards>.sqlite with "
+                                f"--shards or --slurm-array)" ) )
+    parser.add_argument( "--fresh", default=False, action="store_true",
+                         help="Delete the manifest and start over (by default, resume where the last run stopped)" )
+    parser.add_argument( "--verify", default=False, action="store_true",
+                         help="Check the checksums of all files in the manifest, redoing hosts that don't match" )
+    parser.add_argument( "--csv-only", default=False, action="store_true",
+                         help="Don't export any spectra, just rebuild the TNS csv files from the manifest" )
+    parser.add_argument( "-n", "--numprocs", type=int, default=numprocs,
+                         help=f"Number of worker processes (default: {numprocs})" )
+    parser.add_argument( "-s", "--shards", default=None,
+                         help=( "Only export SNe whose names Pearson-hash into these buckets; comma-separated "
+                                "hex buckets or ranges, e.g. 0-3f or 00-0f,80-8f (default: all)" ) )
+    parser.add_argument( "--slurm-array", default=False, action="store_true",
+                         help=( "Pick this task's shard of buckets from $SLURM_ARRAY_TASK_ID and "
+                                "$SLURM_ARRAY_TASK_COUNT" ) )
+    parser.add_argument( "--status-file", default=None,
+                         help=( f"JSON file with counts, rates, ETA, and worker heartbeats, rewritten every "
+                                f"--status-interval seconds (default: {outdir}/status.json, or "
+                                f"{outdir}/status_<shard>.json with --shards or --slurm-array, like the "
+                                f"manifests)" ) )
+    parser.add_argument( "--status-interval", type=float, default=10.,
+                         help="Seconds between status updates (default: 10)" )
+    parser.add_argument( "--progress", default=False, action="store_true",
+                         help="Show a progress line on stderr" )
+    parser.add_argument( "--merge", default=False, action="store_true",
+                         help=( f"Don't export anything; merge all {outdir}/manifest_*.sqlite shard manifests "
+                                f"into the manifest and write the csv files for all buckets" ) )
+    args = parser.parse_args()
+
+    # Make output directories
+    # To avoid having too big of directories, we're going to make two-level subdirectories
+
+    _logger.info( "Making output directories" )
+    for i in '0123456789abcdef':
+        for j in '0123456789abcdef':
+            direc = outdir / i / j
+            direc.mkdir( exist_ok=True, parents=True )
+
+    if ( args.shards is not None ) and args.slurm_array:
+        sys.stderr.write( "Can't give both --shards and --slurm-array\n" )
+        sys.exit( 20 )
+    if ( args.merge ) and ( ( args.shards is not None ) or args.slurm_array ):
+        sys.stderr.write( "--merge works on all shards; don't give --shards or --slurm-array\n" )
+        sys.exit( 20 )
+    buckets = None
+    if args.shards is not None:
+        buckets = parse_shards( args.shards )
+    elif args.slurm_array:
+        buckets = slurm_shards()
+    if buckets is not None:
+        _logger.info( f"Doing {len(buckets)} hash buckets {buckets[0]:02x}..{buckets[-1]:02x}" )
+
+    if args.manifest is not None:
+        manifestpath = pathlib.Path( args.manifest )
+    elif buckets is not None:
+        manifestpath = outdir / f"manifest_{shard_label(buckets)}.sqlite"
+    else:
+        manifestpath = outdir / "manifest.sqlite"
+
+    if args.status_file is not None:
+        statusfile = args.status_file
+    elif buckets is not None:
+        statusfile = str( outdir / f"status_{shard_label(buckets)}.json" )
+    else:
+        statusfile = str( outdir / "status.json" )
+
+    if args.fresh:
+        for f in [ manifestpath, pathlib.Path( f'{manifestpath}-wal' ), pathlib.Path( f'{manifestpath}-shm' ) ]:
+            if f.exists():
+                _logger.info( f"Removing {f}" )
+                f.unlink()
+    manifest = ExportManifest( manifestpath, logger=_logger )
+
+    if args.merge:
+        shardfiles = sorted( outdir.glob( "manifest_*.sqlite" ) )
+        shardfiles = [ f for f in shardfiles if f.resolve() != manifestpath.resolve() ]
+        for f in shardfiles:
+            n = manifest.merge( f )
+            _logger.info( f"Merged {n} hosts from {f}" )
+
+    if args.verify:
+        nbad = manifest.verify()
+        _logger.info( f"{nbad} hosts in the manifest failed verification" )
+
+    with open( pathlib.Path(os.getenv("HOME")) / "secrets/decatdb_desi_desi" ) as ifp:
+        (dbuser, dbpasswd) = ifp.readline().strip().split()
+
+    _logger.info( "Loading mosthosts" )
+    mosthosts = MostHostsDesi( dbuser=dbuser, dbpasswd=dbpasswd, logger=_logger, release='daily', force_regen=False )
+    haszdf = mosthosts.haszdf.sort_index( level=['sn_name_sp', 'hostnum', 'targetid', 'tileid', 'petal', 'night'] )
+
+    if not ( args.csv_only or args.merge ):
+        telemetry = Telemetry( 'exportspectra', counter='spectra', statusfile=statusfile,
+                               interval=args.status_interval, progress=args.progress, logger=_logger )
+        export_spectra( mosthosts, haszdf, manifest, nprocs=args.numprocs, buckets=buckets, telemetry=telemetry )
+
+    outmess = manifest.spectra()
+    manifest.close()
+    write_tns_csvs( outmess, haszdf, mosthosts )
 
 # ======================================================================
 
@@ -0,0 +1,80 @@
+import sys
+import logging
+
+_logger = logging.getLogger( "bts_desi_zmatch" )
+if not _logger.hasHandlers():
+    _logout = logging.StreamHandler( sys.stderr )
+    _logger.addHandler( _logout )
+    _logout.setFormatter( logging.Formatter( f'[%(asctime)s - %(levelname)s] - %(message)s' ) )
+_logger.setLevel( logging.INFO )
+
+# ======================================================================
+
+def match_redshifts( sne, withz, mosthosts, closez=0.01, name='ZTFID', zcol='redshift', logger=None ):
+    """Compare SN redshifts (e.g. from BTS) to DESI redshifts of their MostHosts hosts.
+
+    sne — dataframe with one row per SN, with columns name (e.g. ZTFID),
+          zcol (the SN's redshift), and sn_name_sp (the MostHosts SN it
+          matched; see catalog_crossmatch.local_crossmatch)
+    withz — the rows of MostHostsDesi.df that have a DESI z (indexed by
+            sn_name_sp, hostnum, with column z)
+    mosthosts — MostHostsDesi.mosthosts (indexed by sn_name_sp, hostnum)
+    closez — a DESI z within this of the SN z matches
+
+    Everything is joins and groupbys over the whole sample, so this is
+    fast enough to call from a notebook on all of BTS.
+
+    Returns a dataframe indexed by name with columns:
+      sn_name_sp
+      sn_z — the SN's redshift
+      ndesi — number of hosts with a DESI z
+      nclose — number of those within closez of sn_z
+      nhosts — number of MostHosts hosts
+      desi_z — the chosen DESI z: the first (lowest hostnum) host
+               within closez if there is one, otherwise the first host
+               with a DESI z
+      z_mismatch — True if no host has a DESI z within closez
+      multi_close — True if more than one host has a DESI z within closez
+                    (so desi_z was picked arbitrarily)
+      unknown_hosts — True if some hosts have no DESI z
+
+    SNe in sne whose sn_name_sp has no host in withz are dropped.
+
+    """
+    logger = _logger if logger is None else logger
+    sne = sne[ [ name, zcol, 'sn_name_sp' ] ].rename( columns={ zcol: 'sn_z' } )
+
+    hosts = withz[ [ 'z' ] ].reset_index()[ [ 'sn_name_sp', 'hostnum', 'z' ] ]
+    joined = sne.merge( hosts, on='sn_name_sp', how='inner' ).sort_values( [ name, 'hostnum' ] )
+    joined['close'] = ( joined['z'] - joined['sn_z'] ).abs() <= closez
+
+    grouped = joined.groupby( name, sort=False )
+    result = grouped[ [ 'sn_name_sp', 'sn_z' ] ].first()
+    result['ndesi'] = grouped.size()
+    result['nclose'] = grouped['close'].sum()
+
+    firstz = grouped['z'].first()
+    firstclosez = joined[ joined['close'] ].groupby( name, sort=False )['z'].first()
+    result['desi_z'] = firstclosez.reindex( result.index ).fillna( firstz )
+
+    nhosts = mosthosts.index.get_level_values( 'sn_name_sp' ).value_counts()
+    result['nhosts'] = result['sn_name_sp'].map( nhosts ).fillna( 0 ).astype( int )
+    result['z_mismatch'] = result['nclose'] == 0
+    result['multi_close'] = result['nclose'] > 1
+    result['unknown_hosts'] = result['nhosts'] > result['ndesi']
+
+    result = result[ [ 'sn_name_sp', 'sn_z', 'ndesi', 'nclose', 'nhosts', 'desi_z',
+                       'z_mismatch', 'multi_close', 'unknown_hosts' ] ]
+    logger.info( f"{len(result)} SNe with DESI host redshifts: {(~result['z_mismatch']).sum()} match, "
+                 f"{result['z_mismatch'].sum()} don't" )
+    return result
+
+def summarize( result ):
+    """Return a dict of counts from match_redshifts output."""
+    match = ~result['z_mismatch']
+    return { 'n': len( result ),
+             'n_matchz': int( match.sum() ),
+             'n_matchz_but_unknown_hosts': int( ( match & result['unknown_hosts'] ).sum() ),
+             'n_mismatchz': int( ( ~match ).sum() ),
+             'n_mismatchz_but_unknown_hosts': int( ( ~match & result['unknown_hosts'] ).sum() ),
+             'n_multi_close': int( result['multi_close'].sum() ) }
@@ -0,0 +1,297 @@
+import sys
+import os
+import io
+import pathlib
+import logging
+import argparse
+
+import numpy
+import pandas
+import psycopg2
+import psycopg2.extras
+from astropy.coordinates import SkyCoord
+import astropy.units as units
+
+_libdir = str( pathlib.Path( __file__ ).parent )
+if _libdir not in sys.path:
+    sys.path.insert( 0, _libdir )
+
+from host_association import candidate_pairs, separation
+
+_logger = logging.getLogger( "catalog_crossmatch" )
+if not _logger.hasHandlers():
+    _logout = logging.StreamHandler( sys.stderr )
+    _logger.addHandler( _logout )
+    _logout.setFormatter( logging.Formatter( f'[%(asctime)s - %(levelname)s] - %(message)s' ) )
+_logger.setLevel( logging.INFO )
+
+# ======================================================================
+
+# The columns read_catalog produces.  name, ra, and dec are required;
+# the rest are null if the catalog doesn't have them.
+catalogcols = [ 'name', 'ra', 'dec', 'hostra', 'hostdec', 'z' ]
+
+pantheon_colmap = { 'name': 'SNID', 'ra': 'RA', 'dec': 'Dec', 'hostra': 'RA_host', 'hostdec': 'Dec_host',
+                    'z': 'zcmb' }
+
+bts_colmap = { 'name': 'ZTFID', 'ra': 'RA', 'dec': 'Dec', 'z': 'redshift' }
+
+# Columns of static.mosthosts that come back with each match (renamed
+# so they don't collide with the catalog's)
+_mhcols = { 'sn_name_sp': 'sn_name_sp', 'hostnum': 'hostnum', 'sn_ra': 'sn_ra', 'sn_dec': 'sn_dec',
+            'ra': 'mh_ra', 'dec': 'mh_dec', 'sn_z': 'sn_z' }
+
+def parse_colmap( s ):
+    """Parse "name=SNID,ra=RA,..." into a dict."""
+    colmap = {}
+    for item in s.split( ',' ):
+        key, val = item.split( '=', 1 )
+        colmap[ key.strip() ] = val.strip()
+    return colmap
+
+def read_catalog( path, colmap, raunit='deg', extracols=[] ):
+    """Read an external catalog (CSV) into a dataframe with the standard columns.
+
+    path — the CSV file
+    colmap, raunit, extracols — see catalog_from_df
+
+    """
+    return catalog_from_df( pandas.read_csv( path ), colmap, raunit=raunit, extracols=extracols, source=path )
+
+def catalog_from_df( raw, colmap, raunit='deg', extracols=[], source='catalog' ):
+    """Make a dataframe with the standard columns from an external catalog already in memory.
+
+    raw — the catalog dataframe
+    colmap — dict of standard column (see catalogcols) → catalog column;
+             must include name, ra, and dec
+    raunit — 'deg' or 'hourangle'.  If RA or Dec are strings (e.g.
+             sexagesimal), they're parsed by astropy with this RA unit.
+    extracols — other catalog columns to keep (under their own names)
+    source — what to call the catalog in messages
+
+    Returns a dataframe with columns catalogcols + extracols, with ra,
+    dec, hostra, and hostdec in degrees.
+
+    """
+    for col in [ 'name', 'ra', 'dec' ]:
+        if col not in colmap:
+            raise ValueError( f"colmap must include {col}" )
+    unknown = set( colmap.keys() ) - set( catalogcols )
+    if len( unknown ) > 0:
+        raise ValueError( f"Unknown standard columns in colmap: {unknown}" )
+    missing = [ c for c in list( colmap.values() ) + list( extracols ) if c not in raw.columns ]
+    if len( missing ) > 0:
+        raise ValueError( f"{source} doesn't have columns {missing}" )
+
+    raw = raw.reset_index( drop=True )
+    df = pandas.DataFrame( { col: raw[ colmap[col] ] if col in colmap else numpy.nan for col in catalogcols } )
+    df['name'] = df['name'].astype( str )
+    for racol, deccol in [ ( 'ra', 'dec' ), ( 'hostra', 'hostdec' ) ]:
+        if ( raunit != 'deg' ) or ( df[racol].dtype == object ) or ( df[deccol].dtype == object ):
+            ok = df[racol].notna() & df[deccol].notna()
+            sc = SkyCoord( df.loc[ok, racol].values, df.loc[ok, deccol].values,
+                           unit=( getattr( units, raunit ), units.deg ) )
+            df[racol] = numpy.nan
+            df[deccol] = numpy.nan
+            df.loc[ok, racol] = sc.ra.deg
+            df.loc[ok, deccol] = sc.dec.deg
+        df[racol] = df[racol].astype( float )
+        df[deccol] = df[deccol].astype( float )
+    df['z'] = pandas.to_numeric( df['z'], errors='coerce' )
+    for col in extracols:
+        df[col] = raw[col]
+    _logger.info( f"Read {len(df)} objects from {source}" )
+    return df
+
+# ======================================================================
+
+def nearest( matches, against='sn' ):
+    """Reduce all-within-radius matches to the nearest match for each catalog object.
+
+    For against='sn', every MostHosts host of the nearest SN is kept
+    (they all have the same sn_ra, sn_dec); for against='host' or
+    'snhost', just the nearest host is kept.  Unmatched catalog objects
+    are kept as-is.
+
+    """
+    matches = matches.sort_values( [ 'name', 'sep', 'hostnum' ], na_position='last' )
+    if against != 'sn':
+        return matches.drop_duplicates( 'name' ).reset_index( drop=True )
+    best = matches.drop_duplicates( 'name' )[ [ 'name', 'sn_name_sp' ] ]
+    keep = ( matches[ [ 'name', 'sn_name_sp' ] ].merge( best, how='left', on='name', suffixes=( '', '_best' ),
+                                                         validate='many_to_one' ) )
+    keep = ( keep['sn_name_sp'] == keep['sn_name_sp_best'] ) | keep['sn_name_sp_best'].isna()
+    return matches[ keep.values ].reset_index( drop=True )
+
+def _finish( matches, how, against, radius ):
+    matches['hostnum'] = matches['hostnum'].astype( 'Int64' )
+    if how == 'nearest':
+        matches = nearest( matches, against=against )
+    elif how != 'all':
+        raise ValueError( f"how must be nearest or all, not {how}" )
+    nmatched = matches.loc[ matches['sn_name_sp'].notna(), 'name' ].nunique()
+    _logger.info( f"{nmatched} of {matches['name'].nunique()} catalog objects are within {radius}\" "
+                  f"of a MostHosts {'SN' if against == 'sn' else 'host'}" )
+    return matches.sort_values( [ 'name', 'sep', 'hostnum' ], na_position='last' ).reset_index( drop=True )
+
+def _matchpos( df, against ):
+    """The catalog positions that get matched for against: (ra, dec) Series."""
+    if against in ( 'sn', 'snhost' ):
+        return df['ra'], df['dec']
+    elif against == 'host':
+        return df['hostra'].fillna( df['ra'] ), df['hostdec'].fillna( df['dec'] )
+    else:
+        raise ValueError( f"against must be sn, host, or snhost, not {against}" )
+
+def upload_catalog( cursor, df, against='sn', tablename='catalog' ):
+    """Create a temp table tablename with the catalogcols of df and COPY df into it.
+
+    The table also gets matchra, matchdec: the positions to match for
+    against (see _matchpos).
+
+    """
+    up = df[ catalogcols ].copy()
+    up['matchra'], up['matchdec'] = _matchpos( df, against )
+    cursor.execute( f"CREATE TEMP TABLE {tablename}( name text, ra double precision, dec double precision, "
+                    f"hostra double precision, hostdec double precision, z double precision, "
+                    f"matchra double precision, matchdec double precision )" )
+    buf = io.StringIO()
+    up.to_csv( buf, header=False, index=False, na_rep='' )
+    buf.seek( 0 )
+    cursor.copy_expert( f"COPY {tablename}({','.join(up.columns)}) FROM STDIN WITH ( FORMAT csv, NULL '' )", buf )
+    cursor.execute( f"ANALYZE {tablename}" )
+
+def db_crossmatch( conn, df, radius=2., how='nearest', against='sn', tablename='mosthosts' ):
+    """Crossmatch a catalog against static.{tablename} in the database with q3c.
+
+    conn — a psycopg2 connection to the desi database
+    df — a catalog from read_catalog
+    radius — match radius in arcsec
+    how — 'nearest' (see nearest()) or 'all' (every match within radius)
+    against — 'sn' to match the catalog's ra, dec to MostHosts sn_ra,
+              sn_dec; 'host' to match the catalog's host position
+              (hostra, hostdec, or ra, dec if there is no host position)
+              to the MostHosts host ra, dec; 'snhost' to match the
+              catalog's ra, dec to the MostHosts host ra, dec
+
+    The catalog is COPYed into a temp table, and the match is a single
+    q3c_join with static.{tablename} second, so its q3c indexes on ra,
+    dec and sn_ra, sn_dec (see load_mosthosts_files.py) do the lookup
+    for each catalog object.  (q3c_join can only use an index on its
+    second position, and the catalog, as the preserved side of the LEFT
+    JOIN, can't be the inner side of the loop.)  Returns a dataframe with the catalog's columns, the
+    matched MostHosts sn_name_sp, hostnum, sn_ra, sn_dec, mh_ra, mh_dec
+    (host position), sn_z, and sep (arcsec).  Catalog objects with no
+    match have one row with nulls for the MostHosts columns.
+
+    """
+    mra, mdec = ( 'm.sn_ra', 'm.sn_dec' ) if against == 'sn' else ( 'm.ra', 'm.dec' )
+    cursor = conn.cursor()
+    upload_catalog( cursor, df, against=against )
+    mhsel = ",".join( f"m.{k} AS {v}" for k, v in _mhcols.items() )
+    q = ( f"SELECT {','.join( f'c.{c}' for c in catalogcols )},{mhsel},"
+          f"  q3c_dist(c.matchra,c.matchdec,{mra},{mdec})*3600. AS sep "
+          f"FROM catalog c "
+          f"LEFT JOIN static.{tablename} m ON q3c_join(c.matchra,c.matchdec,{mra},{mdec},%(radius)s) " )
+    cursor.execute( q, { 'radius': radius / 3600. } )
+    cols = [ d[0] for d in cursor.description ]
+    matches = pandas.DataFrame( cursor.fetchall(), columns=cols )
+    cursor.execute( "DROP TABLE catalog" )
+    conn.commit()
+    extracols = [ c for c in df.columns if c not in catalogcols ]
+    if len( extracols ) > 0:
+        matches = matches.merge( df[ [ 'name' ] + extracols ].drop_duplicates( 'name' ), on='name', how='left' )
+    return _finish( matches, how, against, radius )
+
+def local_crossmatch( df, mosthosts, radius=2., how='nearest', against='sn' ):
+    """Crossmatch a catalog against a MostHosts dataframe in memory.
+
+    df — a catalog from read_catalog
+    mosthosts — the mosthosts (or df) property of a MostHostsDesi, or
+                any dataframe with sn_name_sp, hostnum, sn_ra, sn_dec,
+                ra, and dec as columns or index levels
+    radius, how, against — as in db_crossmatch
+
+    Uses a KD tree (host_association.candidate_pairs), so needs no
+    database; returns the same thing db_crossmatch does.
+
+    """
+    mh = mosthosts.reset_index()
+    if 'sn_z' not in mh.columns:
+        mh['sn_z'] = numpy.nan
+    cra, cdec = _matchpos( df, against )
+    mra, mdec = ( mh['sn_ra'], mh['sn_dec'] ) if against == 'sn' else ( mh['ra'], mh['dec'] )
+
+    catdex, mhdex = candidate_pairs( cra.values, cdec.values, mra.values, mdec.values, radius )
+    sep = separation( cra.values[catdex], cdec.values[catdex], mra.values[mhdex], mdec.values[mhdex] )
+    ok = sep <= radius
+    catdex, mhdex, sep = catdex[ok], mhdex[ok], sep[ok]
+
+    pairs = df.iloc[ catdex ].reset_index( drop=True )
+    mhpart = mh.iloc[ mhdex ][ list( _mhcols.keys() ) ].rename( columns=_mhcols ).reset_index( drop=True )
+    pairs = pandas.concat( [ pairs, mhpart ], axis=1 )
+    pairs['sep'] = sep
+    unmatched = df[ ~numpy.isin( numpy.arange( len(df) ), catdex ) ]
+    matches = pandas.concat( [ pairs, unmatched ], ignore_index=True )
+    return _finish( matches, how, against, radius )
+
+# ======================================================================
+
+def main( catalog=None, colmap=None, outprefix='crossmatch', description=None, against='sn', how='nearest',
+          matchfile=None, newfile=None ):
+    """Command-line crossmatch.  The arguments are defaults for the command-line options."""
+    parser = argparse.ArgumentParser( description=( "Crossmatch an external catalog against MostHosts"
+                                                    if description is None else description ),
+                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter )
+    parser.add_argument( "catalog", nargs=( "?" if catalog is not None else None ), default=catalog,
+                         help="CSV catalog file" )
+    parser.add_argument( "-c", "--colmap", default=None if colmap is None else
+                         ",".join( f"{k}={v}" for k, v in colmap.items() ),
+                         help="Column map: name=<col>,ra=<col>,dec=<col>[,hostra=...,hostdec=...,z=...]" )
+    parser.add_argument( "--ra-unit", default="deg", choices=[ "deg", "hourangle" ],
+                         help="Unit of catalog RA" )
+    parser.add_argument( "-r", "--radius", type=float, default=2., help="Match radius in arcsec" )
+    parser.add_argument( "--how", default=how, choices=[ "nearest", "all" ],
+                         help="Keep only the nearest MostHosts SN (or host), or every match within radius" )
+    parser.add_argument( "--against", default=against, choices=[ "sn", "host", "snhost" ],
+                         help=( "Match catalog SN positions to MostHosts SN positions (sn), host to host "
+                                "(host), or catalog SN positions to MostHosts host positions (snhost)" ) )
+    parser.add_argument( "--local", default=False, action="store_true",
+                         help="Match in memory against the MostHostsDesi cache instead of in the database" )
+    parser.add_argument( "--dbuserpwfile", default=str( pathlib.Path( os.getenv("HOME") )
+                                                         / "secrets/decatdb_desi_desi" ),
+                         help="File with database user and password" )
+    parser.add_argument( "-o", "--outprefix", default=outprefix,
+                         help="Writes {outprefix}_match.csv (all objects) and {outprefix}_new.csv (unmatched)" )
+    parser.add_argument( "--match-file", default=matchfile, help="Write all objects here instead" )
+    parser.add_argument( "--new-file", default=newfile, help="Write unmatched objects here instead" )
+    args = parser.parse_args()
+    matchfile = f"{args.outprefix}_match.csv" if args.match_file is None else args.match_file
+    newfile = f"{args.outprefix}_new.csv" if args.new_file is None else args.new_file
+    if args.colmap is None:
+        parser.error( "--colmap is required" )
+
+    df = read_catalog( args.catalog, parse_colmap( args.colmap ), raunit=args.ra_unit )
+
+    if args.local:
+        from mosthosts_desi import MostHostsDesi
+        mhd = MostHostsDesi( dbuserpwfile=args.dbuserpwfile )
+        matches = local_crossmatch( df, mhd.mosthosts, radius=args.radius, how=args.how, against=args.against )
+    else:
+        with open( args.dbuserpwfile ) as ifp:
+            dbuser, dbpasswd = ifp.readline().strip().split()
+        conn = psycopg2.connect( dbname='desidb', host='decatdb.lbl.gov', user=dbuser, password=dbpasswd )
+        try:
+            matches = db_crossmatch( conn, df, radius=args.radius, how=args.how, against=args.against )
+        finally:
+            conn.close()
+
+    matches.to_csv( matchfile, index=False )
+    new = matches[ matches['sn_name_sp'].isna() ][ catalogcols ]
+    new.to_csv( newfile, index=False )
+    _logger.info( f"Wrote {matchfile} and {newfile} ({len(new)} new objects)" )
+
+# ======================================================================
+
+if __name__ == "__main__":
+    main()
@@ -221,6 +221,19 @@ class SpectrumFinder(object):
             spectra.append( self.get_spectrum( targetid, spec['tileid'], spec['petal_loc'], spec['night'] ) )
         return spectra
 
+    @classmethod
+    def coadd_path( cls, filename ):
+        """Return path (pathlib.Path object) of the coadd file that goes with a cumulative_tiles filename.
+
+        filename is the zbest or redrock file from the filename column
+        of the {collection}.cumulative_tiles table.
+
+        """
+        match = cls.nameparse.search( filename )
+        if match is None:
+            raise ValueError( f'Error parsing filename {filename}' )
+        return cls.BASE_DIR / match.group(1) / f"coadd{match.group(3)}"
+
     def filepath( self, targetid, tile, petal, night ):
         """Return path (pathlib.Path object) of the coadd file for specified targetid, tile, petal, night."""
 
@@ -230,10 +243,7 @@ class SpectrumFinder(object):
             # import pdb; pdb.set_trace()
             raise TargetNotFound( f'No spectrum for target {targetid}, tile {tile}, petal {petal}, night {night}' )
 
-        match = self.nameparse.search( row["filename"] )
-        if match is None:
-            raise ValueError( f'Error parsing filename {row["filename"]}' )
-        return self.BASE_DIR / match.group(1) / f"coadd{match.group(3)}"
+        return self.coadd_path( row["filename"] )
 
     def get_spectrum( self, targetid, tile, petal, night, smooth=0 ):
         """Returns a desispec.spectra.Spectra object for the specified target/tile/petal/night.
@@ -249,9 +259,32 @@ class SpectrumFinder(object):
 
         """
         filepath = self.filepath( targetid, tile, petal, night )
+        return self.spectrum_from_coadd( self.read_coadd( filepath ), targetid, smooth=smooth )
+
+    @staticmethod
+    def read_coadd( filepath ):
+        """Read a whole coadd file; returns a desispec.spectra.Spectra object with all of its targets."""
+        filepath = pathlib.Path( filepath )
         if not filepath.is_file():
             raise FileNotFoundError( f'File {filepath} doesn\'t exist' )
-        threespectrums = desispec.io.spectra.read_spectra( filepath ).select( targets=[targetid] )
+        return desispec.io.spectra.read_spectra( filepath )
+
+    @staticmethod
+    def spectrum_from_coadd( spectra, targetid, smooth=0 ):
+        """Pull a single target's spectrum out of an already-read coadd file.
+
+        spectra — a desispec.spectra.Spectra object, as returned by
+                  desispec.io.read_spectra on a coadd file
+        targetid — the target to extract
+
+        Returns a desispec.spectra.Spectra object with the B, R, and Z
+        cameras combined into 'brz'.  Use this (rather than
+        get_spectrum) when you need several targets from the same file,
+        so the file is only read once.  See get_spectrum for the warning
+        about smooth.
+
+        """
+        threespectrums = spectra.select( targets=[targetid] )
         # Combine B, R, Z into brz
         spectrum = desispec.coaddition.coadd_cameras( threespectrums )
 
@@ -0,0 +1,161 @@
+import sys
+import time
+import pathlib
+import hashlib
+import logging
+import sqlite3
+
+import pandas
+
+_logger = logging.getLogger( "export_manifest" )
+if not _logger.hasHandlers():
+    _logout = logging.StreamHandler( sys.stderr )
+    _logger.addHandler( _logout )
+    _logout.setFormatter( logging.Formatter( f'[%(asctime)s - %(levelname)s] - %(message)s' ) )
+_logger.setLevel( logging.INFO )
+
+# ======================================================================
+
+def file_sha256( path, blocksize=1048576 ):
+    """Return the hex sha256 digest of the file at path."""
+    sha = hashlib.sha256()
+    with open( path, "rb" ) as ifp:
+        while True:
+            block = ifp.read( blocksize )
+            if len( block ) == 0:
+                break
+            sha.update( block )
+    return sha.hexdigest()
+
+# ======================================================================
+
+class ExportManifest:
+    """A persistent record of what exportspectra.py has written.
+
+    Backed by a SQLite file with one table, spectra, that has one row
+    for each spectrum file written.  Columns are snname, host, targetid,
+    tileid, petal, night, dex, phash0, phash1, outfile, sha256,
+    written_at.  A spectrum is identified by (snname, host, targetid,
+    tileid, petal, night); night is a yyyy-mm-dd string.
+
+    A spectrum is recorded as soon as its file has been written, so if
+    the export dies partway through, everything in the manifest is
+    complete, and anything that isn't will be redone on restart.
+
+    Only one process should write to the manifest at a time.  In
+    exportspectra.py, that's the coordinator process; the workers just
+    send back what they wrote.
+
+    """
+
+    _keycols = [ 'snname', 'host', 'targetid', 'tileid', 'petal', 'night' ]
+    _cols = _keycols + [ 'dex', 'phash0', 'phash1', 'outfile', 'sha256', 'written_at' ]
+
+    def __init__( self, path, logger=None ):
+        self.path = pathlib.Path( path )
+        self.logger = _logger if logger is None else logger
+        self.path.parent.mkdir( exist_ok=True, parents=True )
+        self._conn = sqlite3.connect( self.path )
+        self._conn.execute( "PRAGMA journal_mode=WAL" )
+        self._conn.execute( "CREATE TABLE IF NOT EXISTS spectra( snname TEXT NOT NULL, host INTEGER NOT NULL, "
+                            "targetid INTEGER NOT NULL, tileid INTEGER NOT NULL, petal INTEGER NOT NULL, "
+                            "night TEXT NOT NULL, dex INTEGER NOT NULL, phash0 TEXT, phash1 TEXT, "
+                            "outfile TEXT, sha256 TEXT, written_at REAL, "
+                            "PRIMARY KEY(snname, host, targetid, tileid, petal, night) )" )
+        self._conn.commit()
+        cols = [ row[1] for row in self._conn.execute( "PRAGMA table_info(spectra)" ).fetchall() ]
+        if set( cols ) != set( self._cols ):
+            raise RuntimeError( f"{self.path} was written by an incompatible version of exportspectra.py; "
+                                f"start over with --fresh" )
+
+    def close( self ):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc_val, exc_tb ):
+        self.close()
+
+    def record_spectra( self, spectra ):
+        """Record spectra that have been written.
+
+        spectra — a list of tuples (snname, host, targetid, tileid,
+                  petal, night, dex, phash0, phash1, outfile, sha256);
+                  this is what coadd_subprocessor in exportspectra.py
+                  sends back.
+
+        """
+        now = time.time()
+        with self._conn:
+            self._conn.executemany( f"INSERT OR REPLACE INTO spectra({','.join(self._cols)}) "
+                                    f"VALUES ({','.join( ['?'] * len(self._cols) )})",
+                                    [ ( s[0], int(s[1]), int(s[2]), int(s[3]), int(s[4]), s[5], int(s[6]),
+                                        s[7], s[8], str(s[9]), s[10], now ) for s in spectra ] )
+
+    def forget_spectra( self, keys ):
+        """Remove spectra from the manifest so they will be redone.
+
+        keys — a list of (snname, host, targetid, tileid, petal, night) tuples
+
+        """
+        with self._conn:
+            self._conn.executemany( "DELETE FROM spectra WHERE snname=? AND host=? AND targetid=? "
+                                    "  AND tileid=? AND petal=? AND night=?",
+                                    [ ( k[0], int(k[1]), int(k[2]), int(k[3]), int(k[4]), k[5] ) for k in keys ] )
+
+    def merge( self, otherpath ):
+        """Merge in the spectra from another manifest file (e.g. one shard of a split export).
+
+        Spectra in the other manifest replace any existing record of the
+        same spectrum here.  Returns the number of spectra merged.
+
+        """
+        self._conn.execute( "ATTACH DATABASE ? AS other", ( str(otherpath), ) )
+        try:
+            with self._conn:
+                cursor = self._conn.execute( f"INSERT OR REPLACE INTO spectra({','.join(self._cols)}) "
+                                             f"SELECT {','.join(self._cols)} FROM other.spectra" )
+                n = cursor.rowcount
+        finally:
+            self._conn.execute( "DETACH DATABASE other" )
+        return n
+
+    def done_spectra( self ):
+        """Return a set of (snname, host, targetid, tileid, petal, night) tuples for spectra already written."""
+        cursor = self._conn.execute( f"SELECT {','.join(self._keycols)} FROM spectra" )
+        return set( tuple(row) for row in cursor.fetchall() )
+
+    def verify( self ):
+        """Check that every spectrum file in the manifest exists and has the right checksum.
+
+        Spectra whose files are missing or corrupted are forgotten, so
+        that they will be redone.  Returns the number of spectra
+        forgotten.
+
+        """
+        spectra = self.spectra()
+        bad = []
+        for row in spectra.itertuples():
+            outfile = pathlib.Path( row.outfile )
+            if ( not outfile.is_file() ) or ( file_sha256( outfile ) != row.sha256 ):
+                self.logger.warning( f"{outfile} is missing or has the wrong checksum; will redo it" )
+                bad.append( ( row.snname, row.host, row.targid, row.tileid, row.petal, row.night ) )
+        self.forget_spectra( bad )
+        return len( bad )
+
+    def spectra( self ):
+        """Return a pandas DataFrame of all spectra recorded in the manifest.
+
+        Columns are phash0, phash1, snname, host, targid, dex, night,
+        outfile (i.e. the outmess table of exportspectra.py), plus
+        tileid, petal, and sha256.
+
+        """
+        df = pandas.read_sql_query( "SELECT phash0, phash1, snname, host, targetid AS targid, dex, night, "
+                                    "       outfile, tileid, petal, sha256 "
+                                    "FROM spectra ORDER BY phash0, phash1, snname, host, targetid, dex",
+                                    self._conn )
+        return df
@@ -0,0 +1,206 @@
+import sys
+import logging
+
+import numpy
+import pandas
+import scipy.spatial
+
+_logger = logging.getLogger( "host_association" )
+if not _logger.hasHandlers():
+    _logout = logging.StreamHandler( sys.stderr )
+    _logger.addHandler( _logout )
+    _logout.setFormatter( logging.Formatter( f'[%(asctime)s - %(levelname)s] - %(message)s' ) )
+_logger.setLevel( logging.INFO )
+
+# ======================================================================
+# Geometry
+
+def radec_to_xyz( ra, dec ):
+    """Return an (N, 3) array of unit vectors for ra, dec (degrees)."""
+    ra = numpy.radians( numpy.asarray( ra, dtype=float ) )
+    dec = numpy.radians( numpy.asarray( dec, dtype=float ) )
+    cosdec = numpy.cos( dec )
+    return numpy.stack( [ cosdec * numpy.cos( ra ), cosdec * numpy.sin( ra ), numpy.sin( dec ) ], axis=-1 )
+
+def _chord( sep ):
+    """Chord length on the unit sphere for an angular separation sep (arcsec)."""
+    return 2. * numpy.sin( numpy.radians( numpy.asarray( sep, dtype=float ) / 3600. ) / 2. )
+
+def separation( ra0, dec0, ra1, dec1 ):
+    """Angular separation (arcsec) from ra0, dec0 to ra1, dec1 (degrees), vectorized."""
+    ra0, dec0, ra1, dec1 = ( numpy.radians( numpy.asarray( x, dtype=float ) ) for x in ( ra0, dec0, ra1, dec1 ) )
+    a = ( numpy.sin( ( dec1 - dec0 ) / 2. )**2
+          + numpy.cos( dec0 ) * numpy.cos( dec1 ) * numpy.sin( ( ra1 - ra0 ) / 2. )**2 )
+    return numpy.degrees( 2. * numpy.arcsin( numpy.sqrt( numpy.clip( a, 0., 1. ) ) ) ) * 3600.
+
+def position_angle( ra0, dec0, ra1, dec1 ):
+    """Position angle (degrees east of north) of ra1, dec1 as seen from ra0, dec0, vectorized."""
+    ra0, dec0, ra1, dec1 = ( numpy.radians( numpy.asarray( x, dtype=float ) ) for x in ( ra0, dec0, ra1, dec1 ) )
+    dra = ra1 - ra0
+    return numpy.degrees( numpy.arctan2( numpy.sin( dra ) * numpy.cos( dec1 ),
+                                         numpy.cos( dec0 ) * numpy.sin( dec1 )
+                                         - numpy.sin( dec0 ) * numpy.cos( dec1 ) * numpy.cos( dra ) ) )
+
+def directional_light_radius( a, ba, pa, theta ):
+    """Radius of an ellipse in a given direction.
+
+    a — semi-major axis (arcsec)
+    ba — axis ratio b/a
+    pa — position angle of the major axis (degrees east of north)
+    theta — position angle of the direction (degrees east of north)
+
+    Returns a·b / sqrt( (a sin φ)² + (b cos φ)² ), where φ = theta - pa.
+    Where ba is unknown, the ellipse is taken to be a circle.
+
+    """
+    a = numpy.asarray( a, dtype=float )
+    ba = numpy.where( numpy.isfinite( ba ), numpy.clip( numpy.asarray( ba, dtype=float ), 0., 1. ), 1. )
+    pa = numpy.where( numpy.isfinite( pa ), numpy.asarray( pa, dtype=float ), 0. )
+    b = a * ba
+    phi = numpy.radians( numpy.asarray( theta, dtype=float ) - pa )
+    with numpy.errstate( divide='ignore', invalid='ignore' ):
+        return a * b / numpy.sqrt( ( a * numpy.sin( phi ) )**2 + ( b * numpy.cos( phi ) )**2 )
+
+# ======================================================================
+# Galaxy shapes
+
+def sga_ellipse( df, diameter='d26_sga', fallback='d25_leda_sga', pa='pa_leda_sga', ba='ba_leda_sga' ):
+    """Return (a, ba, pa) arrays for SGA galaxies.
+
+    df — a dataframe with SGA columns.  The defaults are the column names
+         in static.mosthosts; for static.sga, use diameter='d26',
+         fallback='d25_leda', pa='pa', ba='ba'.
+    diameter — column with the diameter in arcmin
+    fallback — column with a diameter (arcmin) to use where diameter is
+               null (or None to not have one)
+
+    a is the semi-major axis in arcsec.  (Some of these columns are
+    text in static.mosthosts, so everything goes through to_numeric.)
+
+    """
+    diam = pandas.to_numeric( df[diameter], errors='coerce' )
+    if fallback is not None:
+        diam = diam.fillna( pandas.to_numeric( df[fallback], errors='coerce' ) )
+    a = diam.to_numpy( dtype=float, na_value=numpy.nan ) * 60. / 2.
+    return ( a,
+             pandas.to_numeric( df[ba], errors='coerce' ).to_numpy( dtype=float, na_value=numpy.nan ),
+             pandas.to_numeric( df[pa], errors='coerce' ).to_numpy( dtype=float, na_value=numpy.nan ) )
+
+def tractor_ellipse( df, shape_r='shape_r', shape_e1='shape_e1', shape_e2='shape_e2', minradius=0.5 ):
+    """Return (a, ba, pa) arrays for Legacy Survey Tractor sources.
+
+    df — a dataframe with the Tractor shape columns
+    minradius — a (arcsec) for sources smaller than this (including
+                PSF sources, which have shape_r=0)
+
+    a is shape_r (the half-light radius, arcsec); ba and pa come from the
+    ellipticity components: |e| = sqrt(e1² + e2²), b/a = (1-|e|)/(1+|e|),
+    and pa = ½ atan2(e2, e1).
+
+    """
+    r = pandas.to_numeric( df[shape_r], errors='coerce' ).to_numpy( dtype=float, na_value=numpy.nan )
+    e1 = pandas.to_numeric( df[shape_e1], errors='coerce' ).to_numpy( dtype=float, na_value=0. )
+    e2 = pandas.to_numeric( df[shape_e2], errors='coerce' ).to_numpy( dtype=float, na_value=0. )
+    e = numpy.clip( numpy.hypot( e1, e2 ), 0., 0.999 )
+    a = numpy.fmax( r, minradius )
+    return a, ( 1. - e ) / ( 1. + e ), numpy.degrees( 0.5 * numpy.arctan2( e2, e1 ) )
+
+# ======================================================================
+
+def candidate_pairs( snra, sndec, galra, galdec, radius ):
+    """Find every (SN, galaxy) pair closer than the galaxy's search radius.
+
+    snra, sndec — SN positions (degrees)
+    galra, galdec — galaxy positions (degrees)
+    radius — search radius around each galaxy (arcsec); a scalar, or
+             an array with one per galaxy
+
+    Builds a KD tree of the SNe on the unit sphere and does one
+    ball query per galaxy (in C, on all cores).
+
+    Returns (sndex, galdex), integer arrays of the positions of the
+    pairs in the input arrays.
+
+    """
+    snxyz = radec_to_xyz( snra, sndec )
+    galxyz = radec_to_xyz( galra, galdec )
+    ok = numpy.all( numpy.isfinite( galxyz ), axis=1 )
+    radius = numpy.broadcast_to( numpy.asarray( radius, dtype=float ), ( len( galxyz ), ) )
+    ok &= numpy.isfinite( radius )
+    galdexes = numpy.nonzero( ok )[0]
+
+    snok = numpy.nonzero( numpy.all( numpy.isfinite( snxyz ), axis=1 ) )[0]
+    if ( len( snok ) == 0 ) or ( len( galdexes ) == 0 ):
+        return numpy.array( [], dtype=int ), numpy.array( [], dtype=int )
+    tree = scipy.spatial.cKDTree( snxyz[snok] )
+    hits = tree.query_ball_point( galxyz[galdexes], _chord( radius[galdexes] ), workers=-1, return_sorted=False )
+    counts = numpy.fromiter( ( len(h) for h in hits ), dtype=int, count=len(hits) )
+    if counts.sum() == 0:
+        return numpy.array( [], dtype=int ), numpy.array( [], dtype=int )
+    sndex = snok[ numpy.concatenate( [ h for h in hits if len(h) > 0 ] ).astype( int ) ]
+    galdex = numpy.repeat( galdexes, counts )
+    return sndex, galdex
+
+def associate_hosts( snra, sndec, galra, galdec, a, ba, pa, maxdlr=4., minsearch=5.,
+                     sn_ids=None, gal_ids=None, logger=None ):
+    """Rank candidate host galaxies for SNe by elliptical normalized separation.
+
+    snra, sndec — SN positions (degrees)
+    galra, galdec — candidate galaxy positions (degrees)
+    a, ba, pa — galaxy ellipses: semi-major axis (arcsec), axis ratio,
+                and position angle (degrees east of north); see
+                sga_ellipse() and tractor_ellipse()
+    maxdlr — only keep candidates with d_DLR up to this
+    minsearch — search at least this far (arcsec) around every galaxy,
+                so that galaxies with no size are still candidates by
+                plain separation
+    sn_ids, gal_ids — optional identifiers for the SNe and galaxies
+                      (e.g. sn_name_sp, sga_id) to put in the result;
+                      default is position in the input arrays
+
+    For each pair, d_DLR = sep / DLR, where DLR is the radius of the
+    galaxy's ellipse in the direction of the SN (Gupta et al. 2016);
+    d_DLR ≤ 1 means the SN is inside the ellipse.  Galaxies with no
+    size get DLR = NaN and are ranked after all galaxies with one, by
+    separation.
+
+    Returns a dataframe with one row per candidate pair: sn, galaxy,
+    sep (arcsec), theta (position angle of SN from galaxy), dlr
+    (arcsec), d_dlr, and rank (1 = best host for that SN), sorted by
+    sn and rank.
+
+    """
+    logger = _logger if logger is None else logger
+    a = numpy.asarray( a, dtype=float )
+    ba = numpy.asarray( ba, dtype=float )
+    pa = numpy.asarray( pa, dtype=float )
+    radius = numpy.fmax( numpy.nan_to_num( maxdlr * a, nan=0. ), minsearch )
+    sndex, galdex = candidate_pairs( snra, sndec, galra, galdec, radius )
+
+    snra = numpy.asarray( snra, dtype=float )[sndex]
+    sndec = numpy.asarray( sndec, dtype=float )[sndex]
+    gra = numpy.asarray( galra, dtype=float )[galdex]
+    gdec = numpy.asarray( galdec, dtype=float )[galdex]
+    sep = separation( gra, gdec, snra, sndec )
+    theta = position_angle( gra, gdec, snra, sndec )
+    dlr = directional_light_radius( a[galdex], ba[galdex], pa[galdex], theta )
+    with numpy.errstate( divide='ignore', invalid='ignore' ):
+        d_dlr = numpy.where( dlr > 0, sep / dlr, numpy.nan )
+
+    pairs = pandas.DataFrame( { 'sn': sndex if sn_ids is None else numpy.asarray( sn_ids )[sndex],
+                                'galaxy': galdex if gal_ids is None else numpy.asarray( gal_ids )[galdex],
+                                'sep': sep, 'theta': theta, 'dlr': dlr, 'd_dlr': d_dlr } )
+    keep = ( pairs['d_dlr'] <= maxdlr ) | ( pairs['d_dlr'].isna() & ( pairs['sep'] <= minsearch ) )
+    pairs = pairs[ keep ]
+
+    # Rank by d_dlr, then (for galaxies with no size) by separation
+    pairs = pairs.assign( _nodlr=pairs['d_dlr'].isna() ).sort_values( [ 'sn', '_nodlr', 'd_dlr', 'sep' ] )
+    pairs['rank'] = pairs.groupby( 'sn', sort=False ).cumcount() + 1
+    pairs = pairs.drop( columns='_nodlr' ).reset_index( drop=True )
+
+    logger.info( f"{len(pairs)} candidate hosts for {pairs['sn'].nunique()} SNe" )
+    return pairs
+
+def best_hosts( pairs ):
+    """Return the rank 1 rows of associate_hosts() output, indexed by sn."""
+    return pairs[ pairs['rank'] == 1 ].set_index( 'sn' )
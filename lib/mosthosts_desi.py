@@ -1,5 +1,6 @@
 import os
 import sys
+import json
 import math
 import pathlib
 import pickle
@@ -161,7 +162,7 @@ class MostHostsDesi(object):
     # ========================================
     
     def __init__( self, release='daily', force_regen=False, latest_night_only=True, logger=None,
-                  dbuserpwfile=None, dbuser=None, dbpasswd=None ):
+                  dbuserpwfile=None, dbuser=None, dbpasswd=None, changelog=None ):
         '''Build Pandas dataframes with info about Desi observation of mosthosts hosts.
         
         It matches by searching the daily tables by RA/Dec; things
@@ -218,6 +219,14 @@ class MostHostsDesi(object):
                            sitting around in files that are accessible
                            by people outside of the DESI collaboration!
 
+        changelog — The JSON change log written by
+                    load_mosthosts_files.py --upsert (or a list of
+                    them).  If given (and the .pkl files are being read
+                    rather than regenerated), only the SNe listed in the
+                    change log are regenerated from the database and
+                    spliced into the cached dataframes, which are then
+                    rewritten.  See apply_changelog().
+
         '''
         global _mhdlogger
         self.logger = _mhdlogger if logger is None else logger
@@ -254,8 +263,12 @@ class MostHostsDesi(object):
             else:
                 mustregen = True
 
-        if mustregen:
-            self.generate_df( release, latest_night_only )
+        if ( not mustregen ) and ( changelog is not None ):
+            self.apply_changelog( changelog, latest_night_only=latest_night_only )
+        
+        if mustregen or ( changelog is not None ):
+            if mustregen:
+                self.generate_df( release, latest_night_only )
 
             # with open( pklfile, "wb" ) as ofp:
             #     pickle.dump( self._df, ofp )
@@ -340,10 +353,42 @@ class MostHostsDesi(object):
     
     # ========================================
             
-    def generate_df( self, release, latest_night_only ):
+    def apply_changelog( self, changelog, latest_night_only=True ):
+        """Regenerate just the SNe in a mosthosts change log.
+
+        changelog — path of a JSON change log from load_mosthosts_files.py
+                    --upsert, or a list of paths
+
+        The rows for the SNe in the change log's sn_names are dropped
+        from the df and haszdf dataframes and rebuilt from the database.
+        (The mosthosts dataframe is always read fresh from the
+        database.)  Does not rewrite the cache files; the constructor
+        does that when you pass it changelog.
+
+        """
+        changelogs = [ changelog ] if isinstance( changelog, ( str, pathlib.Path ) ) else changelog
+        sn_names = set()
+        for path in changelogs:
+            with open( path ) as ifp:
+                sn_names |= set( json.load( ifp )['sn_names'] )
+        sn_names = sorted( sn_names )
+        self.logger.info( f"Regenerating {len(sn_names)} SNe from change log" )
+        if len( sn_names ) > 0:
+            self.generate_df( self.release, latest_night_only, sn_names=sn_names )
+
+    def generate_df( self, release, latest_night_only, sn_names=None ):
+        """Build the df and haszdf dataframes from the database.
+
+        If sn_names is given, only those SNe are rebuilt, and their rows
+        replace whatever the existing df and haszdf have for them.
+
+        """
         # Get the dataframe of information from the desi tables
 
         mosthosts_subset = self.mosthosts[ [ 'ra','dec', 'sn_ra', 'sn_dec', 'sn_z' ] ]
+        if sn_names is not None:
+            mosthosts_subset = mosthosts_subset[ mosthosts_subset.index.get_level_values( 'sn_name_sp' )
+                                                 .isin( sn_names ) ]
         
         if release == "fujilupe":
             raise RuntimeError( "Fujilupe hack not implemented." )
@@ -367,6 +412,9 @@ class MostHostsDesi(object):
                   f"INNER JOIN {release}.tiles_fibermap f "
                   f"  ON q3c_join(m.ra,m.dec,f.target_ra,f.target_dec,%(radius)s) " )
         subs = { 'radius': 1./3600. }
+        if sn_names is not None:
+            query += "WHERE m.sn_name_sp=ANY(%(sn_names)s) "
+            subs['sn_names'] = list( sn_names )
         cursor.execute( query, subs )
         query = ( "SELECT COUNT(*) AS n FROM temp_mosthosts_search1" )
         cursor.execute( query )
@@ -386,7 +434,9 @@ class MostHostsDesi(object):
                   f"  {release}.cumulative_tiles c INNER JOIN {release}.tiles_redshifts r ON r.cumultile_id=c.id"
                   f") ON (c.tileid,c.petal)=(m.tileid,m.petal_loc) AND m.targetid=r.targetid" )
         cursor.execute( query )
-        desidf = pandas.DataFrame( cursor.fetchall() )
+        desidf = pandas.DataFrame( cursor.fetchall(),
+                                   columns=[ 'sn_name_sp', 'hostnum', 'targetid', 'tileid', 'petal_loc', 'night',
+                                             'z', 'zerr', 'zwarn', 'chi2', 'deltachi2', 'spectype', 'subtype' ] )
         self.logger.info( f"...done getting night/redshift/type info, got {len(desidf)} rows." )
 
         dbconn.close()
@@ -410,7 +460,7 @@ class MostHostsDesi(object):
 
         self.logger.info( "Building hazdf..." )
         desidf.set_index( ['sn_name_sp', 'hostnum', 'targetid', 'tileid', 'petal', 'night' ], inplace=True )
-        self._haszdf = mosthosts_subset.join( desidf, how="inner" )
+        haszdf = mosthosts_subset.join( desidf, how="inner" )
 
         # Combine together redshifts in desidf to make a sort of aggregate redshift
         # Then make the _df table by appending this to the _mosthosts talbe
@@ -425,10 +475,24 @@ class MostHostsDesi(object):
             return row.iloc[0]
 
         subdf = desidf[ desidf['zwarn'] == 0 ]
-        combdf = subdf.reset_index().groupby( ['sn_name_sp','hostnum'] ).apply( zcomb )
-        combdf = combdf.set_index( ['sn_name_sp', 'hostnum'] )[ [ 'z', 'zerr', 'zdisp' ] ]
+        if len( subdf ) > 0:
+            combdf = subdf.reset_index().groupby( ['sn_name_sp','hostnum'] ).apply( zcomb )
+            combdf = combdf.set_index( ['sn_name_sp', 'hostnum'] )[ [ 'z', 'zerr', 'zdisp' ] ]
+        else:
+            combdf = pandas.DataFrame( { 'z': [], 'zerr': [], 'zdisp': [] },
+                                       index=pandas.MultiIndex.from_arrays( [ [], [] ],
+                                                                            names=[ 'sn_name_sp', 'hostnum' ] ) )
         
-        self._df = mosthosts_subset.join( combdf, how='left' )
+        df = mosthosts_subset.join( combdf, how='left' )
+
+        if sn_names is None:
+            self._df = df
+            self._haszdf = haszdf
+        else:
+            keepdf = ~self._df.index.get_level_values( 'sn_name_sp' ).isin( sn_names )
+            keephasz = ~self._haszdf.index.get_level_values( 'sn_name_sp' ).isin( sn_names )
+            self._df = pandas.concat( [ self._df[ keepdf ], df ] ).sort_index()
+            self._haszdf = pandas.concat( [ self._haszdf[ keephasz ], haszdf ] ).sort_index()
         
         self.logger.info( f"Done generating dataframes." )
         
@@ -0,0 +1,132 @@
+import sys
+import logging
+
+import pandas
+
+_logger = logging.getLogger( "mosthosts_reconcile" )
+if not _logger.hasHandlers():
+    _logout = logging.StreamHandler( sys.stderr )
+    _logger.addHandler( _logout )
+    _logout.setFormatter( logging.Formatter( f'[%(asctime)s - %(levelname)s] - %(message)s' ) )
+_logger.setLevel( logging.INFO )
+
+# ======================================================================
+
+def normalize_names( names ):
+    """Normalize a Series of SN names so that aliases can be compared.
+
+    Lowercases, removes whitespace, and strips a leading "SN" or "AT",
+    so that, e.g., "SN 2019abc", "AT2019abc", and "2019abc" all match.
+
+    """
+    return ( names.astype( str ).str.lower()
+             .str.replace( r'\s+', '', regex=True )
+             .str.replace( r'^(sn|at)(?=\d)', '', regex=True ) )
+
+def mosthosts_names( mosthosts ):
+    """Return a long dataframe of all the names MostHosts has for each SN.
+
+    mosthosts — the mosthosts property of a MostHostsDesi object
+                (indexed by sn_name_sp, hostnum)
+
+    Returns a dataframe with columns sn_name_sp, kind (sp, sn, tns, iau,
+    or ptf), name, and normname (see normalize_names), with one row for
+    each distinct (sn_name_sp, kind, name).
+
+    """
+    df = mosthosts.reset_index()
+    cols = { 'sn_name_sp': 'sp', 'sn_name': 'sn', 'sn_name_tns': 'tns', 'sn_name_iau': 'iau', 'sn_name_ptf': 'ptf' }
+    cols = { k: v for k, v in cols.items() if k in df.columns }
+    names = df[ list( cols.keys() ) ].rename( columns=cols )
+    names['sn_name_sp'] = df['sn_name_sp']
+    names = names.melt( id_vars='sn_name_sp', var_name='kind', value_name='name' )
+    names = names[ names['name'].notna() & ( names['name'].astype(str).str.strip() != '' ) ]
+    names = names.drop_duplicates().reset_index( drop=True )
+    names['normname'] = normalize_names( names['name'] )
+    return names
+
+def skyportal_names( spdf ):
+    """Return a long dataframe of all the names SkyPortal has for each source.
+
+    spdf — the df property of a MostHostsSkyPortal object (indexed by id)
+
+    Returns a dataframe with columns obj_id, kind (id or alias), name,
+    and normname.
+
+    """
+    ids = pandas.DataFrame( { 'obj_id': spdf.index.values, 'kind': 'id', 'name': spdf.index.values } )
+    if 'alias' in spdf.columns:
+        aliases = spdf['alias'].explode().dropna()
+        aliases = pandas.DataFrame( { 'obj_id': aliases.index.values, 'kind': 'alias', 'name': aliases.values } )
+        names = pandas.concat( [ ids, aliases ], ignore_index=True )
+    else:
+        names = ids
+    names = names.drop_duplicates( [ 'obj_id', 'name' ] ).reset_index( drop=True )
+    names['normname'] = normalize_names( names['name'] )
+    return names
+
+# ======================================================================
+
+def reconcile( mosthosts, spdf, logger=None ):
+    """Compare the SNe in MostHosts with the sources in the SkyPortal MostHosts group.
+
+    mosthosts — the mosthosts property of a MostHostsDesi object
+    spdf — the df property of a MostHostsSkyPortal object
+
+    All of the comparisons are hash joins (Index.isin, merge), so this
+    runs in well under a second on the cached tables.
+
+    Returns a dict of dataframes:
+
+      skyportal_repeats — SkyPortal ids that show up more than once
+                          (columns obj_id, count)
+      shared_names — MostHosts TNS/IAU/PTF names used by more than one
+                     sn_name_sp (columns normname, sn_name_sp)
+      matched — sn_name_sp that are SkyPortal ids (column sn_name_sp)
+      alias_only — sn_name_sp that aren't SkyPortal ids, but where
+                   one of MostHosts' names for the SN matches a SkyPortal
+                   id or alias (columns sn_name_sp, obj_id, kind, name,
+                   spkind, spname)
+      missing_from_skyportal — sn_name_sp that don't match anything on
+                               SkyPortal (column sn_name_sp)
+      missing_from_mosthosts — SkyPortal sources that don't match any
+                               MostHosts name (column obj_id)
+
+    """
+    logger = _logger if logger is None else logger
+    mhnames = mosthosts_names( mosthosts )
+    spnames = skyportal_names( spdf )
+    spids = pandas.Index( spdf.index.unique() )
+    snnames = pandas.Index( mosthosts.index.get_level_values( 'sn_name_sp' ).unique() )
+
+    counts = spdf.index.value_counts()
+    repeats = counts[ counts > 1 ].rename_axis( 'obj_id' ).reset_index( name='count' )
+
+    aliases = mhnames[ mhnames['kind'] != 'sp' ].drop_duplicates( [ 'normname', 'sn_name_sp' ] )
+    nshared = aliases.groupby( 'normname' )['sn_name_sp'].transform( 'size' )
+    shared = aliases.loc[ nshared > 1, [ 'normname', 'sn_name_sp' ] ].sort_values( [ 'normname', 'sn_name_sp' ] )
+
+    matched = snnames[ snnames.isin( spids ) ]
+    unmatched = snnames[ ~snnames.isin( spids ) ]
+
+    # Any MostHosts name for an unmatched SN against any SkyPortal id or alias
+    cands = mhnames[ mhnames['sn_name_sp'].isin( unmatched ) ]
+    aliasonly = cands.merge( spnames.rename( columns={ 'kind': 'spkind', 'name': 'spname' } ), on='normname' )
+    aliasonly = ( aliasonly[ [ 'sn_name_sp', 'obj_id', 'kind', 'name', 'spkind', 'spname' ] ]
+                  .drop_duplicates().sort_values( [ 'sn_name_sp', 'obj_id' ] ).reset_index( drop=True ) )
+
+    missingsp = unmatched[ ~unmatched.isin( aliasonly['sn_name_sp'] ) ]
+
+    # A SkyPortal source is accounted for if its id or any alias matches any MostHosts name
+    hit = spnames.loc[ spnames['normname'].isin( mhnames['normname'] ), 'obj_id' ]
+    missingmh = spids[ ~spids.isin( hit ) ]
+
+    report = { 'skyportal_repeats': repeats,
+               'shared_names': shared.reset_index( drop=True ),
+               'matched': pandas.DataFrame( { 'sn_name_sp': matched.values } ),
+               'alias_only': aliasonly,
+               'missing_from_skyportal': pandas.DataFrame( { 'sn_name_sp': missingsp.values } ),
+               'missing_from_mosthosts': pandas.DataFrame( { 'obj_id': missingmh.values } ) }
+    logger.info( f"{len(snnames)} SNe in MostHosts, {len(spids)} sources on SkyPortal: "
+                 + ", ".join( f"{len(v)} {k}" for k, v in report.items() ) )
+    return report
@@ -1,12 +1,27 @@
 import sys
+import pathlib
 import logging
+import os
 import re
+import gzip
+import datetime
 import requests
+import requests.adapters
+import urllib3.util.retry
 import json
+import math
 import time
+import threading
+import concurrent.futures
 # import html2text
 import pandas
 
+_libdir = str( pathlib.Path( __file__ ).parent )
+if _libdir not in sys.path:
+    sys.path.insert( 0, _libdir )
+
+from telemetry import Telemetry
+
 _logger = logging.getLogger( "mosthosts_skyportal" )
 _logerr = logging.StreamHandler( sys.stderr )
 _logger.addHandler( _logerr )
@@ -26,6 +41,76 @@ class SpExc(Exception):
         return f'Status {self.status}: {self.info} ("{self.message}")'
 
 # ======================================================================
+
+def _write_parquet( df, path ):
+    """Atomically write df to the parquet file path; return the list of columns written as JSON.
+
+    Parquet can't hold columns of lists and dicts (or of mixed types),
+    so object columns that have anything other than strings in them are
+    written as JSON text.  Pass the returned list to _read_parquet to
+    get them back.
+
+    """
+    path = pathlib.Path( path )
+    out = df.copy()
+    jsoncols = []
+    for col in out.columns:
+        if out[col].dtype == object:
+            notnull = out[col][ out[col].notna() ]
+            if not notnull.map( lambda v: isinstance( v, str ) ).all():
+                jsoncols.append( col )
+                out[col] = out[col].map( json.dumps, na_action='ignore' )
+    tmpfile = path.parent / f'.{path.name}.tmp'
+    out.to_parquet( tmpfile )
+    os.replace( tmpfile, path )
+    return jsoncols
+
+def _read_parquet( path, jsoncols ):
+    df = pandas.read_parquet( path )
+    for col in jsoncols:
+        df[col] = df[col].map( json.loads, na_action='ignore' )
+    return df
+
+# ======================================================================
+
+class RateLimiter:
+    """A thread-safe token bucket.
+
+    Call acquire() before each request; it sleeps as needed so that no
+    more than rate calls per second go out on average, with bursts of up
+    to burst calls.  rate=None means no limit.
+
+    """
+
+    def __init__( self, rate, burst=None ):
+        self._lock = threading.Lock()
+        self._tokens = 0.
+        self._last = time.monotonic()
+        self.set_rate( rate, burst )
+
+    def set_rate( self, rate, burst=None ):
+        """Change the rate; burst defaults to one second's worth of calls."""
+        with self._lock:
+            self.rate = rate
+            self.burst = None if rate is None else max( 1., rate if burst is None else burst )
+            if self.burst is not None:
+                self._tokens = min( self._tokens, self.burst )
+
+    def acquire( self, n=1 ):
+        while True:
+            with self._lock:
+                if self.rate is None:
+                    return
+                now = time.monotonic()
+                self._tokens = min( self.burst, self._tokens + ( now - self._last ) * self.rate )
+                self._last = now
+                if self._tokens >= n:
+                    self._tokens -= n
+                    return
+                wait = ( n - self._tokens ) / self.rate
+            time.sleep( wait )
+
+# ======================================================================
     
 class MostHostsSkyPortal:
     """Encapsulate info about what MostHosts candidates are on SkyPortal.
@@ -35,12 +120,15 @@ class MostHostsSkyPortal:
     methods can be used to further query skyportal (with some error
     return checking built in.
 
-    The df dataframe is by default cached in "skyportalcache.pkl" in the
-    local directory.  Of course, this means that the data you have might
-    be out of date from what's on the SkyPortal.  Call the instance's
-    generate_df method with regen=True to force this file to be
-    regenerated.  (Takes a little while — several minutes, as of Feb
-    2022 when there are ~15k candidates in MostHosts.)
+    The df dataframe is by default cached in "skyportalcache.parquet"
+    (with metadata in "skyportalcache.json") in the local directory.  Of
+    course, this means that the data you have might be out of date from
+    what's on the SkyPortal.  Call the instance's generate_df method
+    with sync=True to pull down just the sources that have changed since
+    the cache was written, or with regen=True to force the whole cache
+    to be regenerated.  (Pages are fetched concurrently, so even that
+    takes seconds rather than the several minutes it used to take for
+    the ~15k candidates in MostHosts.)
 
     The dataframe is indexed by "id" (corresponds to object id on
     Skyportal and spname in the MostHostsDesi object from
@@ -54,20 +142,16 @@ class MostHostsSkyPortal:
         dec_dis
         redshift
         redshift_error
-        redshift_history
         gal_lon
         gal_lat
         luminosity_distance
         dm
         angular_diameter_distance
         alias
-        classifications
-        annotations
         transient
         varstar
         is_roid
         score
-        altdata
         origin
         dist_nearest_source
         mag_nearest_source
@@ -78,7 +162,20 @@ class MostHostsSkyPortal:
         modified
         internal_key
         offset
-        groups
+
+    The nested fields SkyPortal returns for each source are split out
+    into separate flat dataframes, one row per item, each with a
+    source_id column that links it to the index of df.  They are the
+    properties classifications, annotations, redshift_history, altdata
+    (one row per source that has altdata), and groups.  The columns are
+    whatever fields SkyPortal gives for each (e.g. classification,
+    probability, author_name for classifications); nested dicts are
+    flattened into columns with names like "data.field".  They're only
+    read from the cache when first used.  With them you can do things
+    like find every source classified as a Ia with:
+
+        cl = mhsp.classifications
+        iaids = cl.loc[ cl['classification'] == 'Ia', 'source_id' ].unique()
 
     Once you have this dataframe loaded, you can call the
     spectra_for_obj(objid) method of your MostHostsSkyPortal instance to
@@ -88,17 +185,86 @@ class MostHostsSkyPortal:
     Another method, get_spectrum_info(), returns a Pandas DataFrame with
     information about all of the spectra in the MostHosts group.
 
+    All queries go through one requests.Session owned by the instance,
+    so connections to SkyPortal are kept alive and reused.  The
+    session's connection pool is big enough for poolsize threads to
+    share the instance.  Connection errors, and 429 and 5xx returns,
+    are retried with exponential backoff (honoring any Retry-After
+    header the server sends).  POSTs are not retried unless
+    retry_post=True, since a POST that timed out may have been applied.
+    All requests (from all threads) share one RateLimiter, so at most
+    maxrate requests per second go to the server.
+
+    Multi-page listings (/api/sources, /api/spectra) are fetched with
+    fetch_pages(), which gets the first page to find out how many there
+    are, and then pulls the rest with nthreads threads.
+
     """
     
     mosthosts_group_id = 36
+    retry_statuses = [ 429, 500, 502, 503, 504 ]
+    childtables = [ 'classifications', 'annotations', 'redshift_history', 'altdata', 'groups' ]
+
+    def __init__( self, url="https://desi-skyportal.lbl.gov", token=None, logger=None,
+                  timeout=(10., 120.), retries=5, backoff=1., poolsize=16, retry_post=False, gzip=False,
+                  maxrate=20., nthreads=8, cachefile="skyportalcache.parquet" ):
+        """Connect to SkyPortal.
 
-    def __init__( self, url="https://desi-skyportal.lbl.gov", token=None, logger=None ):
+        url — base URL of the SkyPortal
+        token — SkyPortal API token
+        logger — a logging.Logger
+        timeout — seconds; either one number, or (connect, read)
+        retries — number of times to retry a failed request
+        backoff — retries wait backoff×2ⁿ⁻¹ seconds (n = retry number)
+                  unless the server says Retry-After
+        poolsize — number of connections to keep in the pool; set this
+                   to at least the number of threads that will use this
+                   object at once
+        retry_post — also retry POST requests
+        gzip — if True, gzip request bodies (sent with Content-Encoding: gzip)
+        maxrate — maximum requests per second to send (None for no limit)
+        nthreads — default number of threads for fetch_pages()
+        cachefile — where to cache the df property; the child tables go
+                    next to it, in e.g. skyportalcache_classifications.parquet
+
+        """
         if token is None:
             raise Exception( "API token required" )
         self._spapi = f'{url}/api'
         self._token = token
         self._df = None
+        self._children = {}
+        self._cachemeta = None
         self.logger = _logger if logger is None else logger
+        self.timeout = timeout
+        self.gzip = gzip
+        self.nthreads = nthreads
+        self.cachefile = pathlib.Path( cachefile )
+        self.ratelimiter = RateLimiter( maxrate )
+
+        methods = set( urllib3.util.retry.Retry.DEFAULT_ALLOWED_METHODS )
+        if retry_post:
+            methods.add( 'POST' )
+        retry = urllib3.util.retry.Retry( total=retries, backoff_factor=backoff,
+                                          status_forcelist=self.retry_statuses,
+                                          allowed_methods=frozenset( methods ),
+                                          respect_retry_after_header=True,
+                                          raise_on_status=False )
+        adapter = requests.adapters.HTTPAdapter( pool_connections=poolsize, pool_maxsize=poolsize,
+                                                 max_retries=retry )
+        self._session = requests.Session()
+        self._session.headers.update( { 'Authorization': f'token {self._token}' } )
+        self._session.mount( 'https://', adapter )
+        self._session.mount( 'http://', adapter )
+
+    def close( self ):
+        self._session.close()
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc_val, exc_tb ):
+        self.close()
         
     @property
     def df( self ):
@@ -106,20 +272,66 @@ class MostHostsSkyPortal:
             self.generate_df( regen=False )
         return self._df
 
+    def _child( self, table ):
+        if self._df is None:
+            self.generate_df( regen=False )
+        if table not in self._children:
+            self._children[table] = _read_parquet( self._childfile( table ),
+                                                   self._cachemeta['jsoncols'][table] )
+        return self._children[table]
+
+    @property
+    def classifications( self ):
+        return self._child( 'classifications' )
+
+    @property
+    def annotations( self ):
+        return self._child( 'annotations' )
+
+    @property
+    def redshift_history( self ):
+        return self._child( 'redshift_history' )
+
+    @property
+    def altdata( self ):
+        return self._child( 'altdata' )
+
+    @property
+    def groups( self ):
+        return self._child( 'groups' )
+
     @property
     def apiurl( self ):
         return self._spapi
     
-    def sp_req( self, method, url, data=None, params=None ):
+    def sp_req( self, method, url, data=None, params=None, body=None ):
         """Query SkyPortal and return the result.
 
-        Raises an SpExc exception if there's an error return or if the
-        query returns text/html (instead of json).
+        data — a data structure to send as the JSON body
+        params — URL query parameters
+        body — bytes of already-encoded JSON to send as the body
+               (instead of data)
+
+        If this object was created with gzip=True, request bodies are
+        gzipped.
+
+        Raises an SpExc exception if there's an error return (after
+        retries) or if the query returns text/html (instead of json).
 
         Returns the data structure given by the SkyPortal API.
         """
-        headers = { 'Authorization': f'token {self._token}' }
-        res = requests.request( method, url, json=data, params=params, headers=headers )
+        self.ratelimiter.acquire()
+        if ( body is None ) and ( data is not None ) and self.gzip:
+            body = json.dumps( data ).encode( 'utf-8' )
+        if body is not None:
+            headers = { 'Content-Type': 'application/json' }
+            if self.gzip:
+                body = gzip.compress( body, compresslevel=5 )
+                headers['Content-Encoding'] = 'gzip'
+            res = self._session.request( method, url, data=body, params=params, headers=headers,
+                                         timeout=self.timeout )
+        else:
+            res = self._session.request( method, url, json=data, params=params, timeout=self.timeout )
 
         if res.status_code not in [200,400]:
             self.logger.error( f'Got back status {res.status_code} ({res.reason})' )
@@ -161,36 +373,248 @@ class MostHostsSkyPortal:
         if 'data' not in retval:
             raise SpExc( 'Skyportal query returned no data!' )
         return retval['data']
+
+    def fetch_pages( self, url, params, listkey, numperpage=100, nthreads=None, telemetry=None ):
+        """Get everything from a paged SkyPortal listing.
+
+        url — the API endpoint (e.g. f'{self.apiurl}/sources')
+        params — query parameters (not including pageNumber and numPerPage)
+        listkey — the key of the list in the returned data (e.g. 'sources')
+        numperpage — rows to ask for per page
+        nthreads — number of pages to fetch at once (default: self.nthreads)
+        telemetry — optional Telemetry; set_total is called with
+                    totalMatches, and the 'pages' counter and the
+                    telemetry's main counter (by the number of rows) are
+                    incremented as pages come in.
+
+        Page 1 is fetched first to get totalMatches; after that, the
+        rest of the pages are fetched concurrently.  Returns a list of
+        the rows from all pages, in page order, with rows whose id was
+        already seen on an earlier page dropped.  (Rows can shift
+        between pages if things are added while paging.)  If the
+        endpoint doesn't page and just returns a list, that list is
+        returned.
+
+        """
+        nthreads = self.nthreads if nthreads is None else nthreads
+
+        def getpage( pagenum ):
+            pageparams = dict( params )
+            pageparams.update( { 'pageNumber': pagenum, 'numPerPage': numperpage } )
+            info = self.sp_req_data( 'GET', url, params=pageparams )
+            if telemetry is not None:
+                telemetry.increment( n=len( info ) if isinstance( info, list ) else len( info[listkey] ) )
+                telemetry.increment( 'pages' )
+            return info
+
+        first = getpage( 1 )
+        if isinstance( first, list ):
+            return first
+        total = first['totalMatches']
+        if telemetry is not None:
+            telemetry.set_total( total )
+        npages = max( 1, math.ceil( total / numperpage ) )
+
+        pages = { 1: first[listkey] }
+        if npages > 1:
+            with concurrent.futures.ThreadPoolExecutor( max_workers=nthreads ) as pool:
+                futures = { pool.submit( getpage, n ): n for n in range( 2, npages+1 ) }
+                for future in concurrent.futures.as_completed( futures ):
+                    pages[ futures[future] ] = future.result()[listkey]
+
+        rows = []
+        seen = set()
+        for n in range( 1, npages+1 ):
+            for row in pages[n]:
+                if ( 'id' in row ) and ( row['id'] in seen ):
+                    continue
+                seen.add( row.get( 'id' ) )
+                rows.append( row )
+        if len( rows ) != total:
+            self.logger.warning( f'{url}: got {len(rows)} unique rows, but totalMatches was {total}' )
+        return rows
     
-    def generate_df( self, regen=False ):
+    @property
+    def cachemetafile( self ):
+        return self.cachefile.with_suffix( '.json' )
+
+    def _childfile( self, table ):
+        return self.cachefile.parent / f'{self.cachefile.stem}_{table}{self.cachefile.suffix}'
+
+    def _read_cache( self ):
+        """Read df from the cache, and the cache metadata.  The child tables are read lazily by _child().
+
+        Returns the metadata.  Raises an exception if the files aren't
+        there or are unreadable.
+
+        """
+        with open( self.cachemetafile ) as ifp:
+            meta = json.load( ifp )
+        self._df = _read_parquet( self.cachefile, meta['jsoncols']['sources'] )
+        self._children = {}
+        self._cachemeta = meta
+        return meta
+
+    def _write_cache( self, highwater ):
+        """Write df and the child tables to the cache, with highwater as the time of the newest modification.
+
+        The metadata file is written last, so if something goes wrong
+        partway through, the next read will fail and regenerate.
+
+        """
+        jsoncols = { 'sources': _write_parquet( self._df, self.cachefile ) }
+        for table in self.childtables:
+            jsoncols[table] = _write_parquet( self._children[table], self._childfile( table ) )
+        meta = { 'highwater': highwater,
+                 'synced_at': datetime.datetime.now( tz=datetime.timezone.utc ).isoformat(),
+                 'nsources': len( self._df ),
+                 'jsoncols': jsoncols }
+        tmpmeta = self.cachemetafile.parent / f'.{self.cachemetafile.name}.tmp'
+        with open( tmpmeta, "w" ) as ofp:
+            json.dump( meta, ofp, indent=2 )
+        os.replace( tmpmeta, self.cachemetafile )
+        self._cachemeta = meta
+
+    @classmethod
+    def _normalize( cls, df ):
+        """Split the nested columns of a sources dataframe into child tables.
+
+        Returns (df, children), where df no longer has the nested
+        columns, and children is a dict of table name → dataframe.
+
+        """
+        children = {}
+        for table in cls.childtables:
+            if table not in df.columns:
+                children[table] = pandas.DataFrame( { 'source_id': pandas.Series( [], dtype=object ) } )
+                continue
+            items = df[table] if table == 'altdata' else df[table].explode()
+            items = items[ items.map( lambda v: isinstance( v, dict ) ) ]
+            child = pandas.json_normalize( items.tolist() )
+            child.insert( 0, 'source_id', items.index.values )
+            children[table] = child
+        return df.drop( columns=[ t for t in cls.childtables if t in df.columns ] ), children
+
+    @staticmethod
+    def _highwater( df ):
+        """The latest created_at or modified time in df, as an ISO string (or None)."""
+        times = [ pandas.to_datetime( df[col], utc=True, errors='coerce' ).max()
+                  for col in [ 'created_at', 'modified' ] if col in df.columns ]
+        times = [ t for t in times if not pandas.isna( t ) ]
+        return max( times ).isoformat() if len( times ) > 0 else None
+
+    def _fetch_sources( self, telemetry, **kwargs ):
+        data = { 'group_ids': [self.mosthosts_group_id],
+                 'includeSpectrumExists': True,
+        }
+        data.update( kwargs )
+        sources = self.fetch_pages( f'{self._spapi}/sources', data, 'sources', telemetry=telemetry )
+        df = pandas.DataFrame( sources )
+        if len( df ) > 0:
+            df.set_index( 'id', inplace=True )
+        return self._normalize( df )
+
+    def fetch_source_ids( self, telemetry=None ):
+        """Return the set of ids of all the sources in the MostHosts group.
+
+        SkyPortal has no id-only listing, but without any of the
+        include* options the listing is just the basic source fields,
+        so with big pages this is much cheaper than _fetch_sources.
+
+        """
+        rows = self.fetch_pages( f'{self._spapi}/sources', { 'group_ids': [self.mosthosts_group_id] }, 'sources',
+                                 numperpage=500, telemetry=telemetry )
+        return { row['id'] for row in rows }
+
+    def _fetch_sources_by_id( self, ids ):
+        """Fetch the sources ids one at a time (concurrently); returns (df, children) like _fetch_sources."""
+        def getsource( objid ):
+            return self.sp_req_data( 'GET', f'{self._spapi}/sources/{objid}',
+                                     params={ 'includeSpectrumExists': True } )
+
+        with concurrent.futures.ThreadPoolExecutor( max_workers=self.nthreads ) as pool:
+            sources = list( pool.map( getsource, sorted( ids ) ) )
+        df = pandas.DataFrame( sources )
+        if len( df ) > 0:
+            df.set_index( 'id', inplace=True )
+        return self._normalize( df )
+
+    def _replace_sources( self, df, children, dropids=() ):
+        """Drop the sources dropids and the sources in df from self._df and children, then add df and children.
+
+        df and children may be None, to just drop dropids.
+
+        """
+        dropids = set( dropids ) | ( set() if df is None else set( df.index ) )
+        for table in self.childtables:
+            old = self._child( table )
+            keep = old[ ~old['source_id'].isin( dropids ) ]
+            self._children[table] = ( keep if children is None
+                                      else pandas.concat( [ keep, children[table] ], ignore_index=True ) )
+        keep = self._df[ ~self._df.index.isin( dropids ) ]
+        self._df = keep if df is None else pandas.concat( [ keep, df ] )
+
+    def generate_df( self, regen=False, sync=False, telemetry=None ):
+        """Load (or regenerate, or update) the df property.
+
+        regen — if True, (or if the cache can't be read) pull everything
+                from SkyPortal and rewrite the cache.
+        sync — if True, read the cache, and then only pull from
+               SkyPortal the sources created or modified since the
+               newest one in the cache.  These replace or are added to
+               the cached sources.  Then, get the ids of every source in
+               the group (fetch_source_ids); cached sources that aren't
+               there any more are dropped, and sources that were added to
+               the group without being modified are fetched by id.
+        telemetry — a Telemetry object to report progress to; by default,
+                    one is made that shows a progress line on stderr.
+
+        If neither regen nor sync is True, just read the cache.
+
+        """
+        meta = None
         if not regen:
             try:
-                self.logger.info( "Reading skyportalcache.pkl" )
-                self._df = pandas.read_pickle( "skyportalcache.pkl" )
+                self.logger.info( f"Reading {self.cachefile}" )
+                meta = self._read_cache()
             except Exception as e:
-                self.logger.warning( "Failed to read skyportalcache.pkl, regenerating." )
+                self.logger.warning( f"Failed to read {self.cachefile}, regenerating." )
                 regen = True
 
-        if regen:
-            querysleep = 0.01
-            totnumsrc = 999999999
-            sources = []
-            data = { 'group_ids': [self.mosthosts_group_id],
-                     'includeSpectrumExists': True,
-                     'numPerPage': 100,
-                     'pageNumber': 1
-            }
-            while len(sources) < totnumsrc:
-                info = self.sp_req_data( 'GET', f'{self._spapi}/sources', params=data )
-                totnumsrc = info['totalMatches']
-                data['pageNumber'] += 1
-                sources.extend( info['sources'] )
-                sys.stderr.write( f'Read {len(sources)} of {totnumsrc} sources from SkyPortal\n' )
-                time.sleep(querysleep)
-
-            self._df = pandas.DataFrame( sources )
-            self._df.set_index( 'id', inplace=True )
-            self._df.to_pickle( "skyportalcache.pkl" )
+        if ( not regen ) and ( not sync ):
+            return
+
+        owntelemetry = telemetry is None
+        if owntelemetry:
+            telemetry = Telemetry( 'skyportal sources', counter='sources', interval=1., progress=True,
+                                   logger=self.logger ).start()
+        try:
+            if regen or ( meta['highwater'] is None ):
+                self._df, self._children = self._fetch_sources( telemetry )
+                self.logger.info( f'Read {len(self._df)} sources from SkyPortal' )
+
+            else:
+                changed, changedchildren = self._fetch_sources( telemetry,
+                                                                createdOrModifiedAfter=meta['highwater'] )
+                self.logger.info( f'{len(changed)} sources created or modified since {meta["highwater"]}' )
+                if len( changed ) > 0:
+                    self._replace_sources( changed, changedchildren )
+
+                ids = self.fetch_source_ids()
+                removed = set( self._df.index ) - ids
+                added = ids - set( self._df.index )
+                self.logger.info( f"{len(removed)} sources removed from and {len(added)} unmodified sources "
+                                  f"added to the group" )
+                if len( added ) > 0:
+                    new, newchildren = self._fetch_sources_by_id( added )
+                    self._replace_sources( new, newchildren, dropids=removed )
+                elif len( removed ) > 0:
+                    self._replace_sources( None, None, dropids=removed )
+        finally:
+            if owntelemetry:
+                telemetry.stop()
+
+        self._write_cache( self._highwater( self._df ) )
 
     def get_spectrum_info( self ):
         """Pull down info about all spectra in the mosthosts group.
@@ -209,11 +633,14 @@ class MostHostsSkyPortal:
         assignment_id — internal id from skyportal
         altdata — ?
         original_file_filename — None (given how I uploaded the spectra)
+
+        Uses fetch_pages(), so if the server pages api/spectra, the
+        pages are fetched concurrently.
         """
         data = { 'groupIDs': [self.mosthosts_group_id],
                  'minimalPayload': True
         }
-        info = self.sp_req_data( 'GET', f'{self._spapi}/spectra', params=data )
+        info = self.fetch_pages( f'{self._spapi}/spectra', data, 'spectra', numperpage=500 )
         return( pandas.DataFrame( info ) )
             
     def get_instrument_id( self, name ):
@@ -3,14 +3,12 @@
 
 import sys
 import logging
-import re
-import requests
-import json
-import time
+import argparse
 # import html2text
 import pandas
 from mosthosts_desi import MostHostsDesi
 from mosthosts_skyportal import MostHostsSkyPortal
+from mosthosts_reconcile import reconcile
 
 logger = logging.getLogger( "main" )
 logerr = logging.StreamHandler( sys.stderr )
@@ -21,33 +19,39 @@ logger.setLevel( logging.INFO )
 def main():
     global logger
 
-    regenerate = True
+    parser = argparse.ArgumentParser( description="Compare the MostHosts table with the SkyPortal MostHosts group" )
+    parser.add_argument( "--regen", default=False, action="store_true",
+                         help="Reread everything from SkyPortal (default: use skyportalcache.parquet)" )
+    parser.add_argument( "--sync", default=False, action="store_true",
+                         help="Update skyportalcache.parquet with sources that have changed on SkyPortal" )
+    parser.add_argument( "-o", "--outprefix", default=None,
+                         help="If given, write each part of the report to {outprefix}_{part}.csv" )
+    args = parser.parse_args()
+
     with open( '/global/homes/r/raknop/secrets/skyportal_token' ) as ifp:
         token = ifp.readline().strip()
     mhsp = MostHostsSkyPortal( token=token )
-    mhsp.generate_df( regen=regenerate )
+    mhsp.generate_df( regen=args.regen, sync=args.sync )
     mhd = MostHostsDesi( dbuserpwfile='/global/homes/r/raknop/secrets/decatdb_desi_desi' )
 
-    # Find sources that are in skyportal more than once
-    grp = mhsp.df['ra'].groupby('id').aggregate('count')
-    repeats = grp[ grp>1 ].index.values
-    print( f'Sources that repeat in SkyPortal: {repeats}' )
-    
-    # Find mismatches
     print( f'Length of mosthosts table: {len(mhd.df)}' )
     print( f'Unique SNe in mosthosts table: {len(mhd.df.index.unique(level=0))}' )
     print( f'Number of sources in skyportal: {len(mhsp.df)}' )
-    
-    sourceids = mhsp.df.index.unique().values
-    tmp = pandas.Series( mhd.df.index.unique(level=0) )
-    missing = tmp[ tmp.apply( lambda x: x not in sourceids ) ].unique()
-    print( f'Sources missing from skyportal: {missing}' )
-
-    spnames = mhd.df.index.unique(level=0).values
-    tmp = pandas.Series( sourceids )
-    missing = tmp[ tmp.apply( lambda x: x not in spnames ) ].unique()
-    print( f'Sources in skyportal but not in mosthosts table: {missing}' )
-    
+
+    report = reconcile( mhd.mosthosts, mhsp.df, logger=logger )
+
+    with pandas.option_context( 'display.max_rows', 200, 'display.width', 200 ):
+        print( f'Sources that repeat in SkyPortal:\n{report["skyportal_repeats"]}' )
+        print( f'Names shared by more than one MostHosts SN:\n{report["shared_names"]}' )
+        print( f'Sources missing from skyportal: {report["missing_from_skyportal"]["sn_name_sp"].values}' )
+        print( f'Sources only on skyportal under another name:\n{report["alias_only"]}' )
+        print( f'Sources in skyportal but not in mosthosts table: '
+               f'{report["missing_from_mosthosts"]["obj_id"].values}' )
+
+    if args.outprefix is not None:
+        for part, df in report.items():
+            df.to_csv( f'{args.outprefix}_{part}.csv', index=False )
+
 # ======================================================================
 
 if __name__ == "__main__":
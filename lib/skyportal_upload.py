@@ -0,0 +1,385 @@
+import sys
+import json
+import time
+import queue
+import pathlib
+import logging
+import sqlite3
+import threading
+
+import numpy
+
+_libdir = str( pathlib.Path( __file__ ).parent )
+if _libdir not in sys.path:
+    sys.path.insert( 0, _libdir )
+
+from mosthosts_skyportal import SpExc
+
+_logger = logging.getLogger( "skyportal_upload" )
+if not _logger.hasHandlers():
+    _logout = logging.StreamHandler( sys.stderr )
+    _logger.addHandler( _logout )
+    _logout.setFormatter( logging.Formatter( f'[%(asctime)s - %(levelname)s] - %(message)s' ) )
+_logger.setLevel( logging.INFO )
+
+# ======================================================================
+
+class SpectrumPayloadBuilder:
+    """Encode SkyPortal api/spectra POST bodies straight from numpy arrays.
+
+    The arrays are written with a fixed number of significant digits
+    (sigfigs, a dict of array name → digits) rather than the 17 digits
+    you get from json.dumps on a list of floats; non-finite values
+    become null.  The formatting is done by numpy.char.mod on whole
+    arrays, so there are never Python float lists.  build_batch() does a
+    whole batch of spectra (e.g. everything from one coadd file) at
+    once, and a wavelength array shared by the batch is only formatted
+    once.
+
+    The result is JSON as bytes, to pass to MostHostsSkyPortal.sp_req
+    as body (which will gzip it if the MostHostsSkyPortal was made with
+    gzip=True).
+
+    """
+
+    default_sigfigs = { 'wavelengths': 8, 'fluxes': 6, 'errors': 4 }
+
+    def __init__( self, sigfigs=None ):
+        self.sigfigs = dict( self.default_sigfigs )
+        if sigfigs is not None:
+            self.sigfigs.update( sigfigs )
+
+    def format_array( self, arr, name ):
+        """Return arr (1d or 2d) formatted as JSON arrays, one string per row."""
+        arr = numpy.atleast_2d( numpy.asarray( arr, dtype=numpy.float64 ) )
+        strs = numpy.char.mod( f'%.{self.sigfigs[name]}g', arr )
+        strs = numpy.where( numpy.isfinite( arr ), strs, 'null' )
+        return [ '[' + ','.join( row ) + ']' for row in strs.tolist() ]
+
+    def build_batch( self, metas, wavelengths, fluxes, errors ):
+        """Build the bodies for a batch of spectra.
+
+        metas — list of dicts with everything in the body except the
+                arrays (obj_id, label, instrument_id, etc.)
+        wavelengths — a 1d array shared by all spectra, or a 2d array
+                      with one row per spectrum
+        fluxes, errors — 2d arrays with one row per spectrum
+
+        Returns a list of bytes, one for each element of metas.
+
+        """
+        n = len( metas )
+        wavestrs = self.format_array( wavelengths, 'wavelengths' )
+        if len( wavestrs ) == 1:
+            wavestrs = wavestrs * n
+        fluxstrs = self.format_array( fluxes, 'fluxes' )
+        errstrs = self.format_array( errors, 'errors' )
+        if not ( len( wavestrs ) == len( fluxstrs ) == len( errstrs ) == n ):
+            raise ValueError( f'Batch of {n} spectra needs that many rows of wavelengths, fluxes, and errors' )
+        bodies = []
+        for meta, wave, flux, err in zip( metas, wavestrs, fluxstrs, errstrs ):
+            head = json.dumps( meta )[:-1]
+            sep = ', ' if len( meta ) > 0 else ''
+            bodies.append( f'{head}{sep}"wavelengths": {wave}, "fluxes": {flux}, "errors": {err}}}'
+                           .encode( 'utf-8' ) )
+        return bodies
+
+    def build( self, meta, wavelengths, fluxes, errors ):
+        """Build the body for one spectrum; see build_batch."""
+        return self.build_batch( [ meta ], wavelengths, numpy.atleast_2d( fluxes ), numpy.atleast_2d( errors ) )[0]
+
+# ======================================================================
+
+class UploadLedger:
+    """A persistent record of spectrum uploads to SkyPortal.
+
+    Backed by a SQLite file with one table, uploads, that has one row
+    per (spname, host, night) — the things that identify a spectrum on
+    SkyPortal, since that's what goes into the label.  night is a
+    yyyy-mm-dd string.  Other columns are targetid, tileid, petal,
+    label, status ('uploaded' or 'failed'), attempts, http_status,
+    message, and updated_at.
+
+    An upload is recorded as 'uploaded' as soon as SkyPortal accepts it,
+    so if a run dies partway through, a restart skips everything that
+    got there even if SkyPortal's spectrum listing hasn't caught up.
+
+    Safe to use from several threads in one process.
+
+    """
+
+    _cols = [ 'spname', 'host', 'night', 'targetid', 'tileid', 'petal', 'label', 'status', 'attempts',
+              'http_status', 'message', 'updated_at' ]
+
+    def __init__( self, path, logger=None ):
+        self.path = pathlib.Path( path )
+        self.logger = _logger if logger is None else logger
+        self.path.parent.mkdir( exist_ok=True, parents=True )
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect( self.path, check_same_thread=False )
+        self._conn.execute( "PRAGMA journal_mode=WAL" )
+        self._conn.execute( "CREATE TABLE IF NOT EXISTS uploads( spname TEXT NOT NULL, host INTEGER NOT NULL, "
+                            "night TEXT NOT NULL, targetid INTEGER, tileid INTEGER, petal INTEGER, label TEXT, "
+                            "status TEXT NOT NULL, attempts INTEGER, http_status INTEGER, message TEXT, "
+                            "updated_at REAL, PRIMARY KEY(spname, host, night) )" )
+        self._conn.commit()
+        cols = [ row[1] for row in self._conn.execute( "PRAGMA table_info(uploads)" ).fetchall() ]
+        if set( cols ) != set( self._cols ):
+            raise RuntimeError( f"{self.path} was written by an incompatible version of the uploader; "
+                                f"move it out of the way" )
+
+    def close( self ):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc_val, exc_tb ):
+        self.close()
+
+    def record( self, job, status, attempts, http_status=None, message=None ):
+        """Record the result of an upload.
+
+        job — an UploadJob
+        status — 'uploaded' or 'failed'
+        attempts — number of times it was tried
+        http_status — the last HTTP status from SkyPortal, if any
+        message — error message, if any
+
+        """
+        with self._lock, self._conn:
+            self._conn.execute( f"INSERT OR REPLACE INTO uploads({','.join(self._cols)}) "
+                                f"VALUES ({','.join( ['?'] * len(self._cols) )})",
+                                ( job.spname, int(job.host), job.night, job.targetid, job.tileid, job.petal,
+                                  job.label, status, attempts, http_status, message, time.time() ) )
+
+    def uploaded( self ):
+        """Return a set of (spname, host, night) for everything that's been uploaded."""
+        with self._lock:
+            cursor = self._conn.execute( "SELECT spname, host, night FROM uploads WHERE status='uploaded'" )
+            return set( tuple(row) for row in cursor.fetchall() )
+
+    def summary( self ):
+        """Return a dict of status → number of uploads."""
+        with self._lock:
+            cursor = self._conn.execute( "SELECT status, COUNT(*) FROM uploads GROUP BY status" )
+            return { row[0]: row[1] for row in cursor.fetchall() }
+
+# ======================================================================
+
+class UploadJob:
+    """One spectrum to upload.
+
+    spname, host, night (yyyy-mm-dd) — identify the spectrum; see UploadLedger
+    targetid, tileid, petal — where it came from in DESI (only recorded in the ledger)
+    label — the label the spectrum has on SkyPortal
+    payload — the body of the POST to api/spectra (a dict, or JSON bytes from SpectrumPayloadBuilder)
+
+    """
+
+    __slots__ = [ 'spname', 'host', 'night', 'targetid', 'tileid', 'petal', 'label', 'payload' ]
+
+    def __init__( self, spname, host, night, label, payload, targetid=None, tileid=None, petal=None ):
+        self.spname = spname
+        self.host = host
+        self.night = night
+        self.label = label
+        self.payload = payload
+        self.targetid = None if targetid is None else int( targetid )
+        self.tileid = None if tileid is None else int( tileid )
+        self.petal = None if petal is None else int( petal )
+
+    @property
+    def key( self ):
+        return ( self.spname, int(self.host), self.night )
+
+# ======================================================================
+
+class AdaptiveConcurrency:
+    """Additive-increase, multiplicative-decrease limit on the number of requests in flight.
+
+    Call acquire() before a request, and release(throttled) after.  The
+    limit starts at initial; it goes up by one after limit successful
+    requests in a row, and is halved (but not below minimum) when the
+    server says to slow down.
+
+    """
+
+    def __init__( self, initial=2, minimum=1, maximum=16 ):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = max( minimum, min( initial, maximum ) )
+        self._inflight = 0
+        self._successes = 0
+        self._cond = threading.Condition()
+
+    def acquire( self ):
+        with self._cond:
+            while self._inflight >= self.limit:
+                self._cond.wait()
+            self._inflight += 1
+
+    def release( self, throttled=False ):
+        with self._cond:
+            self._inflight -= 1
+            if throttled:
+                self.limit = max( self.minimum, self.limit // 2 )
+                self._successes = 0
+            else:
+                self._successes += 1
+                if ( self._successes >= self.limit ) and ( self.limit < self.maximum ):
+                    self.limit += 1
+                    self._successes = 0
+            self._cond.notify_all()
+
+# ======================================================================
+
+class UploadExecutor:
+    """Upload spectra to SkyPortal from a pool of threads.
+
+    Give it an iterable of UploadJobs (typically a generator that reads
+    the spectra and builds the payloads as it goes).  run() iterates
+    that in a producer thread, which feeds a bounded queue, so reading
+    spectra overlaps with uploading them; nthreads uploader threads
+    take jobs off the queue and POST them to api/spectra.
+
+    The rate of requests is limited by the MostHostsSkyPortal object's
+    RateLimiter.  The number of requests in flight is limited by an
+    AdaptiveConcurrency, which backs off when SkyPortal returns 429 or
+    503.  Those two statuses mean the request wasn't processed, so the
+    job is retried (after an exponential backoff) up to retries times.
+    Any other error is recorded as a failure and not retried here,
+    since a POST that got, e.g., a 502 may have gone through; the next
+    run's upload plan (which comes from what's actually on SkyPortal)
+    will pick it up if it didn't.
+
+    Every result goes into the UploadLedger, and jobs whose key is
+    already recorded as uploaded there are skipped, so reruns are
+    idempotent.
+
+    """
+
+    throttle_statuses = { 429, 503 }
+
+    def __init__( self, mhsp, ledger, nthreads=8, initial_concurrency=2, retries=5, backoff=2., queuesize=None,
+                  dryrun=False, telemetry=None, logger=None ):
+        """Make an executor.
+
+        mhsp — the MostHostsSkyPortal object to upload through
+        ledger — an UploadLedger
+        nthreads — number of uploader threads (the maximum concurrency)
+        initial_concurrency — number of requests in flight to start with
+        retries — times to retry a throttled upload
+        backoff — a throttled upload waits backoff×2ⁿ⁻¹ seconds before retry n
+        queuesize — number of built payloads to hold ready (default: 2×nthreads)
+        dryrun — if True, build everything but don't upload
+        telemetry — optional Telemetry; the main counter is incremented
+                    for each job finished, plus counters uploaded,
+                    failed, throttled, skipped, and would_upload
+        logger — a logging.Logger
+
+        """
+        self.mhsp = mhsp
+        self.ledger = ledger
+        self.nthreads = nthreads
+        self.retries = retries
+        self.backoff = backoff
+        self.dryrun = dryrun
+        self.telemetry = telemetry
+        self.logger = _logger if logger is None else logger
+        self.concurrency = AdaptiveConcurrency( initial=initial_concurrency, maximum=nthreads )
+        self._queue = queue.Queue( maxsize=2*nthreads if queuesize is None else queuesize )
+        self._counts = { 'uploaded': 0, 'failed': 0, 'throttled': 0, 'skipped': 0, 'would_upload': 0 }
+        self._countlock = threading.Lock()
+
+    def _count( self, what, finished=True ):
+        with self._countlock:
+            self._counts[what] += 1
+        if self.telemetry is not None:
+            self.telemetry.increment( what )
+            if finished:
+                self.telemetry.increment()
+
+    def _produce( self, jobs ):
+        done = self.ledger.uploaded()
+        try:
+            for job in jobs:
+                if job is None:
+                    continue
+                if job.key in done:
+                    self.logger.debug( f'{job.spname} host {job.host} night {job.night} is in the ledger, skipping' )
+                    self._count( 'skipped' )
+                    continue
+                self._queue.put( job )
+        except Exception as ex:
+            self.logger.exception( f'Error producing upload jobs; stopping: {ex}' )
+        finally:
+            for i in range( self.nthreads ):
+                self._queue.put( None )
+
+    def _upload( self, job ):
+        url = f'{self.mhsp.apiurl}/spectra'
+        attempts = 0
+        while True:
+            attempts += 1
+            self.concurrency.acquire()
+            try:
+                if isinstance( job.payload, bytes ):
+                    self.mhsp.sp_req( 'POST', url, body=job.payload )
+                else:
+                    self.mhsp.sp_req( 'POST', url, data=job.payload )
+            except SpExc as ex:
+                throttled = ex.status in self.throttle_statuses
+                self.concurrency.release( throttled=throttled )
+                if throttled and ( attempts <= self.retries ):
+                    self._count( 'throttled', finished=False )
+                    wait = self.backoff * 2**(attempts-1)
+                    self.logger.warning( f'SkyPortal throttled {job.label} for {job.spname} (status {ex.status}); '
+                                         f'concurrency now {self.concurrency.limit}, retrying in {wait:.0f} s' )
+                    time.sleep( wait )
+                    continue
+                self.logger.error( f'Failed to upload {job.label} for {job.spname}: {ex}' )
+                self.ledger.record( job, 'failed', attempts, http_status=ex.status, message=str(ex) )
+                self._count( 'failed' )
+                return
+            except Exception as ex:
+                self.concurrency.release()
+                self.logger.error( f'Failed to upload {job.label} for {job.spname}: {ex}' )
+                self.ledger.record( job, 'failed', attempts, message=str(ex) )
+                self._count( 'failed' )
+                return
+            self.concurrency.release()
+            self.ledger.record( job, 'uploaded', attempts, http_status=200 )
+            self._count( 'uploaded' )
+            return
+
+    def _consume( self, worker ):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            if self.telemetry is not None:
+                self.telemetry.heartbeat( worker, f'{job.spname} {job.label}' )
+            if self.dryrun:
+                self.logger.info( f'Would upload {job.spname} {job.label} (target {job.targetid})' )
+                self._count( 'would_upload' )
+                continue
+            self._upload( job )
+        if self.telemetry is not None:
+            self.telemetry.finished( worker )
+
+    def run( self, jobs ):
+        """Upload all the UploadJobs in jobs; returns a dict of counts (uploaded, failed, throttled, skipped)."""
+        producer = threading.Thread( target=self._produce, args=( jobs, ), name='upload producer', daemon=True )
+        consumers = [ threading.Thread( target=self._consume, args=( f'uploader {i}', ),
+                                        name=f'uploader {i}', daemon=True )
+                      for i in range( self.nthreads ) ]
+        producer.start()
+        for thread in consumers:
+            thread.start()
+        producer.join()
+        for thread in consumers:
+            thread.join()
+        return dict( self._counts )
@@ -0,0 +1,291 @@
+import os
+import sys
+import json
+import time
+import queue
+import pathlib
+import logging
+import datetime
+import threading
+import collections
+import multiprocessing
+
+_logger = logging.getLogger( "telemetry" )
+if not _logger.hasHandlers():
+    _logout = logging.StreamHandler( sys.stderr )
+    _logger.addHandler( _logout )
+    _logout.setFormatter( logging.Formatter( f'[%(asctime)s - %(levelname)s] - %(message)s' ) )
+_logger.setLevel( logging.INFO )
+
+# ======================================================================
+
+class TelemetryReporter:
+    """The worker side of a Telemetry object.
+
+    Get one of these from Telemetry.reporter() and pass it to a worker
+    process (as an argument to multiprocessing.Process).  It only holds
+    the queue and the worker's name, so it's cheap to pickle.  Nothing
+    it does blocks; if the queue is somehow full, the update is dropped.
+
+    """
+
+    def __init__( self, eventqueue, worker ):
+        self._queue = eventqueue
+        self.worker = worker
+
+    def _put( self, event ):
+        try:
+            self._queue.put_nowait( event )
+        except queue.Full:
+            pass
+
+    def heartbeat( self, message=None ):
+        """Say that this worker is alive; message (optional) is what it's doing now."""
+        self._put( ( 'heartbeat', self.worker, message, 0, time.time() ) )
+
+    def increment( self, counter, n=1 ):
+        """Add n to counter.  (Also counts as a heartbeat.)"""
+        self._put( ( 'increment', self.worker, counter, n, time.time() ) )
+
+    def finished( self ):
+        """Say that this worker is exiting, so it shouldn't be reported as stalled."""
+        self._put( ( 'finished', self.worker, 'finished', 0, time.time() ) )
+
+# ======================================================================
+
+class Telemetry:
+    """Counters, rates, per-worker heartbeats, and ETA for long batch jobs.
+
+    Make one of these in the coordinating process and call start().
+    Then:
+
+      * In the same process (from any thread), call increment(),
+        heartbeat(), and set_total() directly.
+
+      * For worker processes, call reporter(workername) and pass the
+        resultant TelemetryReporter to the worker; the worker calls its
+        increment() and heartbeat() methods, which send events back
+        through a multiprocessing queue.
+
+    A background thread in the coordinating process drains the queue,
+    and every interval seconds writes a JSON status file (if statusfile
+    was given) and redraws a one-line progress display on stderr (if
+    progress is True).  The status file is replaced atomically, so it's
+    safe to cat or poll from another shell.  It includes every counter
+    with its overall and recent (last window seconds) rate, the ETA for
+    the main counter (if a total was given), and the time since each
+    worker was last heard from.  A worker not heard from in stalltime
+    seconds (that hasn't said it's finished) is marked as stalled, and a
+    warning is logged.
+
+    Call stop() (or use the object as a context manager) at the end to
+    write the final status.
+
+    """
+
+    def __init__( self, name, counter='done', total=None, statusfile=None, interval=10., progress=False,
+                  stalltime=300., window=60., logger=None ):
+        """Create a Telemetry.
+
+        name — name of the job, shown in the status
+        counter — the main counter; rate and ETA are based on this one
+        total — the number of counter things to be done, if known (see also set_total())
+        statusfile — path of JSON status file to write (default: don't write one)
+        interval — seconds between status updates
+        progress — if True, draw a progress line on stderr
+        stalltime — workers not heard from in this many seconds are considered stalled
+        window — seconds over which the "recent" rates are calculated
+        logger — a logging.Logger
+
+        """
+        self.name = name
+        self.counter = counter
+        self.total = total
+        self.statusfile = None if statusfile is None else pathlib.Path( statusfile )
+        self.interval = interval
+        self.progress = progress
+        self.stalltime = stalltime
+        self.window = window
+        self.logger = _logger if logger is None else logger
+
+        self._queue = multiprocessing.Queue()
+        self._lock = threading.RLock()
+        self._counters = collections.defaultdict( int )
+        self._history = collections.deque()
+        self._workers = {}
+        self._stallwarned = set()
+        self._t0 = time.time()
+        self._thread = None
+        self._stopevent = threading.Event()
+
+    # ----------------------------------------
+
+    def reporter( self, worker ):
+        """Return a TelemetryReporter for a worker process named worker."""
+        return TelemetryReporter( self._queue, worker )
+
+    def set_total( self, total ):
+        with self._lock:
+            self.total = total
+
+    def increment( self, counter=None, n=1, worker=None ):
+        counter = self.counter if counter is None else counter
+        with self._lock:
+            self._counters[counter] += n
+            if worker is not None:
+                self._beat( worker, None, time.time() )
+
+    def heartbeat( self, worker, message=None ):
+        with self._lock:
+            self._beat( worker, message, time.time() )
+
+    def finished( self, worker ):
+        with self._lock:
+            self._beat( worker, 'finished', time.time(), finished=True )
+
+    def count( self, counter=None ):
+        counter = self.counter if counter is None else counter
+        with self._lock:
+            return self._counters[counter]
+
+    def _beat( self, worker, message, t, finished=False ):
+        if worker not in self._workers:
+            self._workers[worker] = { 'first_seen': t, 'message': None, 'events': 0, 'finished': False }
+        self._workers[worker]['last_seen'] = t
+        self._workers[worker]['finished'] = finished
+        self._workers[worker]['events'] += 1
+        if message is not None:
+            self._workers[worker]['message'] = message
+        self._stallwarned.discard( worker )
+
+    # ----------------------------------------
+
+    def drain( self ):
+        """Process everything workers have sent so far.  (The background thread does this for you.)"""
+        while True:
+            try:
+                kind, worker, what, n, t = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            with self._lock:
+                if kind == 'increment':
+                    self._counters[what] += n
+                    self._beat( worker, None, t )
+                else:
+                    self._beat( worker, what, t, finished=( kind == 'finished' ) )
+
+    def status( self ):
+        """Return a dict with the current state of everything."""
+        now = time.time()
+        with self._lock:
+            elapsed = now - self._t0
+            self._history.append( ( now, dict( self._counters ) ) )
+            while ( len( self._history ) > 2 ) and ( now - self._history[1][0] >= self.window ):
+                self._history.popleft()
+            then, thencounts = self._history[0]
+
+            rates = {}
+            for counter, val in self._counters.items():
+                recent = None
+                if now > then:
+                    recent = ( val - thencounts.get( counter, 0 ) ) / ( now - then )
+                rates[counter] = { 'overall': val / elapsed if elapsed > 0 else None, 'recent': recent }
+
+            done = self._counters[self.counter]
+            eta = None
+            if ( self.total is not None ) and ( done > 0 ):
+                rate = rates[self.counter]['recent']
+                if ( rate is None ) or ( rate <= 0 ):
+                    rate = rates[self.counter]['overall']
+                if ( rate is not None ) and ( rate > 0 ):
+                    eta = max( self.total - done, 0 ) / rate
+
+            workers = {}
+            for worker, info in self._workers.items():
+                age = now - info['last_seen']
+                stalled = ( not info['finished'] ) and ( age > self.stalltime )
+                if stalled and ( worker not in self._stallwarned ):
+                    self.logger.warning( f"{self.name}: worker {worker} not heard from in {age:.0f} s "
+                                         f"(last: {info['message']})" )
+                    self._stallwarned.add( worker )
+                workers[worker] = { 'last_seen': datetime.datetime.fromtimestamp( info['last_seen'] ).isoformat(),
+                                    'seconds_since_heard': age,
+                                    'events': info['events'],
+                                    'message': info['message'],
+                                    'finished': info['finished'],
+                                    'stalled': stalled }
+
+            return { 'name': self.name,
+                     'pid': os.getpid(),
+                     'started': datetime.datetime.fromtimestamp( self._t0 ).isoformat(),
+                     'updated': datetime.datetime.fromtimestamp( now ).isoformat(),
+                     'elapsed': elapsed,
+                     'counter': self.counter,
+                     'total': self.total,
+                     'counters': dict( self._counters ),
+                     'rates': rates,
+                     'eta_seconds': eta,
+                     'workers': workers,
+                     'nstalled': sum( 1 for w in workers.values() if w['stalled'] ),
+                     'finished': self._stopevent.is_set() }
+
+    def _write_status( self, status ):
+        if self.statusfile is not None:
+            tmpfile = self.statusfile.parent / f".{self.statusfile.name}.{os.getpid()}.tmp"
+            with open( tmpfile, "w" ) as ofp:
+                json.dump( status, ofp, indent=2 )
+            os.replace( tmpfile, self.statusfile )
+
+        if self.progress:
+            done = status['counters'].get( self.counter, 0 )
+            line = f"{self.name}: {self.counter} {done}"
+            if self.total is not None:
+                line += f"/{self.total}"
+                if self.total > 0:
+                    line += f" ({100. * done / self.total:.1f}%)"
+            rate = status['rates'].get( self.counter, {} ).get( 'recent', None )
+            if rate is not None:
+                line += f" {rate:.2f}/s"
+            if status['eta_seconds'] is not None:
+                line += f" ETA {datetime.timedelta( seconds=int( status['eta_seconds'] ) )}"
+            if len( status['workers'] ) > 0:
+                line += f" | {len(status['workers'])} workers"
+                if status['nstalled'] > 0:
+                    line += f" ({status['nstalled']} STALLED)"
+            sys.stderr.write( f"\r{line}\033[K" )
+            if status['finished']:
+                sys.stderr.write( "\n" )
+            sys.stderr.flush()
+
+    def update( self ):
+        """Drain the queue and write status now."""
+        self.drain()
+        self._write_status( self.status() )
+
+    # ----------------------------------------
+
+    def _run( self ):
+        while not self._stopevent.wait( self.interval ):
+            try:
+                self.update()
+            except Exception as ex:
+                self.logger.error( f"{self.name}: telemetry update failed: {ex}" )
+
+    def start( self ):
+        if self._thread is None:
+            self._thread = threading.Thread( target=self._run, name=f'telemetry {self.name}', daemon=True )
+            self._thread.start()
+        return self
+
+    def stop( self ):
+        self._stopevent.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.update()
+
+    def __enter__( self ):
+        return self.start()
+
+    def __exit__( self, exc_type, exc_val, exc_tb ):
+        self.stop()
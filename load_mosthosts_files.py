@@ -1,12 +1,21 @@
 import sys
 import os
+import io
 import re
+import csv
+import json
+import argparse
+import datetime
 import pathlib
 import logging
+import concurrent.futures
 import psycopg2
 import psycopg2.extras
 import pandas
 import numpy
+import pyarrow
+import pyarrow.csv
+import pyarrow.compute
 
 _dbcon = None
 _tablename = 'mosthosts';
@@ -21,7 +30,7 @@ columns = {
     "origin": { "type": "text" },
     "sn_type": { "type": "text" },
     "sn_z": { "type": "real" },
-    "sn_ra": { "type": "double precision" },
+    "sn_ra": { "type": "double precision", "q3c": True },
     "sn_dec": { "type": "double precision" },
     "sn_name": { "type": "text", "index": True },
     "sn_name_ptf": { "type": "text", "index": True },
@@ -117,12 +126,11 @@ def dbcon():
         _dbcon = psycopg2.connect( dbname='desidb', host='decatdb.lbl.gov', user='desidb_admin', password=passwd )
     return _dbcon
 
-def create_table():
+def create_table( tablename=_tablename ):
+    """Create static.{tablename} with the columns in columns, but no indexes other than the primary key."""
     conn = dbcon()
     cursor = conn.cursor()
-    indices = []
-    q3c = []
-    q = f"CREATE TABLE static.{_tablename}( ";
+    q = f"CREATE TABLE static.{tablename}( ";
     first = True
     for key, val in columns.items():
         if first:
@@ -132,85 +140,433 @@ def create_table():
         q += f"{key} {val['type']}"
         if 'extra' in val:
             q += f" {val['extra']}"
-        if ( 'index' in val ) and val['index']:
-            indices.append( key )
-        if ( 'q3c' in val ) and val['q3c']:
-            q3c.append( key )
     q += ")"
     cursor.execute( q )
-    for dex in indices:
-        cursor.execute(f'CREATE INDEX ON static.{_tablename} USING btree({dex})' )
+    conn.commit()
+
+def index_names( tablename=_tablename ):
+    """Return a dict of index name → CREATE INDEX statement for the indexes static.{tablename} should have."""
+    indexes = {}
     raparse = re.compile( "^(.*)ra(.*)$" )
-    for racol in q3c:
-        match = raparse.search( racol )
-        if match is None:
-            raise ValueError( f"Can't find 'ra' in {racol} for q3c creation" )
-        deccol = f"{match.group(1)}dec{match.group(2)}"
-        cursor.execute( f'CREATE INDEX ON static.{_tablename} (q3c_ang2ipix({racol},{deccol}))' )
+    for key, val in columns.items():
+        if ( 'index' in val ) and val['index']:
+            indexes[ f"{tablename}_{key}_idx" ] = f"USING btree({key})"
+        if ( 'q3c' in val ) and val['q3c']:
+            match = raparse.search( key )
+            if match is None:
+                raise ValueError( f"Can't find 'ra' in {key} for q3c creation" )
+            deccol = f"{match.group(1)}dec{match.group(2)}"
+            indexes[ f"{tablename}_{key}_q3c_idx" ] = f"(q3c_ang2ipix({key},{deccol}))"
+    return indexes
+
+def create_indexes( tablename=_tablename ):
+    """Build the btree and q3c indexes on static.{tablename}, and ANALYZE it.
+
+    Do this after loading the data, so that rows don't each pay for
+    index maintenance.
+
+    """
+    conn = dbcon()
+    cursor = conn.cursor()
+    for name, spec in index_names( tablename ).items():
+        _logger.info( f"Creating index {name}" )
+        cursor.execute( f'CREATE INDEX {name} ON static.{tablename} {spec}' )
     conn.commit()
-                    
+    _logger.info( f"Analyzing static.{tablename}" )
+    cursor.execute( f'ANALYZE static.{tablename}' )
+    conn.commit()
+
+def swap_in( stagingname, tablename=_tablename ):
+    """Atomically replace static.{tablename} with static.{stagingname}.
+
+    In one transaction: copy the grants from the current table to the
+    staging table, drop the current table, and rename the staging table
+    (and its indexes and primary key) to take its place.  Anybody
+    reading the table sees either the whole old table or the whole new
+    one.
+
+    """
+    conn = dbcon()
+    cursor = conn.cursor()
+    try:
+        cursor.execute( "SELECT grantee, privilege_type FROM information_schema.role_table_grants "
+                        "WHERE table_schema='static' AND table_name=%(t)s AND grantee<>current_user",
+                        { 't': tablename } )
+        for grantee, privilege in cursor.fetchall():
+            cursor.execute( f'GRANT {privilege} ON static.{stagingname} TO "{grantee}"' )
+        cursor.execute( f'DROP TABLE IF EXISTS static.{tablename}' )
+        cursor.execute( f'ALTER TABLE static.{stagingname} RENAME TO {tablename}' )
+        cursor.execute( f'ALTER TABLE static.{tablename} RENAME CONSTRAINT {stagingname}_pkey TO {tablename}_pkey' )
+        for stagingindex, index in zip( index_names( stagingname ).keys(), index_names( tablename ).keys() ):
+            cursor.execute( f'ALTER INDEX static.{stagingindex} RENAME TO {index}' )
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        raise
+    _logger.info( f"static.{stagingname} is now static.{tablename}" )
 
-def read_all_files( direc ):
+# Types that read_all_files parses each column as.  Integer columns
+# are read as strings and cast afterwards (see _read_catalog_file).
+_arrowtypes = { 'text': pyarrow.string(),
+                'uuid': pyarrow.string(),
+                'double precision': pyarrow.float64(),
+                'real': pyarrow.float32(),
+                'bigint': pyarrow.int64(),
+                'int': pyarrow.int32(),
+                'smallint': pyarrow.int16() }
+_pandastypes = { pyarrow.int64(): pandas.Int64Dtype(),
+                 pyarrow.int32(): pandas.Int32Dtype(),
+                 pyarrow.int16(): pandas.Int16Dtype() }
+
+# Column renames from the catalog files to the table (after lowercasing)
+_filerenames = { 'z': 'sn_z', 'type': 'sn_type' }
+
+# Columns of the table that aren't in the catalog files; read_all_files makes them
+_derivedcols = [ 'id', 'hostnum', 'ra', 'dec' ]
+
+def catalog_schema():
+    """Return the pyarrow schema (table column names) of what read_all_files returns from each file."""
+    return pyarrow.schema( [ ( k, _arrowtypes[v['type']] ) for k, v in columns.items()
+                             if k not in _derivedcols ] )
+
+def _cast_int_column( arr, field, path ):
+    """Cast a column of integers read as strings to field.type.
+
+    Trailing ".0"s are stripped.  Values that still aren't plain
+    integers (e.g. "3.902708624346786e+18") go through float64, the way
+    the old reader did everything, with a warning, since that loses
+    precision on 64-bit ids.
+
+    """
+    arr = pyarrow.compute.replace_substring_regex( arr, pattern=r'\.0*$', replacement='' )
+    isint = pyarrow.compute.match_substring_regex( arr, pattern=r'^[+-]?[0-9]+$' )
+    try:
+        nfloat = pyarrow.compute.sum( pyarrow.compute.invert( isint ) ).as_py() or 0
+        if nfloat == 0:
+            return arr.cast( field.type )
+        _logger.warning( f"{path}: {nfloat} values of {field.name} aren't integers; casting them "
+                         f"through float64, which may lose precision" )
+        nulls = pyarrow.nulls( len( arr ), pyarrow.string() )
+        ints = pyarrow.compute.if_else( isint, arr, nulls ).cast( field.type )
+        floats = pyarrow.compute.if_else( isint, nulls, arr ).cast( pyarrow.float64() )
+        return pyarrow.compute.coalesce( ints, floats.cast( field.type ) )
+    except pyarrow.ArrowInvalid as ex:
+        raise ValueError( f"Column {field.name} of {path} isn't all {field.type}: {ex}" )
+
+def _read_catalog_file( path, schema ):
+    """Read one df*.csv file into a pyarrow Table with schema schema.
+
+    Column names are lowercased and renamed (_filerenames) to match the
+    table.  Empty strings, "None", and "nan" are nulls.  Integer columns
+    are parsed as strings and cast by _cast_int_column, since some of
+    the files write ids as floats, and going through a float would lose
+    precision on 64-bit ids.
+
+    Raises ValueError if the file is missing any column of the schema
+    or if a column won't parse as its type.  Columns in the file that
+    aren't in the schema are ignored, with a warning unless they're
+    unnamed (pandas index) columns.
+
+    """
+    with open( path ) as ifp:
+        header = next( csv.reader( ifp ) )
+    filecols = {}
+    for col in header:
+        name = col.lower()
+        filecols[ _filerenames.get( name, name ) ] = col
+
+    missing = [ f.name for f in schema if f.name not in filecols ]
+    if len( missing ) > 0:
+        raise ValueError( f"{path} is missing columns {missing}" )
+    extra = [ c for n, c in filecols.items() if ( n not in schema.names ) and ( c.strip() != '' )
+              and ( c[0:7] != "Unnamed" ) ]
+    if len( extra ) > 0:
+        _logger.warning( f"{path}: ignoring unknown columns {extra}" )
+
+    coltypes = { filecols[f.name]: pyarrow.string() if pyarrow.types.is_integer( f.type ) else f.type
+                 for f in schema }
+    convert = pyarrow.csv.ConvertOptions( column_types=coltypes,
+                                          include_columns=[ filecols[f.name] for f in schema ],
+                                          null_values=[ '', 'None', 'nan', 'NaN' ],
+                                          strings_can_be_null=True )
+    try:
+        table = pyarrow.csv.read_csv( path, convert_options=convert )
+    except pyarrow.ArrowInvalid as ex:
+        raise ValueError( f"Failed to parse {path}: {ex}" )
+
+    arrays = []
+    for f in schema:
+        arr = table.column( filecols[f.name] )
+        if pyarrow.types.is_integer( f.type ):
+            arr = _cast_int_column( arr, f, path )
+        arrays.append( arr )
+    return pyarrow.Table.from_arrays( arrays, schema=schema )
+
+def read_all_files( direc, nthreads=4 ):
+    """Read all the df*.csv MostHosts catalog files in direc into one dataframe.
+
+    Files are read nthreads at a time, each with the types from columns
+    (see catalog_schema and _read_catalog_file).  Nulls stay nulls:
+    NaN in float columns, <NA> in (nullable) integer columns, and None in
+    text columns.
+
+    ra and dec are set from the DR9 position if there is one, otherwise
+    from the SGA position.  hostnum is just the order of the hosts of
+    each SN in the files; upsert renumbers to match the existing table.
+
+    """
     direc = pathlib.Path( direc )
     files = list( direc.glob( 'df*.csv') )
     files.sort()
-    dfs = []
-    typedict = { k: lambda x: None if len(x)==0 else numpy.int64(float(x))
-                 for k in columns.keys() if columns[k]['type'] == 'bigint' }
-    for f in files:
-        _logger.info( f"Reading {f}" )
-        curdf = pandas.read_csv( f, converters=typedict )
-        # Strip out "unnamed" columns,
-        # as there seem to be inconsistencies
-        drops = []
-        for col in curdf.columns:
-            if col[0:7] == "Unnamed":
-                drops.append( col )
-        curdf.drop( columns=drops, inplace=True )
-        dfs.append( curdf )
-
-    df = pandas.concat( dfs, axis='rows' )
-        
+    if len( files ) == 0:
+        raise FileNotFoundError( f"No df*.csv files in {direc}" )
+    schema = catalog_schema()
+    _logger.info( f"Reading {len(files)} files from {direc}" )
+    with concurrent.futures.ThreadPoolExecutor( max_workers=nthreads ) as pool:
+        tables = list( pool.map( lambda f: _read_catalog_file( f, schema ), files ) )
+    table = pyarrow.concat_tables( tables )
+    _logger.info( f"Read {table.num_rows} hosts" )
+
+    df = table.to_pandas( types_mapper=_pandastypes.get )
+
     # Set ra from dr9 if it's there, otherwise sga
+    df['ra'] = df['ra_dr9'].fillna( df['ra_sga'] )
+    df['dec'] = df['dec_dr9'].fillna( df['dec_sga'] )
 
-    df["ra"] = None
-    df["dec"] = None
-    df["hostnum"] = None
-    w = pandas.isnull( df.ra_dr9 )
-    df.loc[~w, 'ra'] = df.loc[~w].ra_dr9
-    df.loc[~w, 'dec'] = df.loc[~w].dec_dr9
-    df.loc[w, 'ra'] = df.loc[w].ra_sga
-    df.loc[w, 'dec'] = df.loc[w].dec_sga
-    
     # Assign host numbers right now without
     # trying to match to old mosthosts
-    # Pandas is so mysterious
-    df.hostnum = df.groupby('sn_name_sp').cumcount().add(1)-1
+    df['hostnum'] = df.groupby( 'sn_name_sp' ).cumcount()
+
+    return df
+
+def load_df( df, tablename=_tablename ):
+    """Stream df into static.{tablename} with COPY FROM STDIN."""
+    _logger.info( f"Loading {len(df)} rows into static.{tablename}" )
+    conn = dbcon()
+    cursor = conn.cursor()
+    cols = [ i for i in columns.keys() if i != 'id' ]
+    buf = io.StringIO()
+    df[ cols ].to_csv( buf, header=False, index=False, na_rep='' )
+    buf.seek( 0 )
+    cursor.copy_expert( f"COPY static.{tablename}({','.join(cols)}) FROM STDIN WITH ( FORMAT csv, NULL '' )",
+                        buf )
+    conn.commit()
+
+def reload_table( df, tablename=_tablename ):
+    """Replace static.{tablename} with the contents of df.
+
+    Loads into a staging table, indexes it, and then swaps it in, so
+    static.{tablename} is never half-loaded.
 
-    # lowercaseize all column names
-    df.rename( { i: i.lower() for i in df.columns }, axis='columns', inplace=True )
+    """
+    stagingname = f"{tablename}_load"
+    conn = dbcon()
+    cursor = conn.cursor()
+    cursor.execute( f'DROP TABLE IF EXISTS static.{stagingname}' )
+    conn.commit()
+    create_table( stagingname )
+    load_df( df, stagingname )
+    create_indexes( stagingname )
+    swap_in( stagingname, tablename )
 
-    # specific renames
-    df.rename( { 'z': 'sn_z', 'type': 'sn_type' }, axis='columns', inplace=True )
-    df.replace( { numpy.nan: None }, inplace=True )
-    df.replace( { 'None': None }, inplace=True )
-    
+# ======================================================================
+# Incremental updates
+
+def read_table( tablename=_tablename ):
+    """Return the current contents of static.{tablename} as a dataframe."""
+    conn = dbcon()
+    cursor = conn.cursor( cursor_factory=psycopg2.extras.RealDictCursor )
+    cursor.execute( f"SELECT * FROM static.{tablename}" )
+    df = pandas.DataFrame( cursor.fetchall(), columns=list( columns.keys() ) )
+    cursor.close()
     return df
 
-def load_df( df ):
-    _logger.info( f"Loading {len(df)} rows into table" )
+def _angsep( ra0, dec0, ra1, dec1 ):
+    """Angular separation in degrees (haversine), vectorized."""
+    ra0, dec0, ra1, dec1 = ( numpy.radians( numpy.asarray( x, dtype=float ) ) for x in ( ra0, dec0, ra1, dec1 ) )
+    a = ( numpy.sin( ( dec1 - dec0 ) / 2. )**2
+          + numpy.cos( dec0 ) * numpy.cos( dec1 ) * numpy.sin( ( ra1 - ra0 ) / 2. )**2 )
+    return numpy.degrees( 2. * numpy.arcsin( numpy.sqrt( numpy.clip( a, 0., 1. ) ) ) )
+
+def _differs( new, old ):
+    """Return a boolean Series: does any column of new differ from the same column of old?
+
+    new and old are aligned dataframes with the same columns.  Nulls
+    compare equal to nulls.  real columns are compared as float32, since
+    that's all the database keeps.
+
+    """
+    diff = pandas.Series( False, index=new.index )
+    for col in new.columns:
+        ctype = columns[col]['type']
+        if ctype in ( 'real', 'double precision' ):
+            dtype = numpy.float32 if ctype == 'real' else numpy.float64
+            a = pandas.to_numeric( new[col], errors='coerce' ).astype( dtype )
+            b = pandas.to_numeric( old[col], errors='coerce' ).astype( dtype )
+        elif ctype in ( 'bigint', 'int', 'smallint' ):
+            a = pandas.to_numeric( new[col], errors='coerce' ).astype( 'Int64' )
+            b = pandas.to_numeric( old[col], errors='coerce' ).astype( 'Int64' )
+        else:
+            a = new[col].astype( 'string' )
+            b = old[col].astype( 'string' )
+        bothnull = a.isna() & b.isna()
+        eq = ( a == b ).fillna( False ).astype( bool )
+        diff |= ~( eq | bothnull )
+    return diff
+
+def diff_hosts( newdf, olddf, tolerance=1./3600. ):
+    """Figure out what has to change in the mosthosts table to make it match newdf.
+
+    newdf — hosts read from catalog files (read_all_files)
+    olddf — current contents of the table (read_table)
+    tolerance — hosts of the same SN within this many degrees are the same host
+
+    Hosts are keyed by (sn_name_sp, position): a new host is the same
+    as an existing host if it's for the same SN and within tolerance.
+    (If several are, the closest pairs are taken first.)  Existing hosts
+    keep their id and hostnum; hosts that are new for an SN get
+    hostnums after the highest one the SN already has.
+
+    Returns (inserts, updates, deletes): inserts and updates are
+    dataframes with all the columns (updates includes id), deletes is a
+    dataframe with id, sn_name_sp, and hostnum.
+
+    """
+    newdf = newdf.reset_index( drop=True ).copy()
+    newdf['newdex'] = newdf.index
+    olddf = olddf.reset_index( drop=True )
+
+    pairs = newdf[ [ 'newdex', 'sn_name_sp', 'ra', 'dec' ] ].merge(
+        olddf[ [ 'id', 'sn_name_sp', 'hostnum', 'ra', 'dec' ] ], on='sn_name_sp', suffixes=( '', '_old' ) )
+    pairs['sep'] = _angsep( pairs['ra'], pairs['dec'], pairs['ra_old'], pairs['dec_old'] )
+    pairs = pairs[ pairs['sep'] <= tolerance ].sort_values( 'sep' )
+    # Greedy closest-first one-to-one matching
+    matched = []
+    usednew = set()
+    usedold = set()
+    for row in pairs[ [ 'newdex', 'id', 'hostnum' ] ].itertuples( index=False ):
+        if ( row.newdex in usednew ) or ( row.id in usedold ):
+            continue
+        usednew.add( row.newdex )
+        usedold.add( row.id )
+        matched.append( row )
+    matched = pandas.DataFrame( matched, columns=[ 'newdex', 'id', 'hostnum' ] )
+
+    datacols = [ c for c in columns.keys() if c not in ( 'id', 'hostnum' ) ]
+
+    # Updates: matched hosts where anything changed
+    upd = newdf.set_index( 'newdex' ).loc[ matched['newdex'], datacols ]
+    upd['id'] = matched['id'].values
+    upd['hostnum'] = matched['hostnum'].values
+    oldmatched = olddf.set_index( 'id' ).loc[ upd['id'], datacols ]
+    oldmatched.index = upd.index
+    updates = upd[ _differs( upd[datacols], oldmatched ).values ].reset_index( drop=True )
+
+    # Inserts: new hosts that didn't match, numbered after the SN's existing hosts
+    ins = newdf[ ~newdf['newdex'].isin( matched['newdex'] ) ].drop( columns='newdex' ).copy()
+    maxhost = olddf.groupby( 'sn_name_sp' )['hostnum'].max()
+    start = ins['sn_name_sp'].map( maxhost ).fillna( -1 ).astype( int ) + 1
+    ins['hostnum'] = start + ins.groupby( 'sn_name_sp' ).cumcount()
+    inserts = ins.reset_index( drop=True )
+
+    # Deletes: existing hosts that aren't in the new files
+    deletes = olddf.loc[ ~olddf['id'].isin( matched['id'] ), [ 'id', 'sn_name_sp', 'hostnum' ] ]
+    deletes = deletes.reset_index( drop=True )
+
+    return inserts, updates, deletes
+
+def apply_diff( inserts, updates, deletes, tablename=_tablename ):
+    """Apply the output of diff_hosts to static.{tablename} in one transaction."""
     conn = dbcon()
     cursor = conn.cursor()
-    q = f"INSERT INTO static.{_tablename}({','.join( [ i for i in columns.keys() if i != 'id' ] )}) "
-    q += f"VALUES ({','.join( [ f'%({i})s' for i in columns.keys() if i != 'id' ] )})"
-    args = df.where( pandas.notnull(df), None ).to_dict( orient='records' )
-    psycopg2.extras.execute_batch( cursor, q, args )
+    cols = [ i for i in columns.keys() if i != 'id' ]
+    try:
+        if len( deletes ) > 0:
+            cursor.execute( f"DELETE FROM static.{tablename} WHERE id=ANY(%(ids)s::uuid[])",
+                            { 'ids': [ str(i) for i in deletes['id'] ] } )
+        if len( updates ) > 0:
+            cursor.execute( f"CREATE TEMP TABLE {tablename}_updates (LIKE static.{tablename}) ON COMMIT DROP" )
+            buf = io.StringIO()
+            updates[ [ 'id' ] + cols ].to_csv( buf, header=False, index=False, na_rep='' )
+            buf.seek( 0 )
+            cursor.copy_expert( f"COPY {tablename}_updates(id,{','.join(cols)}) FROM STDIN "
+                                f"WITH ( FORMAT csv, NULL '' )", buf )
+            cursor.execute( f"UPDATE static.{tablename} m SET {','.join( f'{c}=u.{c}' for c in cols )} "
+                            f"FROM {tablename}_updates u WHERE m.id=u.id" )
+        if len( inserts ) > 0:
+            buf = io.StringIO()
+            inserts[ cols ].to_csv( buf, header=False, index=False, na_rep='' )
+            buf.seek( 0 )
+            cursor.copy_expert( f"COPY static.{tablename}({','.join(cols)}) FROM STDIN "
+                                f"WITH ( FORMAT csv, NULL '' )", buf )
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        raise
+    cursor.execute( f'ANALYZE static.{tablename}' )
     conn.commit()
 
+def write_changelog( inserts, updates, deletes, path ):
+    """Write a JSON change log of what apply_diff did.
+
+    Has lists of [sn_name_sp, hostnum] for inserted, updated, and
+    deleted, plus sn_names, the sorted list of every SN with any change.
+    MostHostsDesi( changelog=path ) uses sn_names to regenerate only
+    those SNe in its cached dataframes.
+
+    """
+    def keys( df ):
+        return [ [ sn, int(host) ] for sn, host in zip( df['sn_name_sp'], df['hostnum'] ) ]
+    sn_names = sorted( set( inserts['sn_name_sp'] ) | set( updates['sn_name_sp'] ) | set( deletes['sn_name_sp'] ) )
+    changelog = { 'time': datetime.datetime.now( tz=datetime.timezone.utc ).isoformat(),
+                  'table': f'static.{_tablename}',
+                  'inserted': keys( inserts ),
+                  'updated': keys( updates ),
+                  'deleted': keys( deletes ),
+                  'sn_names': sn_names }
+    with open( path, "w" ) as ofp:
+        json.dump( changelog, ofp, indent=2 )
+    _logger.info( f"Wrote change log for {len(sn_names)} SNe to {path}" )
+
+def upsert( df, changelog=None, tolerance=1./3600., dryrun=False ):
+    """Bring static.mosthosts in line with df, changing only the rows that need it."""
+    olddf = read_table()
+    inserts, updates, deletes = diff_hosts( df, olddf, tolerance=tolerance )
+    _logger.info( f"{len(olddf)} hosts in table, {len(df)} in files: {len(inserts)} to insert, "
+                  f"{len(updates)} to update, {len(deletes)} to delete" )
+    if dryrun:
+        return inserts, updates, deletes
+    apply_diff( inserts, updates, deletes )
+    if changelog is not None:
+        write_changelog( inserts, updates, deletes, changelog )
+    return inserts, updates, deletes
+
 def main():
-    create_table()
-    df = read_all_files( 'files_mosthosts_20240222' )
-    load_df( df )
+    parser = argparse.ArgumentParser( description="Load MostHosts catalog files into static.mosthosts" )
+    parser.add_argument( "directory", nargs="?", default="files_mosthosts_20240222",
+                         help="Directory with the df*.csv files (default: files_mosthosts_20240222)" )
+    parser.add_argument( "--upsert", default=False, action="store_true",
+                         help=( "Only insert, update, and delete the hosts that have changed, keeping hostnum "
+                                "for existing hosts (default: replace the whole table)" ) )
+    parser.add_argument( "--changelog", default=None,
+                         help=( "With --upsert, write a JSON change log here (default: "
+                                "mosthosts_changes_<time>.json)" ) )
+    parser.add_argument( "--tolerance", type=float, default=1.,
+                         help="With --upsert, hosts of the same SN this close (arcsec) are the same host (default 1)" )
+    parser.add_argument( "--dry-run", default=False, action="store_true",
+                         help="With --upsert, just report what would change" )
+    parser.add_argument( "-n", "--nthreads", type=int, default=4,
+                         help="Number of catalog files to read at once (default 4)" )
+    args = parser.parse_args()
+
+    df = read_all_files( args.directory, nthreads=args.nthreads )
+    if args.upsert:
+        changelog = args.changelog
+        if changelog is None:
+            changelog = f"mosthosts_changes_{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}.json"
+        upsert( df, changelog=changelog, tolerance=args.tolerance/3600., dryrun=args.dry_run )
+    else:
+        reload_table( df )
 
 if __name__ == "__main__":
     main()
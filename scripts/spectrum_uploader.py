@@ -6,9 +6,7 @@
 
 import sys
 import os
-import pickle
 import re
-import time
 import math
 import argparse
 import datetime
@@ -16,26 +14,28 @@ import logging
 import traceback
 
 import numpy as np
+import pandas
 
 from mosthosts_desi import MostHostsDesi
 from mosthosts_skyportal import MostHostsSkyPortal, SpExc
-from desi_specinfo import SpectrumInfo
+from telemetry import Telemetry
+from desi_specfinder import SpectrumFinder
+from skyportal_upload import UploadLedger, UploadJob, UploadExecutor, SpectrumPayloadBuilder
 
 import desispec
 
-def upload_desi_spectrum( sn_id, index, nhostsforsn, night, spectrum, mhsp, instrument_id=None, logger=logging.getLogger("main") ):
-    """Upload a desispec.spectrum.Spectra to SkyPortal.
+def desi_spectrum_parts( sn_id, index, nhostsforsn, night, spectrum, instrument_id,
+                         logger=logging.getLogger("main") ):
+    """Get what goes into a SkyPortal api/spectra POST for a desispec.spectrum.Spectra.
 
-    sn_id — the id on skyportal of the sn
-    index — the "index" field in Most Hosts for the host this is a spectrum of
-    nhostsforsn — the number of hosts there are for this sn
-    night — either an integer or a string in the format yyyymmdd or yyyy-mm-dd
-    spectrum — a desispec.spectrum.Spectra object.  It should have just a 
-               single spectrum, and a single band 'brz'
-    mhsp — a MostHostsSkyPortal object
-    instrument_id — The instrument_id for DESI on SkyPortal.  (Looks it up on SkyPortal if not supplied.)
-    """
+    Parameters are as for upload_desi_spectrum, except that
+    instrument_id is required.
 
+    Returns (label, meta, wavelengths, fluxes, errors), where meta is a
+    dict of everything in the POST body except the three arrays, or
+    None if the spectrum can't be uploaded.
+
+    """
     try:
         match = re.search( '^(\d\d\d\d)(\d\d)(\d\d)$', str(night) )
         if match is None:
@@ -45,8 +45,6 @@ def upload_desi_spectrum( sn_id, index, nhostsforsn, night, spectrum, mhsp, inst
         nightlabel = f'{match.group(1)}-{match.group(2)}-{match.group(3)}'
         label = f'Host {int(index)} of {int(nhostsforsn)} {nightlabel}'
         obsnight = datetime.datetime( int(match.group(1)), int(match.group(2)), int(match.group(3)) )
-        if instrument_id is None:
-            instrument_id = mhsp.get_instrument_id('DESI')
 
         if ( 'brz' not in spectrum.wave.keys() ) or ( len(spectrum.wave.keys()) != 1 ):
             raise ValueError( 'Spectrum must have a single band "brz".' )
@@ -65,22 +63,201 @@ def upload_desi_spectrum( sn_id, index, nhostsforsn, night, spectrum, mhsp, inst
         logger.error( f'Error processing spectrum for {sn_id} host {index} night {night}!' )
         return None
 
-    data = {
+    meta = {
         'obj_id': sn_id,
         'label': label,
-        'wavelengths': spectrum.wave['brz'].tolist(),
-        'fluxes': spectrum.flux['brz'][0,:].tolist(),
-        'errors': error.tolist(),
         'instrument_id': instrument_id,
         'observed_at': obsnight.isoformat(),
         'group_ids': [MostHostsSkyPortal.mosthosts_group_id],
         'type': 'host_center'
         }
+    return label, meta, spectrum.wave['brz'], spectrum.flux['brz'][0,:], error
+
+def desi_spectrum_payload( sn_id, index, nhostsforsn, night, spectrum, instrument_id, builder=None,
+                           logger=logging.getLogger("main") ):
+    """Build the body of a SkyPortal api/spectra POST for a desispec.spectrum.Spectra.
+
+    Parameters are as for upload_desi_spectrum, except that
+    instrument_id is required.  If builder (a SpectrumPayloadBuilder) is
+    given, the body is encoded JSON bytes, otherwise it's a dict.
+
+    Returns (label, data), or (None, None) if the spectrum can't be
+    uploaded.
+
+    """
+    parts = desi_spectrum_parts( sn_id, index, nhostsforsn, night, spectrum, instrument_id, logger=logger )
+    if parts is None:
+        return None, None
+    label, meta, wave, flux, error = parts
+    if builder is not None:
+        return label, builder.build( meta, wave, flux, error )
+    data = dict( meta )
+    data.update( { 'wavelengths': wave.tolist(), 'fluxes': flux.tolist(), 'errors': error.tolist() } )
+    return label, data
+
+def upload_desi_spectrum( sn_id, index, nhostsforsn, night, spectrum, mhsp, instrument_id=None, logger=logging.getLogger("main") ):
+    """Upload a desispec.spectrum.Spectra to SkyPortal.
+
+    sn_id — the id on skyportal of the sn
+    index — the "index" field in Most Hosts for the host this is a spectrum of
+    nhostsforsn — the number of hosts there are for this sn
+    night — either an integer or a string in the format yyyymmdd or yyyy-mm-dd
+    spectrum — a desispec.spectrum.Spectra object.  It should have just a 
+               single spectrum, and a single band 'brz'
+    mhsp — a MostHostsSkyPortal object
+    instrument_id — The instrument_id for DESI on SkyPortal.  (Looks it up on SkyPortal if not supplied.)
+    """
+    if instrument_id is None:
+        instrument_id = mhsp.get_instrument_id('DESI')
+    label, data = desi_spectrum_payload( sn_id, index, nhostsforsn, night, spectrum, instrument_id, logger=logger )
+    if label is None:
+        return None
     mhsp.sp_req( 'POST', f'{mhsp.apiurl}/spectra', data=data )
     return label
 
 # ======================================================================
 
+def upload_jobs( todo, finder, instrument_id, builder=None, telemetry=None, logger=logging.getLogger("main") ):
+    """Generate UploadJobs for the rows of an upload plan.
+
+    todo — the rows of the plan from plan_uploads to upload
+    finder — a SpectrumFinder that knows about all the hosts in todo
+    instrument_id — SkyPortal's instrument id for DESI
+    builder — a SpectrumPayloadBuilder (default: one with default sigfigs)
+
+    Rows are taken one coadd file at a time, so that each file is only
+    read once, and the payloads for all the spectra from a file are
+    encoded together.  This is meant to be passed to UploadExecutor.run(),
+    which runs it in its own thread, so reading files and building
+    payloads overlaps with uploading.
+
+    """
+    builder = SpectrumPayloadBuilder() if builder is None else builder
+    todo = todo.copy()
+    paths = []
+    for row in todo.itertuples():
+        try:
+            paths.append( str( finder.filepath( row.targetid, row.tileid, row.petal, row.night ) ) )
+        except Exception as e:
+            logger.error( f'Can\'t find the coadd file for {row.spname} target {row.targetid} '
+                          f'tile {row.tileid} petal {row.petal} night {row.night}: {e}' )
+            paths.append( None )
+    todo['coaddfile'] = paths
+    nofile = todo['coaddfile'].isna()
+    if telemetry is not None:
+        for i in range( nofile.sum() ):
+            telemetry.increment( 'failed' )
+            telemetry.increment()
+    todo = todo[ ~nofile ]
+
+    for coaddfile, rows in todo.groupby( 'coaddfile', sort=True ):
+        if telemetry is not None:
+            telemetry.heartbeat( 'reader', f'reading {coaddfile}' )
+        try:
+            spectra = SpectrumFinder.read_coadd( coaddfile )
+        except Exception as e:
+            logger.exception( f'Failed to read {coaddfile}; skipping {len(rows)} spectra' )
+            if telemetry is not None:
+                telemetry.increment( 'failed', len(rows) )
+                telemetry.increment( n=len(rows) )
+            continue
+        good = []
+        parts = []
+        for row in rows.itertuples():
+            try:
+                spec = SpectrumFinder.spectrum_from_coadd( spectra, row.targetid )
+                part = desi_spectrum_parts( row.spname, row.host, row.nhosts, row.nightstr, spec,
+                                            instrument_id, logger=logger )
+            except Exception as e:
+                logger.exception( f'Failed to get spectrum for {row.spname} '
+                                  f'target {row.targetid} tile {row.tileid} petal {row.petal} night {row.night}' )
+                part = None
+            if part is None:
+                if telemetry is not None:
+                    telemetry.increment( 'failed' )
+                    telemetry.increment()
+                continue
+            good.append( row )
+            parts.append( part )
+        if len( parts ) == 0:
+            continue
+
+        # All the spectra from one coadd file share a wavelength array
+        waves = [ p[2] for p in parts ]
+        if all( np.array_equal( w, waves[0] ) for w in waves[1:] ):
+            waves = waves[0]
+        else:
+            waves = np.vstack( waves )
+        bodies = builder.build_batch( [ p[1] for p in parts ], waves,
+                                      np.vstack( [ p[3] for p in parts ] ), np.vstack( [ p[4] for p in parts ] ) )
+        for row, part, body in zip( good, parts, bodies ):
+            yield UploadJob( row.spname, row.host, row.nightstr, part[0], body,
+                             targetid=row.targetid, tileid=row.tileid, petal=row.petal )
+    if telemetry is not None:
+        telemetry.finished( 'reader' )
+
+# ======================================================================
+
+def plan_uploads( haszdf, mosthosts, mhsp, logger=logging.getLogger("main") ):
+    """Figure out which DESI spectra need to be uploaded to SkyPortal.
+
+    haszdf — the (possibly trimmed) haszdf dataframe from a MostHostsDesi object
+    mosthosts — the MostHostsDesi object (used to count hosts per SN)
+    mhsp — a MostHostsSkyPortal object
+
+    Pulls the inventory of all spectra in the MostHosts group from
+    SkyPortal in one go (with mhsp.get_spectrum_info()), parses the
+    labels, and compares that to haszdf.  Spectra are identified by
+    (SN, host, night), since that's all that's in the label.  If there
+    is more than one DESI spectrum for the same SN, host, and night
+    (different targets or tiles), only the first is planned.
+
+    Returns a dataframe with one row per (SN, host, night) and columns
+    spname, host, nhosts, targetid, tileid, petal, night (yyyymmdd int),
+    nightstr (yyyy-mm-dd), ra, dec, and status.  status is one of:
+
+      upload — needs to be uploaded
+      already_uploaded — a spectrum with the right label is already on SkyPortal
+      missing_from_skyportal — the SN isn't a source on SkyPortal
+
+    """
+    plan = haszdf.reset_index()[ [ 'sn_name_sp', 'hostnum', 'targetid', 'tileid', 'petal', 'night', 'ra', 'dec' ] ]
+    plan = plan.rename( columns={ 'sn_name_sp': 'spname', 'hostnum': 'host' } )
+    nights = plan['night'].astype( str )
+    plan['nightstr'] = nights.str[0:4] + '-' + nights.str[4:6] + '-' + nights.str[6:8]
+    plan = plan.drop_duplicates( [ 'spname', 'host', 'nightstr' ], keep='first' )
+
+    nhosts = mosthosts.df.groupby( level='sn_name_sp' ).size().rename( 'nhosts' )
+    plan = plan.merge( nhosts, left_on='spname', right_index=True, how='left' )
+
+    specinfo = mhsp.get_spectrum_info()
+    logger.info( f'{len(specinfo)} spectra in the MostHosts group on SkyPortal' )
+    if len( specinfo ) > 0:
+        parsed = specinfo['label'].str.extract( r'^Host (\d+) of \d+ (\d\d\d\d-\d\d-\d\d) ?(\d+)?$' )
+        bad = parsed[0].isna()
+        if bad.any():
+            logger.error( f'Failed to parse {bad.sum()} spectrum labels, e.g. '
+                          f'{specinfo.loc[bad,"label"].head(5).tolist()}' )
+        onsp = pandas.DataFrame( { 'spname': specinfo['obj_id'], 'host': pandas.to_numeric( parsed[0] ),
+                                   'nightstr': parsed[1] } )[ ~bad ]
+        onsp = onsp.drop_duplicates().astype( { 'host': plan['host'].dtype } )
+    else:
+        onsp = pandas.DataFrame( { 'spname': [], 'host': [], 'nightstr': [] } ).astype( { 'host': plan['host'].dtype } )
+
+    plan = plan.merge( onsp, on=[ 'spname', 'host', 'nightstr' ], how='left', indicator=True )
+    plan['status'] = np.where( plan['_merge'] == 'both', 'already_uploaded', 'upload' )
+    plan.loc[ ~plan['spname'].isin( mhsp.df.index ), 'status' ] = 'missing_from_skyportal'
+    plan = plan.drop( columns='_merge' ).reset_index( drop=True )
+
+    counts = plan['status'].value_counts()
+    logger.info( f'Upload plan: {counts.to_dict()}' )
+    missing = plan.loc[ plan['status'] == 'missing_from_skyportal', 'spname' ].unique()
+    if len( missing ) > 0:
+        logger.error( f'{len(missing)} SNe are in MostHostsDesi but not MostHostsSkyPortal: {list(missing)}' )
+    return plan
+
+# ======================================================================
+
 def main():
     # print( "This is a work in progress, do not run." )
 
@@ -101,18 +278,40 @@ def main():
                          help=( "Force regeneration of mosthosts_desi_daily_desiobs.pkl from the desi database "
                                 " (by default, just read mosthosts_desi_daily_desiobs.pkl and do nothing)" ) )
     parser.add_argument( "--regen-skyportal", default=False, action="store_true",
-                         help=( "Reread skyportal information from skyportal (by default, just reads skyportalcache.pkl)" ) )
-    parser.add_argument( "-i", "--ignore-specinfo-cache", default=False, action="store_true",
-                         help=( "Ignore (rebuild) cached file of information about what spectra are on SkyPortal" ) )
+                         help=( "Reread skyportal information from skyportal (by default, just reads "
+                                "skyportalcache.parquet)" ) )
+    parser.add_argument( "--sync-skyportal", default=False, action="store_true",
+                         help=( "Update skyportalcache.parquet with just the sources that have changed on skyportal "
+                                "since it was written" ) )
+    parser.add_argument( "--plan-file", default=None,
+                         help=( "Write the upload plan (every DESI spectrum, and whether it needs to be uploaded) "
+                                "to this CSV file" ) )
     parser.add_argument( "-t", "--skyportal-token", required=True, help="API token for skyportal" )
     parser.add_argument( "-s", "--skyportal-url", default="https://desi-skyportal.lbl.gov",
                          help="URL of skyportal (default: https://desi-skyportal.lbl.gov)" )
-    parser.add_argument( "--sleep-time", type=float, default=0.1,
-                         help="Sleep time (seconds) between skyportal requests (default: 0.1)" )
+    parser.add_argument( "-n", "--nthreads", type=int, default=8,
+                         help=( "Maximum number of uploads in flight at once (default: 8); the actual number "
+                                "adapts to how fast skyportal is taking them" ) )
+    parser.add_argument( "--max-rate", type=float, default=5.,
+                         help="Maximum skyportal requests per second (default: 5)" )
+    parser.add_argument( "--sigfigs", type=int, nargs=3, default=[ 8, 6, 4 ],
+                         metavar=( "WAVE", "FLUX", "ERR" ),
+                         help=( "Significant digits to send for wavelengths, fluxes, and errors (default: 8 6 4)" ) )
+    parser.add_argument( "--gzip", default=False, action="store_true",
+                         help="gzip upload bodies (only if the skyportal server accepts Content-Encoding: gzip)" )
+    parser.add_argument( "-l", "--ledger", default="upload_ledger.sqlite",
+                         help=( "SQLite file that records every upload, so a rerun skips what's already done "
+                                "(default: upload_ledger.sqlite)" ) )
     parser.add_argument( "--really-upload", default=False, action='store_true',
                          help="Include this to do things." )
     parser.add_argument( "-c", "--candidates", default=[], nargs='*',
                          help="Only do these candidates (\"skyportal\" name) (default: do all)" )
+    parser.add_argument( "--status-file", default=None,
+                         help="Write a JSON file with counts, rates, and ETA here every --status-interval seconds" )
+    parser.add_argument( "--status-interval", type=float, default=10.,
+                         help="Seconds between status updates (default: 10)" )
+    parser.add_argument( "--progress", default=False, action="store_true",
+                         help="Show a progress line on stderr" )
     args = parser.parse_args()
 
     if ( args.dbuserpwfile is None ) and ( args.dbuser is None or args.dbpasswd is None ):
@@ -122,8 +321,6 @@ def main():
         with open( args.dbuserpwfile ) as ifp:
             (args.dbuser, args.dbpasswd) = ifp.readline().strip().split()
         
-    spapi = f'{args.skyportal_url}/api'
-        
     # Load in all the information about mosthosts spectra.  (Use the default release of "daily".)
 
     mosthosts = MostHostsDesi( dbuser=args.dbuser, dbpasswd=args.dbpasswd, dbuserpwfile=args.dbuserpwfile,
@@ -147,121 +344,45 @@ def main():
     else:
         haszdf = mosthosts.haszdf
     
-    mhsp = MostHostsSkyPortal( token=args.skyportal_token, logger=logger )
-    if args.regen_skyportal:
-        mhsp.generate_df( regen=True )
+    mhsp = MostHostsSkyPortal( url=args.skyportal_url, token=args.skyportal_token, logger=logger,
+                               maxrate=args.max_rate, poolsize=args.nthreads, gzip=args.gzip )
+    if args.regen_skyportal or args.sync_skyportal:
+        mhsp.generate_df( regen=args.regen_skyportal, sync=args.sync_skyportal )
     instrument_id = mhsp.get_instrument_id('DESI')
-    
-    # Try to figure out which desi spectra are already uploaded
 
-    if ( not args.ignore_specinfo_cache ) and os.path.isfile( "spspecinfo_cache.pkl" ):
-        spspecinfo = pickle.load( open("specinfo_cache.pkl", "rb") )
-    else:
-        spspecinfo = {}
-
-    labelparse = re.compile('^Host (\d+) of \d+ (\d\d\d\d-\d\d-\d\d) ?(\d+)?$')
-
-    # How I keep track:
-    # The data structure "spspecinfo" has info on what's on sky portal.
-    # It's a dictionary indexed by candidate id (the "spname" index from MostHostsDesi).
-    # Each element of that dictionary is a dictionary indexed by host index (the "index" from MostHostsDesi).
-    # Each element of that dictionary is a set of nights ("yyyy-mm-dd") for spectra that are on SkyPortal
-    #
-    # NOTE : it's possible, at least in principle, the same object will
-    # be observed on the same night with a different targetid.  Right now,
-    # this code ignores that and assumes it never happens.
-    
-    numdid = 0
-    nmissing = 0
-    curid = None
-    skipcurid = False
-    for mhdidx, mhdrow in haszdf.iterrows():
-        if numdid % 100 == 0:
-            logger.info( f'***** Doing row {numdid} of {len(haszdf)} DESI host spectra.' )
-        numdid += 1
-        # mhdid is the current candidate id, mhddex is the host index of the candidate
-        mhdid, mhddex, targetid, tileid, petal, night = mhdidx
-        spname = mhdrow["spname"]
-        nightstr = str(night)
-        nightstr = f"{nightstr[0:4]}-{nightstr[4:6]}-{nightstr[6:8]}"
-
-        if ( ( spname in spspecinfo ) and ( mhddex in spspecinfo[spname] )
-             and ( nightstr in spspecinfo[spname][mhddex] ) ):
-            logger.info( f'{mhdid} host {mhddex} night {nightstr} already uploaded, moving on' )
-            continue
+    # Figure out which desi spectra are already uploaded
 
-        # Get the spectra for the current object (if we haven't already in a previous iteration)
-        # Both from skyportal, and from desi
-        
-        if mhdid != curid:
-            curid = mhdid
-            skipcurid = False
-            curhost = None
-            
-            if spname not in mhsp.df.index.values:
-                logger.error( f'{spname} ({mhdid}) is in MostHostsDesi but not MostHostsSkyPortal' )
-                nmissing += 1
-                skipcurid = True
-                continue
-            if spname not in spspecinfo:
-                spspecinfo[spname] = {}
-            time.sleep( args.sleep_time )
-            specs = mhsp.spectra_for_obj( spname )
-            for spec in specs:
-                match = labelparse.search( spec['label'] )
-                if match is None:
-                    logger.error( f'Failed to parse spectrum label {spec["label"]} for {spname}' )
-                else:
-                    sphost = int(match.group(1))
-                    spnight = match.group(2)
-                    spextra = match.group(3)    # Ignored for now
-                    if sphost not in spspecinfo[spname]:
-                        spspecinfo[spname][sphost] = set()
-                    spspecinfo[spname][sphost].add( spnight )
-
-        if mhddex != curhost:
-            curhost = mhddex
-                
-            try:
-                si = SpectrumInfo( mhdrow['ra'], mhdrow['dec'], desipasswd=args.dbpasswd, logger=logger )
-            except Exception as e:
-                logger.exception( "Failed to create SpectrumInfo for {spname}, moving on." )
-                continue
+    plan = plan_uploads( haszdf, mosthosts, mhsp, logger=logger )
+    if args.plan_file is not None:
+        plan.to_csv( args.plan_file, index=False )
+        logger.info( f'Wrote upload plan to {args.plan_file}' )
+    todo = plan[ plan['status'] == 'upload' ]
+    if len( todo ) == 0:
+        logger.info( 'Nothing to upload.' )
+        return
 
-        if skipcurid:
-            continue
+    ledger = UploadLedger( args.ledger, logger=logger )
+    telemetry = Telemetry( 'spectrum_uploader', counter='rows', total=len(todo), statusfile=args.status_file,
+                           interval=args.status_interval, progress=args.progress, logger=logger )
+    telemetry.start()
 
-        if mhddex not in spspecinfo[spname]:
-            spspecinfo[spname][mhddex] = set()
+    # One SpectrumFinder for everything, so there's just one trip to the database
 
-        # See if we need to upload the current spectrum
+    hosts = todo.drop_duplicates( [ 'spname', 'host' ] )
+    finder = SpectrumFinder( hosts['ra'].values, hosts['dec'].values,
+                             names=( hosts['spname'] + '_' + hosts['host'].astype(str) ).values,
+                             desipasswd=args.dbpasswd, logger=logger )
 
-        if nightstr in spspecinfo[spname][mhddex]:
-            logger.info( f'{spname} host {mhddex} night {nightstr} already uploaded, moving on' )
-            continue
+    executor = UploadExecutor( mhsp, ledger, nthreads=args.nthreads, dryrun=not args.really_upload,
+                               telemetry=telemetry, logger=logger )
+    builder = SpectrumPayloadBuilder( { 'wavelengths': args.sigfigs[0], 'fluxes': args.sigfigs[1],
+                                        'errors': args.sigfigs[2] } )
+    counts = executor.run( upload_jobs( todo, finder, instrument_id, builder=builder, telemetry=telemetry,
+                                        logger=logger ) )
 
-        # Need to upload current spectrum
-
-        try:
-            spec = si.get_spectrum( targetid, tileid, petal, night )
-        except Exception as e:
-            logger.exception( f'Failed to get spectrum for {spname} '
-                              f'target {targetid} tile{tileid} petal {petal} night {night}' )
-            continue
-        if args.really_upload:
-            logger.info( f'Uploading {spname} host {mhddex} night {nightstr} (target {targetid})...' )
-            try:
-                nhostsforsn = len( mosthosts.df[ mosthosts.df['spname']==spname ] )
-                upload_desi_spectrum( spname, mhddex, nhostsforsn, nightstr, spec, mhsp, instrument_id )
-            except Exception as e:
-                logger.exception( f'Error uploading target {targetid} tile {tileid} petal {petal} night {night}|' )
-            logger.info( f'...uploaded.' )
-            time.sleep( args.sleep_time )
-            spspecinfo[spname][mhddex].add( nightstr )
-        else:
-            logger.info( f'Would upload {spname} host {mhddex} night {nightstr} (target {targetid})' )
-            
-    pickle.dump( spspecinfo, open("specinfo_cache.pkl", "wb") )
+    telemetry.stop()
+    logger.info( f'Done: {counts}; ledger {args.ledger} has {ledger.summary()}' )
+    ledger.close()
 
 # ======================================================================
 
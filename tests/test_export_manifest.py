@@ -0,0 +1,61 @@
+import sys
+import pathlib
+
+import pytest
+
+sys.path.insert( 0, str( pathlib.Path( __file__ ).parent.parent / "lib" ) )
+
+from export_manifest import ExportManifest, file_sha256
+
+def spectrum( outdir, snname, host, targetid, night, contents ):
+    """Write a fake spectrum file; return the record_spectra tuple for it."""
+    outfile = outdir / f"{snname}_{host}_{targetid}.fits"
+    outfile.write_bytes( contents )
+    return ( snname, host, targetid, 1000, 3, night, 0, '57', 'a1', outfile, file_sha256( outfile ) )
+
+def key( s ):
+    return tuple( s[0:6] )
+
+def test_round_trip( tmp_path ):
+    shard0 = [ spectrum( tmp_path, 'SN2019abc', 0, 39627000000000001, '20210514', b'one' ),
+               spectrum( tmp_path, 'SN2019abc', 1, 39627000000000002, '20210514', b'two' ) ]
+    shard1 = [ spectrum( tmp_path, 'ZTF18aaizerg', 0, 39627000000000003, '20220101', b'three' ) ]
+
+    with ExportManifest( tmp_path / "manifest_00-7f.sqlite3" ) as manifest:
+        manifest.record_spectra( shard0 )
+        assert manifest.done_spectra() == { key( s ) for s in shard0 }
+    with ExportManifest( tmp_path / "manifest_80-ff.sqlite3" ) as manifest:
+        manifest.record_spectra( shard1 )
+
+    with ExportManifest( tmp_path / "manifest.sqlite3" ) as manifest:
+        assert manifest.merge( tmp_path / "manifest_00-7f.sqlite3" ) == 2
+        assert manifest.merge( tmp_path / "manifest_80-ff.sqlite3" ) == 1
+        # Merging the same shard again replaces rather than duplicates
+        assert manifest.merge( tmp_path / "manifest_80-ff.sqlite3" ) == 1
+        assert manifest.done_spectra() == { key( s ) for s in shard0 + shard1 }
+        df = manifest.spectra()
+        assert len( df ) == 3
+        assert set( df.targid ) == { 39627000000000001, 39627000000000002, 39627000000000003 }
+        assert manifest.verify() == 0
+
+        # A file changed after it was recorded gets forgotten so it will be redone
+        shard0[1][9].write_bytes( b'corrupted' )
+        assert manifest.verify() == 1
+        assert manifest.done_spectra() == { key( shard0[0] ), key( shard1[0] ) }
+
+        # ...as does a missing one
+        shard1[0][9].unlink()
+        assert manifest.verify() == 1
+        assert manifest.done_spectra() == { key( shard0[0] ) }
+
+    # It all persists in the file
+    with ExportManifest( tmp_path / "manifest.sqlite3" ) as manifest:
+        assert manifest.done_spectra() == { key( shard0[0] ) }
+
+def test_forget_spectra( tmp_path ):
+    spec = [ spectrum( tmp_path, 'SN2019abc', 0, 39627000000000001, '20210514', b'one' ),
+             spectrum( tmp_path, 'AT2021xyz', 0, 39627000000000004, '20210601', b'four' ) ]
+    with ExportManifest( tmp_path / "manifest.sqlite3" ) as manifest:
+        manifest.record_spectra( spec )
+        manifest.forget_spectra( [ key( spec[1] ) ] )
+        assert manifest.done_spectra() == { key( spec[0] ) }
@@ -0,0 +1,84 @@
+import sys
+import pathlib
+
+import numpy
+import pytest
+
+sys.path.insert( 0, str( pathlib.Path( __file__ ).parent.parent ) )
+pytest.importorskip( "sqlalchemy" )
+pytest.importorskip( "desispec" )
+
+import exportspectra
+
+def scalar_pearson_hash( string ):
+    """The byte-at-a-time hash that pearson_hashes replaced."""
+    blob = string.encode( 'utf-8' )
+    hash = numpy.array( [0], dtype=numpy.ubyte )
+    for b in blob:
+        hash[0] = exportspectra._pearson_byteperm[ hash[0] ^ b ]
+    return f"{hash[0]:02x}"
+
+snnames = [ 'ZTF18aaizerg', 'ZTF21abcdefg', 'SN2019abc', 'SN2011fe', 'AT2021xyz', 'AT 2021xyz', 'PTF10abc',
+            'iPTF13ebh', 'ASASSN-14lp', 'DES15X2kvt', 'PS1-10afx', 'SN2019abc_0', 'SN2019abc_12', 'a', '',
+            'SN2020été', '超新星' ]
+
+def test_pearson_hashes_match_scalar():
+    hashes = exportspectra.pearson_hashes( snnames )
+    assert list( hashes ) == [ scalar_pearson_hash( s ) for s in snnames ]
+    assert all( exportspectra.pearson_hash( s ) == scalar_pearson_hash( s ) for s in snnames )
+
+def test_pearson_hashes_empty():
+    assert len( exportspectra.pearson_hashes( [] ) ) == 0
+
+def test_pearson_hashes_many():
+    rng = numpy.random.default_rng( 42 )
+    names = [ f"ZTF{rng.integers( 17, 25 )}{''.join( rng.choice( list( 'abcdefghijklmnopqrstuvwxyz' ), 7 ) )}"
+              for _ in range( 2000 ) ]
+    assert list( exportspectra.pearson_hashes( names ) ) == [ scalar_pearson_hash( s ) for s in names ]
+
+@pytest.mark.parametrize( "spec, buckets", [
+    ( "57", [ 0x57 ] ),
+    ( "0", [ 0 ] ),
+    ( "ff", [ 255 ] ),
+    ( "FF", [ 255 ] ),
+    ( "0-3f", list( range( 64 ) ) ),
+    ( "00-ff", list( range( 256 ) ) ),
+    ( "3f-3f", [ 0x3f ] ),
+    ( "00-0f,80-8f", list( range( 16 ) ) + list( range( 128, 144 ) ) ),
+    ( " 10 - 12 , 20 ", [ 0x10, 0x11, 0x12, 0x20 ] ),
+    ( "10,,11,", [ 0x10, 0x11 ] ),
+    ( "12,10-12,11", [ 0x10, 0x11, 0x12 ] ),
+    ( "80-8f,00-0f", list( range( 16 ) ) + list( range( 128, 144 ) ) ),
+    ( "", [] ),
+] )
+def test_parse_shards( spec, buckets ):
+    assert exportspectra.parse_shards( spec ) == buckets
+
+@pytest.mark.parametrize( "spec", [ "40-3f", "0-100", "100", "zz", "1-2-3", "-5", "5-", "-", "g0", "1;2", "0-3f,xyz" ] )
+def test_parse_shards_malformed( spec ):
+    with pytest.raises( ValueError ):
+        exportspectra.parse_shards( spec )
+
+@pytest.mark.parametrize( "ntasks", [ 1, 3, 7, 8, 100, 256 ] )
+def test_slurm_shards_cover_everything_once( ntasks ):
+    buckets = [ b for t in range( ntasks ) for b in exportspectra.slurm_shards( t, ntasks ) ]
+    assert buckets == list( range( 256 ) )
+
+def test_slurm_shards_from_env( monkeypatch ):
+    monkeypatch.setenv( "SLURM_ARRAY_TASK_ID", "2" )
+    monkeypatch.setenv( "SLURM_ARRAY_TASK_MIN", "1" )
+    monkeypatch.setenv( "SLURM_ARRAY_TASK_COUNT", "4" )
+    assert exportspectra.slurm_shards() == list( range( 64, 128 ) )
+
+@pytest.mark.parametrize( "taskid, ntasks", [ ( 0, 0 ), ( 4, 4 ), ( -1, 4 ), ( 0, 257 ) ] )
+def test_slurm_shards_bad( taskid, ntasks ):
+    with pytest.raises( ValueError ):
+        exportspectra.slurm_shards( taskid, ntasks )
+
+def test_shard_label():
+    assert exportspectra.shard_label( range( 256 ) ) == "all"
+    assert exportspectra.shard_label( [ 0x41, 0x40, 0x3f ] ) == "3f-41"
+    assert exportspectra.shard_label( [ 5 ] ) == "05-05"
+    label = exportspectra.shard_label( [ 0, 2 ] )
+    assert len( label ) == 12
+    assert label != exportspectra.shard_label( [ 0, 3 ] )
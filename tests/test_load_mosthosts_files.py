@@ -0,0 +1,164 @@
+import sys
+import json
+import pathlib
+
+import numpy
+import pandas
+import pytest
+import pyarrow
+
+sys.path.insert( 0, str( pathlib.Path( __file__ ).parent.parent ) )
+pytest.importorskip( "psycopg2" )
+
+import load_mosthosts_files
+
+@pytest.fixture
+def catalog_file( tmp_path ):
+    """A one-column-of-everything df*.csv with ids written as a plain int, a float, and in scientific notation."""
+    schema = load_mosthosts_files.catalog_schema()
+    tofile = { v: k for k, v in load_mosthosts_files._filerenames.items() }
+    header = [ tofile.get( f.name, f.name ) for f in schema ]
+    rows = []
+    for ref_id in [ '1004337252738407808', '1004337252738407808.0', '3.902708624346786e+18' ]:
+        row = { f.name: ( '0' if pyarrow.types.is_integer( f.type )
+                          else '1.5' if pyarrow.types.is_floating( f.type ) else 'x' )
+                for f in schema }
+        row['ref_id_dr9'] = ref_id
+        rows.append( ','.join( row[f.name] for f in schema ) )
+    path = tmp_path / "df_test.csv"
+    path.write_text( '\n'.join( [ ','.join( header ) ] + rows ) + '\n' )
+    return path
+
+def test_read_catalog_file_scientific_ids( catalog_file, caplog ):
+    table = load_mosthosts_files._read_catalog_file( catalog_file, load_mosthosts_files.catalog_schema() )
+    # The scientific-notation id gets what the old numpy.int64( float( x ) ) reader gave
+    assert table.column( 'ref_id_dr9' ).to_pylist() == [ 1004337252738407808, 1004337252738407808,
+                                                         int( numpy.int64( float( '3.902708624346786e+18' ) ) ) ]
+    assert "aren't integers" in caplog.text
+
+def test_read_catalog_file_bad_ids( catalog_file ):
+    catalog_file.write_text( catalog_file.read_text().replace( '3.902708624346786e+18', 'notanumber' ) )
+    with pytest.raises( ValueError, match="ref_id_dr9" ):
+        load_mosthosts_files._read_catalog_file( catalog_file, load_mosthosts_files.catalog_schema() )
+
+# ======================================================================
+# diff_hosts, apply_diff, write_changelog
+
+def hosts( rows ):
+    """A mosthosts-table-like dataframe; rows are dicts of the columns that matter, everything else is null."""
+    return pandas.DataFrame( [ { c: r.get( c ) for c in load_mosthosts_files.columns } for r in rows ],
+                             columns=list( load_mosthosts_files.columns.keys() ) )
+
+def host( sn, ra, dec, hostnum=None, id=None, **kwargs ):
+    return dict( sn_name_sp=sn, ra=ra, dec=dec, hostnum=hostnum, id=id, sn_ra=ra, sn_dec=dec, **kwargs )
+
+arcsec = 1. / 3600.
+
+def test_diff_unchanged():
+    old = hosts( [ host( 'SN1', 10., 20., 0, 'u0', sn_z=0.05 ), host( 'SN1', 10.01, 20., 1, 'u1', sn_z=0.05 ) ] )
+    new = hosts( [ host( 'SN1', 10.01, 20., sn_z=0.05 ), host( 'SN1', 10., 20., sn_z=0.05 ) ] )
+    inserts, updates, deletes = load_mosthosts_files.diff_hosts( new, old )
+    assert ( len( inserts ), len( updates ), len( deletes ) ) == ( 0, 0, 0 )
+
+def test_diff_moved_within_tolerance_keeps_hostnum():
+    old = hosts( [ host( 'SN1', 10., 20., 0, 'u0' ), host( 'SN1', 10.01, 20., 1, 'u1' ) ] )
+    new = hosts( [ host( 'SN1', 10., 20. ), host( 'SN1', 10.01 + 0.5 * arcsec, 20. ) ] )
+    inserts, updates, deletes = load_mosthosts_files.diff_hosts( new, old, tolerance=arcsec )
+    assert ( len( inserts ), len( deletes ) ) == ( 0, 0 )
+    assert len( updates ) == 1
+    assert updates.loc[ 0, 'id' ] == 'u1'
+    assert updates.loc[ 0, 'hostnum' ] == 1
+    assert updates.loc[ 0, 'ra' ] == pytest.approx( 10.01 + 0.5 * arcsec )
+
+def test_diff_added_and_removed():
+    old = hosts( [ host( 'SN1', 10., 20., 0, 'u0' ), host( 'SN1', 10.01, 20., 1, 'u1' ),
+                   host( 'SN2', 50., -5., 0, 'u2' ) ] )
+    new = hosts( [ host( 'SN1', 10., 20. ), host( 'SN1', 10.02, 20. ), host( 'SN3', 80., 1. ) ] )
+    inserts, updates, deletes = load_mosthosts_files.diff_hosts( new, old, tolerance=arcsec )
+    assert len( updates ) == 0
+    ins = inserts.set_index( 'sn_name_sp' )
+    assert set( ins.index ) == { 'SN1', 'SN3' }
+    # A new host of an existing SN is numbered after its existing hosts, even if one of them was deleted
+    assert ins.loc[ 'SN1', 'hostnum' ] == 2
+    assert ins.loc[ 'SN3', 'hostnum' ] == 0
+    assert set( deletes['id'] ) == { 'u1', 'u2' }
+
+def test_diff_competing_hosts():
+    old = hosts( [ host( 'SN1', 10., 20., 0, 'u0' ) ] )
+    # Both are within tolerance of the old host; the closer one is it, the other is new
+    new = hosts( [ host( 'SN1', 10. + 0.6 * arcsec, 20. ), host( 'SN1', 10. + 0.3 * arcsec, 20. ) ] )
+    inserts, updates, deletes = load_mosthosts_files.diff_hosts( new, old, tolerance=arcsec )
+    assert len( deletes ) == 0
+    assert len( updates ) == 1
+    assert updates.loc[ 0, 'id' ] == 'u0'
+    assert updates.loc[ 0, 'hostnum' ] == 0
+    assert updates.loc[ 0, 'ra' ] == pytest.approx( 10. + 0.3 * arcsec )
+    assert len( inserts ) == 1
+    assert inserts.loc[ 0, 'hostnum' ] == 1
+    assert inserts.loc[ 0, 'ra' ] == pytest.approx( 10. + 0.6 * arcsec )
+
+def test_write_changelog( tmp_path ):
+    old = hosts( [ host( 'SN2', 10., 20., 0, 'u0' ), host( 'SN1', 30., 20., 0, 'u1', sn_z=0.1 ),
+                   host( 'SN4', 40., 20., 0, 'u2' ) ] )
+    new = hosts( [ host( 'SN2', 10., 20. ), host( 'SN1', 30., 20., sn_z=0.2 ), host( 'SN3', 50., 0. ) ] )
+    inserts, updates, deletes = load_mosthosts_files.diff_hosts( new, old )
+    path = tmp_path / "changelog.json"
+    load_mosthosts_files.write_changelog( inserts, updates, deletes, path )
+    with open( path ) as ifp:
+        changelog = json.load( ifp )
+    assert changelog['inserted'] == [ [ 'SN3', 0 ] ]
+    assert changelog['updated'] == [ [ 'SN1', 0 ] ]
+    assert changelog['deleted'] == [ [ 'SN4', 0 ] ]
+    assert changelog['sn_names'] == [ 'SN1', 'SN3', 'SN4' ]
+
+class FakeCursor:
+    def __init__( self, conn ):
+        self.conn = conn
+
+    def execute( self, q, params=None ):
+        if self.conn.failon is not None and self.conn.failon in q:
+            raise RuntimeError( "boom" )
+        self.conn.sql.append( ( q, params ) )
+
+    def copy_expert( self, q, buf ):
+        self.conn.sql.append( ( q, buf.read() ) )
+
+class FakeConn:
+    def __init__( self, failon=None ):
+        self.sql = []
+        self.failon = failon
+        self.commits = 0
+        self.rollbacks = 0
+
+    def cursor( self ):
+        return FakeCursor( self )
+
+    def commit( self ):
+        self.commits += 1
+
+    def rollback( self ):
+        self.rollbacks += 1
+
+def test_apply_diff( monkeypatch ):
+    old = hosts( [ host( 'SN1', 10., 20., 0, 'u0', sn_z=0.1 ), host( 'SN2', 30., 20., 0, 'u1' ) ] )
+    new = hosts( [ host( 'SN1', 10., 20., sn_z=0.2 ), host( 'SN3', 50., 0. ) ] )
+    inserts, updates, deletes = load_mosthosts_files.diff_hosts( new, old )
+
+    conn = FakeConn()
+    monkeypatch.setattr( load_mosthosts_files, 'dbcon', lambda: conn )
+    load_mosthosts_files.apply_diff( inserts, updates, deletes )
+    sql = [ q for q, p in conn.sql ]
+    assert sql[0].startswith( "DELETE FROM static.mosthosts" )
+    assert conn.sql[0][1] == { 'ids': [ 'u1' ] }
+    assert any( q.startswith( "UPDATE static.mosthosts" ) for q in sql )
+    copies = [ p for q, p in conn.sql if q.startswith( "COPY static.mosthosts(" ) ]
+    assert len( copies ) == 1 and copies[0].startswith( "SN3,0," )
+    assert conn.rollbacks == 0
+
+    # A failure partway through rolls everything back
+    conn = FakeConn( failon="UPDATE" )
+    monkeypatch.setattr( load_mosthosts_files, 'dbcon', lambda: conn )
+    with pytest.raises( RuntimeError ):
+        load_mosthosts_files.apply_diff( inserts, updates, deletes )
+    assert conn.rollbacks == 1
+    assert conn.commits == 0
@@ -0,0 +1,60 @@
+import sys
+import pathlib
+
+import pytest
+
+sys.path.insert( 0, str( pathlib.Path( __file__ ).parent.parent / "lib" ) )
+
+from mosthosts_skyportal import MostHostsSkyPortal
+
+class FakeSkyPortal:
+    """Stands in for the fetch_pages and sp_req_data methods of a MostHostsSkyPortal."""
+
+    def __init__( self ):
+        self.sources = {}
+        self.fetched_by_id = []
+
+    def add( self, objid, modified ):
+        self.sources[objid] = { 'id': objid, 'ra': 1., 'dec': 2., 'created_at': '2024-01-01T00:00:00',
+                                'modified': modified,
+                                'classifications': [ { 'classification': 'Ia', 'probability': 1. } ],
+                                'groups': [ { 'id': 36, 'name': 'MostHosts' } ] }
+
+    def fetch_pages( self, url, params, listkey, numperpage=100, nthreads=None, telemetry=None ):
+        after = params.get( 'createdOrModifiedAfter' )
+        return [ dict( s ) for s in self.sources.values() if ( after is None ) or ( s['modified'] > after ) ]
+
+    def sp_req_data( self, method, url, data=None, params=None ):
+        objid = url.split( '/' )[-1]
+        self.fetched_by_id.append( objid )
+        return dict( self.sources[objid] )
+
+@pytest.fixture
+def mhsp( tmp_path, monkeypatch ):
+    fake = FakeSkyPortal()
+    mhsp = MostHostsSkyPortal( token='x', cachefile=tmp_path / "skyportalcache.parquet" )
+    monkeypatch.setattr( mhsp, 'fetch_pages', fake.fetch_pages )
+    monkeypatch.setattr( mhsp, 'sp_req_data', fake.sp_req_data )
+    mhsp.fake = fake
+    return mhsp
+
+def test_sync_add_and_remove( mhsp ):
+    mhsp.fake.add( 'a', '2024-01-02T00:00:00' )
+    mhsp.fake.add( 'b', '2024-01-03T00:00:00' )
+    mhsp.generate_df( regen=True )
+    assert set( mhsp.df.index ) == { 'a', 'b' }
+
+    # Remove one source and add another to the group without modifying it,
+    # so the number of sources doesn't change
+    del mhsp.fake.sources['a']
+    mhsp.fake.add( 'c', '2023-06-01T00:00:00' )
+    mhsp.generate_df( sync=True )
+    assert set( mhsp.df.index ) == { 'b', 'c' }
+    assert set( mhsp.classifications['source_id'] ) == { 'b', 'c' }
+    assert mhsp.fake.fetched_by_id == [ 'c' ]
+
+    # ...and it sticks in the cache
+    reread = MostHostsSkyPortal( token='x', cachefile=mhsp.cachefile )
+    reread.generate_df()
+    assert set( reread.df.index ) == { 'b', 'c' }
+    assert set( reread.groups['source_id'] ) == { 'b', 'c' }
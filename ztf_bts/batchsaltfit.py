@@ -0,0 +1,146 @@
+import sys
+import time
+import logging
+import argparse
+import traceback
+import multiprocessing
+import multiprocessing.pool
+
+import pandas
+
+sys.path.insert( 0, '/curveball/bin' )
+
+_logger = logging.getLogger( __name__ )
+if not _logger.hasHandlers():
+    _logout = logging.StreamHandler( sys.stderr )
+    _logger.addHandler( _logout )
+    _logout.setFormatter( logging.Formatter( f'[%(asctime)s - %(levelname)s] - %(message)s' ) )
+_logger.setLevel( logging.INFO )
+
+# Set in each pool worker by _init_worker
+_saltfitltcv = None
+_fitargs = None
+_initerror = None
+
+# ======================================================================
+
+def _init_worker( fitargs ):
+    """Pool initializer: import saltfitltcv (and everything it imports) once per worker.
+
+    This saves the imports (sncosmo, the curveball modules, ...), not
+    the database connection: saltfitltcv.main() still makes its own
+    with db.DB.get() for every SN.
+
+    If the import fails, the error is saved and reported by fit_one
+    (an exception here would make the Pool respawn workers forever).
+
+    """
+    global _saltfitltcv, _fitargs, _initerror
+    _fitargs = list( fitargs )
+    try:
+        import saltfitltcv
+        _saltfitltcv = saltfitltcv
+    except Exception as ex:
+        _initerror = f"Failed to import saltfitltcv: {ex.__class__.__name__}: {ex}"
+
+def fit_one( sn ):
+    """Run saltfitltcv.py's main() for one SN in this (warm) worker.
+
+    Returns (sn, ok, exitcode, duration, error).
+
+    """
+    t0 = time.perf_counter()
+    if _initerror is not None:
+        return ( sn, False, None, 0., _initerror )
+    origargv = sys.argv
+    sys.argv = [ 'saltfitltcv.py', sn ] + _fitargs
+    try:
+        _saltfitltcv.main()
+        return ( sn, True, 0, time.perf_counter() - t0, None )
+    except SystemExit as ex:
+        code = ex.code if isinstance( ex.code, int ) else ( 0 if ex.code is None else 1 )
+        return ( sn, code == 0, code, time.perf_counter() - t0,
+                 None if code == 0 else f"exited with {ex.code}" )
+    except Exception as ex:
+        return ( sn, False, None, time.perf_counter() - t0,
+                 f"{ex.__class__.__name__}: {ex}\n{traceback.format_exc()}" )
+    finally:
+        sys.argv = origargv
+
+def fetch_fits( versiontag, sne ):
+    """Return a dataframe of the salt2 fits with versiontag for sne (as in make_datacsv.py)."""
+    import psycopg2.extras
+    import db
+    with db.DB.get() as dbo:
+        con = dbo.db.connection().connection
+        cursor = con.cursor( cursor_factory=psycopg2.extras.RealDictCursor )
+        q = ( "SELECT DISTINCT ON (o.name) "
+              "  o.name AS sn,s.z,s.dz,s.mbstar,s.dmbstar,s.x1,s.dx1,s.c,s.dc,s.chisq,s.dof "
+              "FROM object o "
+              "INNER JOIN salt2fit s ON o.id=s.object_id "
+              "INNER JOIN salt2fit_versiontag svt ON s.id=svt.salt2fit_id "
+              "INNER JOIN versiontag v ON svt.versiontag_id=v.id "
+              "WHERE v.name=%(version)s AND o.name=ANY(%(sne)s) "
+              "ORDER BY o.name" )
+        cursor.execute( q, { "version": versiontag, "sne": list( sne ) } )
+        return pandas.DataFrame( cursor.fetchall(),
+                                 columns=[ 'sn', 'z', 'dz', 'mbstar', 'dmbstar', 'x1', 'dx1', 'c', 'dc',
+                                           'chisq', 'dof' ] )
+
+# ======================================================================
+
+def main():
+    parser = argparse.ArgumentParser( description=( "Run saltfitltcv.py on a list of SNe in a pool of warm "
+                                                    "worker processes.  Options not listed here (e.g. "
+                                                    "--photometry-version, --t0-bound, --save, --errorpuff, "
+                                                    "--force) are passed on to saltfitltcv.py." ),
+                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter )
+    parser.add_argument( "snlist", nargs="?", default="obj_with_ltcv.lis", help="File with one SN per line" )
+    parser.add_argument( "--versiontag", required=True, help="Version tag for the fits (passed to saltfitltcv.py)" )
+    parser.add_argument( "-n", "--nprocs", type=int, default=multiprocessing.cpu_count(),
+                         help="Number of worker processes" )
+    parser.add_argument( "-o", "--outfile", default=None,
+                         help="CSV of per-SN results (default: batchsaltfit_{versiontag}.csv)" )
+    args, fitargs = parser.parse_known_args()
+    fitargs = [ '--versiontag', args.versiontag ] + fitargs
+    outfile = args.outfile if args.outfile is not None else f"batchsaltfit_{args.versiontag}.csv"
+
+    with open( args.snlist ) as ifp:
+        sne = [ i.strip() for i in ifp.readlines() if len( i.strip() ) > 0 ]
+
+    # Fail now, rather than once per SN in the workers, if saltfitltcv can't be imported
+    import saltfitltcv
+
+    _logger.info( f"Fitting {len(sne)} SNe with {args.nprocs} processes: saltfitltcv.py {' '.join(fitargs)}" )
+    t0 = time.perf_counter()
+    results = []
+    with multiprocessing.pool.Pool( args.nprocs, initializer=_init_worker, initargs=( fitargs, ) ) as pool:
+        for res in pool.imap_unordered( fit_one, sne ):
+            results.append( res )
+            sn, ok, code, duration, err = res
+            if ok:
+                _logger.info( f"{sn} done in {duration:.1f} s ({len(results)}/{len(sne)})" )
+            else:
+                _logger.error( f"{sn} failed in {duration:.1f} s ({len(results)}/{len(sne)}): "
+                               f"{err.splitlines()[0]}" )
+    elapsed = time.perf_counter() - t0
+
+    results = pandas.DataFrame( results, columns=[ 'sn', 'ok', 'exitcode', 'duration', 'error' ] )
+    results['exitcode'] = results['exitcode'].astype( 'Int64' )
+    if '--save' in fitargs:
+        try:
+            results = results.merge( fetch_fits( args.versiontag, sne ), on='sn', how='left' )
+        except Exception as ex:
+            _logger.exception( f"Failed to get fit results from the database: {ex}" )
+    results.sort_values( 'sn' ).to_csv( outfile, index=False )
+
+    nfail = ( ~results['ok'] ).sum()
+    _logger.info( f"{len(results)-nfail} of {len(results)} SNe fit in {elapsed:.0f} s "
+                  f"({results['duration'].sum():.0f} s of fitting); results in {outfile}" )
+    if nfail > 0:
+        _logger.error( f"Failed: {' '.join( results.loc[ ~results['ok'], 'sn' ] )}" )
+
+# **********************************************************************
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,15 @@
+import os
 import sys
+import time
+import heapq
+import sqlite3
 import pathlib
 import logging
-import multiprocessing
-import multiprocessing.pool
+import argparse
+import statistics
+import collections
+import concurrent.futures
+import concurrent.futures.process
 
 sys.path.insert( 0, '/curveball/bin' )
 import db
@@ -18,14 +25,133 @@ if not _logger.hasHandlers():
 
 _logger.setLevel( logging.INFO )
 
-def buildrefs( obj ):
+# Status "filter" for the SN as a whole
+_snfilt = '(all)'
+
+# ======================================================================
+
+class BuildStatus:
+    """Persistent per-(SN, filter) status of reference building.
+
+    Backed by a SQLite file with one table, refs: sn, filt, status
+    (done or failed), attempts, duration (seconds of the last attempt),
+    error, updated.  Only the coordinating process writes to it.  The
+    row with filt '(all)' is for the SN as a whole: it's done once the
+    references for all the SN's filters are, failed once the SN has run
+    out of retries with something still failing, and retrying while a
+    retry is pending.  Its attempts is the number of times the SN was
+    run (in the last run() that ran it).
+
+    """
+
+    def __init__( self, path ):
+        self.path = pathlib.Path( path )
+        self._conn = sqlite3.connect( self.path )
+        self._conn.execute( "PRAGMA journal_mode=WAL" )
+        self._conn.execute( "CREATE TABLE IF NOT EXISTS refs( sn TEXT NOT NULL, filt TEXT NOT NULL, "
+                            "status TEXT NOT NULL, attempts INTEGER NOT NULL, duration REAL, error TEXT, "
+                            "updated REAL, PRIMARY KEY(sn, filt) )" )
+        self._conn.commit()
+
+    def close( self ):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc_val, exc_tb ):
+        self.close()
+
+    def record( self, sn, filt, status, duration=None, error=None, attempts=None ):
+        """Record the status of (sn, filt).
+
+        attempts — if None, this is one more attempt; otherwise, set the
+                   number of attempts to this (used for the '(all)' row,
+                   which is written more than once per attempt)
+
+        """
+        with self._conn:
+            self._conn.execute( "INSERT INTO refs(sn,filt,status,attempts,duration,error,updated) "
+                                "VALUES (?,?,?,COALESCE(?,1),?,?,?) "
+                                "ON CONFLICT(sn,filt) DO UPDATE SET status=excluded.status, "
+                                "  attempts=COALESCE(?,refs.attempts+1), duration=excluded.duration, "
+                                "  error=excluded.error, updated=excluded.updated",
+                                ( sn, filt, status, attempts, duration, error, time.time(), attempts ) )
+
+    def done_sne( self ):
+        """Return the set of SNe whose references are all done."""
+        return set( r[0] for r in self._conn.execute( "SELECT sn FROM refs WHERE filt=? AND status='done'",
+                                                      ( _snfilt, ) ).fetchall() )
+
+    def finished_sne( self ):
+        """Return the set of SNe that are done or that failed for good (per their '(all)' row).
+
+        SNe whose '(all)' row is retrying (the run stopped with a retry
+        pending) aren't finished.
+
+        """
+        return set( r[0] for r in self._conn.execute( "SELECT sn FROM refs WHERE filt=? "
+                                                      "AND status IN ('done','failed')",
+                                                      ( _snfilt, ) ).fetchall() )
+
+    def done_filters( self ):
+        """Return a dict of sn → set of filters whose references are done."""
+        done = collections.defaultdict( set )
+        for sn, filt in self._conn.execute( "SELECT sn, filt FROM refs WHERE status='done'" ).fetchall():
+            done[sn].add( filt )
+        return done
+
+    def failed( self ):
+        """Return a list of (sn, filt, attempts, error) for everything that's failed."""
+        return self._conn.execute( "SELECT sn, filt, attempts, error FROM refs WHERE status='failed' "
+                                   "ORDER BY sn, filt" ).fetchall()
+
+    def forget_failed( self ):
+        with self._conn:
+            self._conn.execute( "DELETE FROM refs WHERE status='failed'" )
+
+    def summary( self ):
+        """Return a string summarizing statuses and per-filter durations of the last attempts."""
+        lines = []
+        for status, n in self._conn.execute( "SELECT status, COUNT(*) FROM refs GROUP BY status" ).fetchall():
+            lines.append( f"{n} {status}" )
+        lines = [ ", ".join( lines ) ]
+        rows = self._conn.execute( "SELECT filt, duration FROM refs WHERE status='done' AND duration IS NOT NULL "
+                                   "  AND filt!=? ORDER BY filt, duration", ( _snfilt, ) ).fetchall()
+        byfilt = collections.defaultdict( list )
+        for filt, duration in rows:
+            byfilt[filt].append( duration )
+        lines.append( f"{'filter':>8s} {'n':>6s} {'total(h)':>9s} {'mean(s)':>8s} {'median(s)':>9s} "
+                      f"{'max(s)':>8s}" )
+        for filt, durs in byfilt.items():
+            lines.append( f"{filt:>8s} {len(durs):6d} {sum(durs)/3600.:9.2f} {sum(durs)/len(durs):8.1f} "
+                          f"{statistics.median(durs):9.1f} {durs[-1]:8.1f}" )
+        return "\n".join( lines )
+
+# ======================================================================
+
+def buildrefs( obj, donefilts=set() ):
+    """Build the ZTF references for obj for every filter that isn't in donefilts.
+
+    Runs in a pool worker; logs to {obj}.log.  Returns a list of
+    (filt, ok, transient, duration, error).  transient is False for
+    failures that won't go away by trying again (the filter doesn't map
+    to exactly one band).  If figuring out the filters fails, the one
+    entry has filt '(all)'.
+
+    """
     logger = logging.getLogger( f'logger {obj}' )
     logger.propagate = False
-    loghandler = logging.FileHandler( f'{obj}.log' )
-    loghandler.setFormatter( logging.Formatter( f'[%(asctime)s - %(levelname)s] - %(message)s' ) )
-    logger.addHandler( loghandler )
+    if not logger.hasHandlers():
+        loghandler = logging.FileHandler( f'{obj}.log' )
+        loghandler.setFormatter( logging.Formatter( f'[%(asctime)s - %(levelname)s] - %(message)s' ) )
+        logger.addHandler( loghandler )
     logger.setLevel( logging.INFO )
 
+    results = []
+    t0 = time.perf_counter()
     try:
         ztf = ExposureSource.get( 'ZTF' )
 
@@ -33,51 +159,209 @@ def buildrefs( obj ):
 
         imgs = get_images_for_sn( ztf, obj=obj, just_list=True, logger=logger )
         filts = set( [ ztf.blob_image_filter( imgs, i ) for i in range(len(imgs)) ] )
+    except Exception as ex:
+        logger.exception( str(ex) )
+        return [ ( _snfilt, False, True, time.perf_counter() - t0, str(ex) ) ]
 
-        # Build the reference
+    # Build the references
 
-        with db.DB.get() as dbo:
-            for filt in filts:
+    for filt in sorted( filts - set( donefilts ) ):
+        t0 = time.perf_counter()
+        try:
+            with db.DB.get() as dbo:
                 bands = dbo.db.query( db.Band ).filter( db.Band.filtercode==filt ).all()
-                if len(bands) > 1:
-                    raise ValueError( f"filtercode {filt} applies to more than one band!" )
-                elif len(bands) == 0:
-                    raise ValueError( f"Can't find band for filtercode {filt}" )
+                if len(bands) != 1:
+                    err = ( f"filtercode {filt} applies to more than one band!" if len(bands) > 1
+                            else f"Can't find band for filtercode {filt}" )
+                    logger.error( err )
+                    results.append( ( filt, False, False, time.perf_counter() - t0, err ) )
+                    continue
                 logger.info( f"Building reference for {filt}" )
                 make_reference( ztf, bands[0], obj=obj, curdb=dbo, logger=logger )
+            results.append( ( filt, True, False, time.perf_counter() - t0, None ) )
+        except Exception as ex:
+            logger.exception( str(ex) )
+            results.append( ( filt, False, True, time.perf_counter() - t0, str(ex) ) )
 
-        return True
-    
-    except Exception as ex:
-        logger.exception( str(ex) )
-        return False
-    
-def main():
-    with open( 'ztf_with_iron_z_justnames.lis' ) as ifp:
-        sne = ifp.readlines()
-    sne = [ i.strip() for i in sne ]
+    return results
+
+# ======================================================================
 
-    pool = multiprocessing.pool.Pool( 12 )
-    poolres = []
-    for sn in sne:
-        poolres.append( pool.apply_async( buildrefs, args=(sn,) ) )
+def pool_size( mempertask, reserve=1 ):
+    """Number of worker processes that fit in this allocation.
 
-    pool.close()
-    pool.join()
+    Uses SLURM_CPUS_PER_TASK and SLURM_MEM_PER_NODE (MB) if set,
+    otherwise the CPUs this process may run on and MemAvailable from
+    /proc/meminfo.  Leaves reserve CPUs for the coordinator.
 
-    fails = []
-    for sn, res in zip( sne, poolres ):
-        if not ( res.successful() and res.get() ):
-            fails.append( sn )
+    mempertask — memory (GB) one buildrefs needs
 
-    if len(fails) == 0:
-        _logger.info( "All sne succeeded" )
+    """
+    if os.getenv( "SLURM_CPUS_PER_TASK" ) is not None:
+        ncpu = int( os.getenv( "SLURM_CPUS_PER_TASK" ) )
     else:
-        nl = '\n'
-        _logger.error( f"The following SNe failed:\n{nl.join(fails)}" )
+        ncpu = len( os.sched_getaffinity( 0 ) )
+    memgb = None
+    if os.getenv( "SLURM_MEM_PER_NODE" ) is not None:
+        memgb = int( os.getenv( "SLURM_MEM_PER_NODE" ) ) / 1024.
+    else:
+        try:
+            with open( "/proc/meminfo" ) as ifp:
+                for line in ifp:
+                    if line.startswith( "MemAvailable:" ):
+                        memgb = int( line.split()[1] ) / 1024. / 1024.
+        except OSError:
+            pass
+    n = max( ncpu - reserve, 1 )
+    if memgb is not None:
+        n = min( n, max( int( memgb / mempertask ), 1 ) )
+    _logger.info( f"{ncpu} CPUs, {'?' if memgb is None else f'{memgb:.1f}'} GB: using {n} processes" )
+    return n
+
+def run( sne, status, nprocs, retries=3, backoff=60. ):
+    """Build references for sne, nprocs at a time, recording everything in status (a BuildStatus).
+
+    SNe and filters already done (per status) are skipped, and so are
+    SNe that failed for good in an earlier run (call
+    status.forget_failed() first to retry those).  An SN with transient
+    failures is tried again (just the failed filters) after
+    backoff·2^(attempt-1) seconds, up to retries times.  If a worker
+    dies (e.g. it was killed for running out of memory), every SN
+    running at the time counts as a transient failure, and the pool is
+    restarted.
+
+    """
+    done = status.done_filters()
+    finished = status.finished_sne()
+    skipped = set( sne ) & finished
+    if len( skipped ) > 0:
+        _logger.info( f"Skipping {len( skipped & status.done_sne() )} SNe that are already done and "
+                      f"{len( skipped - status.done_sne() )} that failed in an earlier run" )
+    sne = [ sn for sn in sne if sn not in finished ]
+    pending = collections.deque( sne )
+    delayed = []
+    attempts = collections.Counter()
+    running = {}
+    t0 = time.perf_counter()
+    ndone = 0
+
+    # A ProcessPoolExecutor (unlike a multiprocessing.pool.Pool) notices
+    # when a worker is killed, and fails its futures with BrokenProcessPool
+    pool = concurrent.futures.ProcessPoolExecutor( nprocs )
+    try:
+        while ( len( pending ) > 0 ) or ( len( delayed ) > 0 ) or ( len( running ) > 0 ):
+            now = time.monotonic()
+            while ( len( delayed ) > 0 ) and ( delayed[0][0] <= now ):
+                pending.append( heapq.heappop( delayed )[1] )
+
+            while ( len( pending ) > 0 ) and ( len( running ) < nprocs ):
+                sn = pending.popleft()
+                attempts[sn] += 1
+                running[sn] = pool.submit( buildrefs, sn, done[sn] )
+
+            if len( running ) > 0:
+                concurrent.futures.wait( running.values(), timeout=1,
+                                         return_when=concurrent.futures.FIRST_COMPLETED )
+            else:
+                time.sleep( 1 )
+
+            broken = False
+            for sn in [ s for s, f in running.items() if f.done() ]:
+                future = running.pop( sn )
+                try:
+                    results = future.result()
+                except concurrent.futures.process.BrokenProcessPool as ex:
+                    broken = True
+                    results = [ ( _snfilt, False, True, None, f"worker died: {ex}" ) ]
+                except Exception as ex:
+                    results = [ ( _snfilt, False, True, None, f"{ex.__class__.__name__}: {ex}" ) ]
+                retry = False
+                allok = True
+                snduration, snerr = None, None
+                for filt, ok, transient, duration, err in results:
+                    allok = allok and ok
+                    if ( not ok ) and transient:
+                        retry = True
+                    if filt == _snfilt:
+                        # Recorded below, once we know whether it'll be retried
+                        snduration, snerr = duration, err
+                        continue
+                    status.record( sn, filt, 'done' if ok else 'failed', duration=duration, error=err )
+                    if ok:
+                        done[sn].add( filt )
+                retry = retry and ( attempts[sn] <= retries )
+                if allok:
+                    snstatus = 'done'
+                elif retry:
+                    snstatus = 'retrying'
+                else:
+                    snstatus = 'failed'
+                status.record( sn, _snfilt, snstatus, duration=snduration, attempts=attempts[sn],
+                               error=( snerr if snerr is not None
+                                       else None if allok else "some filters failed" ) )
+                if retry:
+                    wait = backoff * 2 ** ( attempts[sn] - 1 )
+                    _logger.warning( f"{sn} had failures, retrying in {wait:.0f} s" )
+                    heapq.heappush( delayed, ( time.monotonic() + wait, sn ) )
+                else:
+                    ndone += 1
+                    _logger.info( f"{sn} finished{'' if allok else ' with failures'} ({ndone}/{len(sne)} SNe, "
+                                  f"{(time.perf_counter()-t0)/3600.:.2f} h)" )
+
+            if broken:
+                _logger.error( "A worker died (out of memory?); restarting the pool" )
+                for sn, future in running.items():
+                    # These are broken too, but weren't done yet when we looked; run them again
+                    pending.appendleft( sn )
+                    attempts[sn] -= 1
+                running = {}
+                pool.shutdown( wait=False, cancel_futures=True )
+                pool = concurrent.futures.ProcessPoolExecutor( nprocs )
+    finally:
+        pool.shutdown( wait=False, cancel_futures=True )
+
+# ======================================================================
+
+def main():
+    parser = argparse.ArgumentParser( description="Build ZTF references for a list of SNe",
+                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter )
+    parser.add_argument( "snlist", nargs="?", default="ztf_with_iron_z_justnames.lis",
+                         help="File with one SN per line" )
+    parser.add_argument( "-s", "--status-file", default="buildrefs_status.sqlite",
+                         help="SQLite file with per-(SN, filter) status; done references are skipped on restart" )
+    parser.add_argument( "-n", "--nprocs", type=int, default=None,
+                         help="Number of worker processes (default: as many as the CPUs and memory allow)" )
+    parser.add_argument( "--mem-per-task", type=float, default=0.9,
+                         help="Memory (GB) each worker needs, for sizing the pool" )
+    parser.add_argument( "-r", "--retries", type=int, default=3, help="Times to retry an SN with failures" )
+    parser.add_argument( "-b", "--backoff", type=float, default=60.,
+                         help="Seconds before the first retry (doubles each time)" )
+    parser.add_argument( "--retry-failed", default=False, action="store_true",
+                         help=( "Try again references and SNe that failed in an earlier run (by default "
+                                "they're skipped)" ) )
+    parser.add_argument( "--summary", default=False, action="store_true",
+                         help="Just print the summary from the status file" )
+    args = parser.parse_args()
+
+    with BuildStatus( args.status_file ) as status:
+        if not args.summary:
+            with open( args.snlist ) as ifp:
+                sne = [ i.strip() for i in ifp.readlines() if len( i.strip() ) > 0 ]
+            if args.retry_failed:
+                status.forget_failed()
+            nprocs = args.nprocs if args.nprocs is not None else pool_size( args.mem_per_task )
+            run( sne, status, nprocs, retries=args.retries, backoff=args.backoff )
+
+        _logger.info( f"Summary:\n{status.summary()}" )
+        fails = status.failed()
+        if len(fails) == 0:
+            _logger.info( "All references succeeded" )
+        else:
+            nl = '\n'
+            _logger.error( f"The following failed:\n"
+                           f"{nl.join( f'{sn} {filt} ({n} attempts): {err}' for sn, filt, n, err in fails )}" )
 
 # **********************************************************************
 
 if __name__ == "__main__":
     main()
-
@@ -1,13 +1,9 @@
 #!/bin/bash
 
-for sn in `cat obj_with_ltcv.lis`; do
-    echo "Doing " $sn
-    python /curveball/bin/saltfitltcv.py $sn \
-           --photometry-version default \
-           --versiontag desi_z \
-           --t0-bound \
-           --save \
-           --errorpuff \
-           --force
-done
-
+python batchsaltfit.py obj_with_ltcv.lis \
+       --photometry-version default \
+       --versiontag desi_z \
+       --t0-bound \
+       --save \
+       --errorpuff \
+       --force
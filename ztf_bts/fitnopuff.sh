@@ -1,12 +1,8 @@
 #!/bin/bash
 
-for sn in `cat obj_with_ltcv.lis`; do
-    echo "Doing " $sn
-    python /curveball/bin/saltfitltcv.py $sn \
-           --photometry-version default \
-           --versiontag nopuff \
-           --t0-bound \
-           --save \
-           --force
-done
-
+python batchsaltfit.py obj_with_ltcv.lis \
+       --photometry-version default \
+       --versiontag nopuff \
+       --t0-bound \
+       --save \
+       --force
@@ -0,0 +1,241 @@
+import sys
+import logging
+import argparse
+
+import numpy
+import pandas
+import scipy.optimize
+
+_logger = logging.getLogger( __name__ )
+if not _logger.hasHandlers():
+    _logout = logging.StreamHandler( sys.stderr )
+    _logger.addHandler( _logout )
+    _logout.setFormatter( logging.Formatter( f'[%(asctime)s - %(levelname)s] - %(message)s' ) )
+_logger.setLevel( logging.INFO )
+
+# The columns a data file (e.g. from make_datacsv.py) must have
+datacols = [ 'sn', 'z', 'dz', 'mbstar', 'dmbstar', 'x1', 'dx1', 'c', 'dc', 'chisq', 'dof' ]
+
+# Parameter order, as in hubfit.cc
+paramnames = [ 'alpha', 'beta', 'scriptm' ]
+
+# ======================================================================
+
+def read_data( datafile ):
+    """Read a bts_mosthosts_desiz.csv-style file of SALT2 fits."""
+    df = pandas.read_csv( datafile )
+    missing = [ c for c in datacols if c not in df.columns ]
+    if len( missing ) > 0:
+        raise ValueError( f"{datafile} is missing columns {missing}" )
+    return df
+
+def popovic_cuts( df ):
+    """Return a boolean Series: True for SNe that pass the cuts.
+
+    Cuts from Popovic et al., 2021, ApJ, 913, 49: |c| ≤ 0.3, |x1| ≤ 3,
+    dc ≤ 0.2, dx1 ≤ 1.
+
+    """
+    wbad = ( ( df['c'] > 0.3 ) | ( df['c'] < -0.3 ) |
+             ( df['x1'] > 3 ) | ( df['x1'] < -3 ) |
+             ( df['dc'] > 0.2 ) | ( df['dx1'] > 1 ) )
+    return ~wbad
+
+def _arrays( df ):
+    """Pull the columns the likelihood needs out of df as float arrays (with 5 log10 z precomputed)."""
+    return { 'fivelogz': 5. * numpy.log10( df['z'].values.astype( float ) ),
+             'mbstar': df['mbstar'].values.astype( float ),
+             'dmbstar2': df['dmbstar'].values.astype( float ) ** 2,
+             'x1': df['x1'].values.astype( float ),
+             'dx12': df['dx1'].values.astype( float ) ** 2,
+             'c': df['c'].values.astype( float ),
+             'dc2': df['dc'].values.astype( float ) ** 2 }
+
+def _terms( param, data, dint ):
+    alpha, beta, scriptm = param
+    d = data['mbstar'] - ( scriptm + data['fivelogz'] - alpha * data['x1'] + beta * data['c'] )
+    sigma2 = data['dmbstar2'] + alpha**2 * data['dx12'] + beta**2 * data['dc2'] + dint**2
+    return d, sigma2
+
+def lnL( param, data, dint ):
+    """Log likelihood of param (alpha, beta, scriptm) for data (from _arrays).
+
+    The same likelihood as hubfit.cc: the model is
+    mbstar = scriptm + 5 log10 z - alpha x1 + beta c, with independent
+    Gaussian errors of variance dmbstar² + (alpha dx1)² + (beta dc)² +
+    dint² (errors on z ignored), so
+
+      lnL = -n/2 ln(2π) - ½ Σ ln σ² - ½ Σ d²/σ²
+
+    """
+    d, sigma2 = _terms( param, data, dint )
+    return -0.5 * ( len(d) * numpy.log( 2. * numpy.pi ) + numpy.sum( numpy.log( sigma2 ) + d**2 / sigma2 ) )
+
+def _gradlnL( param, data, dint ):
+    alpha, beta, scriptm = param
+    d, sigma2 = _terms( param, data, dint )
+    dos2 = d / sigma2
+    d2os4 = dos2**2
+    return numpy.array( [ numpy.sum( ( d2os4 - 1. / sigma2 ) * alpha * data['dx12'] - dos2 * data['x1'] ),
+                          numpy.sum( ( d2os4 - 1. / sigma2 ) * beta * data['dc2'] + dos2 * data['c'] ),
+                          numpy.sum( dos2 ) ] )
+
+def chisq( param, data, dint ):
+    d, sigma2 = _terms( param, data, dint )
+    return numpy.sum( d**2 / sigma2 )
+
+def _hessian( param, data, dint, eps=1e-5 ):
+    """Hessian of lnL by central differences of the analytic gradient."""
+    hess = numpy.empty( ( 3, 3 ) )
+    for i in range( 3 ):
+        step = numpy.zeros( 3 )
+        step[i] = eps * max( abs( param[i] ), 1. )
+        hess[i] = ( _gradlnL( param + step, data, dint ) - _gradlnL( param - step, data, dint ) ) / ( 2. * step[i] )
+    return 0.5 * ( hess + hess.T )
+
+# ======================================================================
+
+class HubbleFitResult:
+    """Result of a Hubble fit.
+
+    alpha, beta, scriptm — maximum likelihood parameters
+    dalpha, dbeta, dscriptm — their uncertainties, from the Hessian
+    cov — 3×3 covariance matrix (order alpha, beta, scriptm)
+    dint — intrinsic dispersion used
+    chisq, dof, lnL — at the maximum; dof = n - 3
+    n — number of SNe fit
+    sn — names of the SNe fit
+
+    """
+
+    def __init__( self, param, cov, dint, chisq, lnL, sn ):
+        self.alpha, self.beta, self.scriptm = param
+        self.cov = cov
+        self.dalpha, self.dbeta, self.dscriptm = numpy.sqrt( numpy.diag( cov ) )
+        self.dint = dint
+        self.chisq = chisq
+        self.lnL = lnL
+        self.n = len( sn )
+        self.dof = self.n - 3
+        self.sn = sn
+
+    @property
+    def param( self ):
+        return numpy.array( [ self.alpha, self.beta, self.scriptm ] )
+
+    def asdict( self ):
+        return { 'alpha': self.alpha, 'dalpha': self.dalpha, 'beta': self.beta, 'dbeta': self.dbeta,
+                 'scriptm': self.scriptm, 'dscriptm': self.dscriptm, 'dint': self.dint,
+                 'chisq': self.chisq, 'dof': self.dof, 'n': self.n, 'lnL': self.lnL }
+
+    def __str__( self ):
+        return ( f"α = {self.alpha:.3f} ± {self.dalpha:.3f}, β = {self.beta:.3f} ± {self.dbeta:.3f}, "
+                 f"M = {self.scriptm:.3f} ± {self.dscriptm:.3f}, σ_int = {self.dint:.3f}, "
+                 f"χ²/ν = {self.chisq:.1f}/{self.dof} for {self.n} SNe" )
+
+def fit( df, dint=0.1, p0=( 0.14, 3.2, 24. ), data=None ):
+    """Maximum-likelihood fit of alpha, beta, scriptm to df with a fixed intrinsic dispersion dint.
+
+    df — the SNe to fit (apply popovic_cuts first if you want them)
+    p0 — starting alpha, beta, scriptm
+    data — _arrays( df ), if you already have it
+
+    Returns a HubbleFitResult.
+
+    """
+    data = _arrays( df ) if data is None else data
+    res = scipy.optimize.minimize( lambda p: -lnL( p, data, dint ), numpy.asarray( p0, dtype=float ),
+                                   jac=lambda p: -_gradlnL( p, data, dint ), method='BFGS' )
+    # BFGS often stops with "precision loss" right at the maximum when started near it
+    if ( not res.success ) and ( numpy.max( numpy.abs( res.jac ) ) > 1e-3 ):
+        _logger.warning( f"Hubble fit didn't converge: {res.message}" )
+    param = res.x
+    try:
+        cov = numpy.linalg.inv( -_hessian( param, data, dint ) )
+    except numpy.linalg.LinAlgError:
+        cov = numpy.full( ( 3, 3 ), numpy.nan )
+    return HubbleFitResult( param, cov, dint, chisq( param, data, dint ), -res.fun, df['sn'].values )
+
+def fit_dint( df, p0=( 0.14, 3.2, 24. ), maxdint=2., xtol=1e-4 ):
+    """Fit, solving for the intrinsic dispersion that gives χ²/ν = 1.
+
+    Each trial dint is a full refit (starting from the last one).  If
+    χ²/ν < 1 even with no intrinsic dispersion, dint is 0.
+
+    Returns a HubbleFitResult.
+
+    """
+    data = _arrays( df )
+    dof = len( df ) - 3
+    last = { 'p': numpy.asarray( p0, dtype=float ) }
+
+    def redchi2m1( dint ):
+        res = fit( df, dint=dint, p0=last['p'], data=data )
+        last['p'] = res.param
+        return res.chisq / dof - 1.
+
+    if redchi2m1( 0. ) <= 0.:
+        dint = 0.
+    else:
+        dint = scipy.optimize.brentq( redchi2m1, 0., maxdint, xtol=xtol )
+    return fit( df, dint=dint, p0=last['p'], data=data )
+
+def residuals( df, result, nsigma=3. ):
+    """Hubble residuals of df for a HubbleFitResult.
+
+    Returns a copy of df with added columns:
+      mbcor — mbstar + alpha x1 - beta c
+      dmbcor — its uncertainty, including the errors on alpha and beta
+               and the intrinsic dispersion (as plothub.py did)
+      fitmb — scriptm + 5 log10 z
+      resid — mbcor - fitmb
+      pull — resid / dmbcor
+      outlier — |pull| > nsigma
+      passcut — popovic_cuts
+
+    """
+    r = result
+    df = df.copy()
+    df['mbcor'] = df['mbstar'] + r.alpha * df['x1'] - r.beta * df['c']
+    df['dmbcor'] = numpy.sqrt( df['dmbstar']**2 + ( r.dalpha * df['x1'] )**2 + ( r.alpha * df['dx1'] )**2
+                               + ( r.dbeta * df['c'] )**2 + ( r.beta * df['dc'] )**2 + r.dint**2 )
+    df['fitmb'] = r.scriptm + 5. * numpy.log10( df['z'] )
+    df['resid'] = df['mbcor'] - df['fitmb']
+    df['pull'] = df['resid'] / df['dmbcor']
+    df['outlier'] = df['pull'].abs() > nsigma
+    df['passcut'] = popovic_cuts( df )
+    return df
+
+# ======================================================================
+
+def main():
+    parser = argparse.ArgumentParser( description="Fit alpha, beta, and script-M to SALT2 fits",
+                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter )
+    parser.add_argument( "datafile", nargs="?", default="bts_mosthosts_desiz.csv",
+                         help="CSV with columns sn,z,dz,mbstar,dmbstar,x1,dx1,c,dc,chisq,dof" )
+    parser.add_argument( "--no-reject", default=False, action="store_true",
+                         help="Don't apply the Popovic et al. cuts (|c|>0.3, |x1|>3, dc>0.2, dx1>1)" )
+    parser.add_argument( "-i", "--intrinsic-dm", type=float, default=None,
+                         help="Fixed intrinsic dispersion (default: solve for χ²/ν = 1)" )
+    parser.add_argument( "-n", "--nsigma", type=float, default=3., help="Report residuals bigger than this" )
+    parser.add_argument( "-o", "--outfile", default=None, help="Write residuals of all SNe here" )
+    args = parser.parse_args()
+
+    df = read_data( args.datafile )
+    good = popovic_cuts( df )
+    _logger.info( f"{good.sum()} of {len(df)} SNe pass the cuts" )
+    fitdf = df if args.no_reject else df[ good ]
+    result = fit_dint( fitdf ) if args.intrinsic_dm is None else fit( fitdf, dint=args.intrinsic_dm )
+    print( result )
+
+    resid = residuals( df, result, nsigma=args.nsigma )
+    for row in resid[ resid['outlier'] ].itertuples():
+        print( f"{'(good)' if row.passcut else ' (bad)'}  {row.sn} at z={row.z} has mbcor={row.mbcor:.3f} "
+               f"but fitmbstar={row.fitmb:.3f}" )
+    if args.outfile is not None:
+        resid.to_csv( args.outfile, index=False )
+
+# ======================================================================
+
+if __name__ == "__main__":
+    main()
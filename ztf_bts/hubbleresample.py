@@ -0,0 +1,265 @@
+import sys
+import time
+import pathlib
+import logging
+import argparse
+import multiprocessing
+import multiprocessing.pool
+
+import numpy
+import pandas
+
+from hubblefit import read_data, popovic_cuts, fit, fit_dint
+
+_logger = logging.getLogger( __name__ )
+if not _logger.hasHandlers():
+    _logout = logging.StreamHandler( sys.stderr )
+    _logger.addHandler( _logout )
+    _logout.setFormatter( logging.Formatter( f'[%(asctime)s - %(levelname)s] - %(message)s' ) )
+_logger.setLevel( logging.INFO )
+
+# Columns of each resampled fit
+samplecols = [ 'alpha', 'beta', 'scriptm', 'dint' ]
+
+# Set in each pool worker by _init_worker
+_df = None
+_p0 = None
+_dint = None
+
+# ======================================================================
+
+def _init_worker( df, p0, dint ):
+    """Pool initializer: keep the SNe and the full-sample fit in the worker, so tasks are just seeds or indices."""
+    global _df, _p0, _dint
+    _df = df.reset_index( drop=True )
+    _p0 = tuple( p0 )
+    _dint = dint
+
+def _refit( df ):
+    """Fit df starting from the full-sample fit; solve for dint unless it's fixed."""
+    res = fit_dint( df, p0=_p0 ) if _dint is None else fit( df, dint=_dint, p0=_p0 )
+    return [ res.alpha, res.beta, res.scriptm, res.dint ]
+
+def bootstrap_chunk( task ):
+    """Do nsamples bootstrap refits with a generator seeded from seedseq.
+
+    task — (chunk number, numpy.random.SeedSequence, nsamples)
+
+    Returns (chunk number, array of shape (nsamples, 4) with columns samplecols).
+
+    """
+    chunk, seedseq, nsamples = task
+    rng = numpy.random.default_rng( seedseq )
+    n = len( _df )
+    out = numpy.empty( ( nsamples, len( samplecols ) ) )
+    for i in range( nsamples ):
+        out[i] = _refit( _df.iloc[ rng.integers( 0, n, size=n ) ] )
+    return chunk, out
+
+def jackknife_chunk( task ):
+    """Refit dropping each of the SNe with (positional) indices dropdexes in turn.
+
+    Returns (dropdexes, array of shape (len(dropdexes), 4) with columns samplecols).
+
+    """
+    dropdexes = task
+    keep = numpy.ones( len( _df ), dtype=bool )
+    out = numpy.empty( ( len( dropdexes ), len( samplecols ) ) )
+    for i, dex in enumerate( dropdexes ):
+        keep[dex] = False
+        out[i] = _refit( _df[ keep ] )
+        keep[dex] = True
+    return dropdexes, out
+
+# ======================================================================
+
+def covariance_table( samples, jackknife=False ):
+    """Covariance of the columns of samples as a dataframe indexed and labelled by samplecols.
+
+    For jackknife samples, uses the jackknife normalization (n-1)/n Σ (θ_i - θ̄)(θ_i - θ̄)ᵀ.
+
+    """
+    samples = numpy.asarray( samples )
+    if jackknife:
+        n = len( samples )
+        dev = samples - samples.mean( axis=0 )
+        cov = ( n - 1 ) / n * ( dev.T @ dev )
+    else:
+        cov = numpy.cov( samples, rowvar=False )
+    return pandas.DataFrame( cov, index=samplecols, columns=samplecols )
+
+def bootstrap( df, nprocs=None, seed=42, maxsamples=5000, minsamples=1000, chunksize=25, tol=0.02, window=8,
+               dint=None, full=None, logger=None ):
+    """Bootstrap the Hubble fit.
+
+    df — the SNe to fit (apply popovic_cuts first if you want them)
+    nprocs — worker processes (default: all CPUs)
+    seed — the results depend only on this, not on nprocs: chunk i
+           always gets the i-th child of SeedSequence(seed), and
+           chunks are consumed in order
+    maxsamples — stop after this many refits
+    minsamples, tol, window — stop early once there are at least
+                      minsamples refits, the standard deviation σ of no
+                      parameter has changed by more than a fraction tol
+                      over the last window chunks, and the standard
+                      error of σ itself (σ/√(2(N-1)) for N refits) is
+                      less than a fraction tol of σ.  (Comparing just
+                      consecutive chunks isn't enough: adding one chunk
+                      to a few hundred refits hardly changes σ whether
+                      or not it has converged.)
+    chunksize — refits per task
+    dint — fixed intrinsic dispersion; if None, each refit solves for it
+    full — the HubbleFitResult of the full sample (fit here if None)
+
+    Returns a dataframe with columns samplecols, one row per refit.
+
+    """
+    logger = _logger if logger is None else logger
+    nprocs = multiprocessing.cpu_count() if nprocs is None else nprocs
+    if full is None:
+        full = fit_dint( df ) if dint is None else fit( df, dint=dint )
+    nchunks = -( -maxsamples // chunksize )
+    seeds = numpy.random.SeedSequence( seed ).spawn( nchunks )
+    tasks = ( ( i, seeds[i], min( chunksize, maxsamples - i * chunksize ) ) for i in range( nchunks ) )
+
+    t0 = time.perf_counter()
+    chunks = []
+    stds = []
+    with multiprocessing.pool.Pool( nprocs, initializer=_init_worker, initargs=( df, full.param, dint ) ) as pool:
+        # imap returns chunks in order, so stopping early is deterministic too
+        for chunk, out in pool.imap( bootstrap_chunk, tasks ):
+            chunks.append( out )
+            nsamples = sum( len( c ) for c in chunks )
+            std = numpy.concatenate( chunks ).std( axis=0, ddof=1 )
+            stds.append( std )
+            if ( nsamples >= minsamples ) and ( len( stds ) > window ):
+                then = stds[ -1 - window ]
+                change = numpy.max( numpy.abs( std - then ) / numpy.where( std > 0, std, 1. ) )
+                stderr = 1. / numpy.sqrt( 2. * ( nsamples - 1 ) )
+                if ( change < tol ) and ( stderr < tol ):
+                    logger.info( f"Bootstrap converged after {nsamples} refits (σ changed by at most "
+                                 f"{change:.3f} over the last {window*chunksize}; its standard error is "
+                                 f"{stderr:.3f} σ)" )
+                    break
+        else:
+            logger.info( f"Bootstrap stopped at maxsamples={maxsamples}" )
+    logger.info( f"{nsamples} bootstrap refits of {len(df)} SNe in {time.perf_counter()-t0:.1f} s" )
+    return pandas.DataFrame( numpy.concatenate( chunks ), columns=samplecols )
+
+def jackknife( df, nprocs=None, chunksize=10, dint=None, full=None, logger=None ):
+    """Jackknife the Hubble fit, dropping one SN at a time.
+
+    Arguments are as for bootstrap.
+
+    Returns a dataframe with one row per SN: sn, the parameters
+    (samplecols) of the fit without that SN, and d_{param} = that minus
+    the full-sample fit (the SN's influence on the parameter).
+
+    """
+    logger = _logger if logger is None else logger
+    nprocs = multiprocessing.cpu_count() if nprocs is None else nprocs
+    if full is None:
+        full = fit_dint( df ) if dint is None else fit( df, dint=dint )
+    n = len( df )
+    tasks = [ list( range( i, min( i + chunksize, n ) ) ) for i in range( 0, n, chunksize ) ]
+
+    t0 = time.perf_counter()
+    out = numpy.empty( ( n, len( samplecols ) ) )
+    ndone = 0
+    logevery = max( 1, len( tasks ) // 10 )
+    with multiprocessing.pool.Pool( nprocs, initializer=_init_worker, initargs=( df, full.param, dint ) ) as pool:
+        for i, ( dropdexes, chunk ) in enumerate( pool.imap_unordered( jackknife_chunk, tasks ) ):
+            out[ dropdexes ] = chunk
+            ndone += len( dropdexes )
+            if ( i + 1 ) % logevery == 0:
+                logger.info( f"Jackknife: {ndone}/{n} refits" )
+    logger.info( f"{n} jackknife refits in {time.perf_counter()-t0:.1f} s" )
+
+    result = pandas.DataFrame( out, columns=samplecols )
+    result.insert( 0, 'sn', df['sn'].values )
+    fullparam = dict( zip( samplecols, [ full.alpha, full.beta, full.scriptm, full.dint ] ) )
+    for col in samplecols:
+        result[ f'd_{col}' ] = result[col] - fullparam[col]
+    return result
+
+def summary_row( name, full, bootcov=None, jackcov=None ):
+    """One row of the comparison table: the full fit, and errors from the Hessian and resampling."""
+    row = { 'datafile': name, 'n': full.n, 'alpha': full.alpha, 'beta': full.beta, 'scriptm': full.scriptm,
+            'dint': full.dint, 'dalpha_hess': full.dalpha, 'dbeta_hess': full.dbeta,
+            'dscriptm_hess': full.dscriptm }
+    for which, cov in ( ( 'boot', bootcov ), ( 'jack', jackcov ) ):
+        if cov is not None:
+            for col in samplecols:
+                row[ f'd{col}_{which}' ] = numpy.sqrt( cov.loc[ col, col ] )
+    return row
+
+# ======================================================================
+
+def main():
+    parser = argparse.ArgumentParser( description=( "Bootstrap and/or jackknife the Hubble fit of one or more "
+                                                    "data files, e.g. to compare bts_z and desi_z" ),
+                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter )
+    parser.add_argument( "datafiles", nargs="*", default=[ "bts_mosthosts_desiz.csv" ],
+                         help=( "CSVs with columns sn,z,dz,mbstar,dmbstar,x1,dx1,c,dc,chisq,dof "
+                                "(e.g. bts_mosthosts_btsz.csv bts_mosthosts_desiz.csv)" ) )
+    parser.add_argument( "-m", "--method", default="both", choices=[ "bootstrap", "jackknife", "both" ] )
+    parser.add_argument( "--no-reject", default=False, action="store_true",
+                         help="Don't apply the Popovic et al. cuts (|c|>0.3, |x1|>3, dc>0.2, dx1>1)" )
+    parser.add_argument( "-i", "--intrinsic-dm", type=float, default=None,
+                         help="Fixed intrinsic dispersion (default: solve for χ²/ν = 1 in every refit)" )
+    parser.add_argument( "-n", "--nprocs", type=int, default=multiprocessing.cpu_count(),
+                         help="Number of worker processes" )
+    parser.add_argument( "-s", "--seed", type=int, default=42, help="Bootstrap random seed" )
+    parser.add_argument( "--max-samples", type=int, default=5000, help="Maximum number of bootstrap refits" )
+    parser.add_argument( "--min-samples", type=int, default=1000,
+                         help="Don't stop the bootstrap early before this many refits" )
+    parser.add_argument( "-t", "--tol", type=float, default=0.02,
+                         help=( "Stop the bootstrap when no parameter's σ has changed by more than this "
+                                "fraction over the last --window chunks, and σ's standard error is less than "
+                                "this fraction of σ" ) )
+    parser.add_argument( "-w", "--window", type=int, default=8, help="Chunks to look back for convergence" )
+    parser.add_argument( "-c", "--chunksize", type=int, default=25, help="Bootstrap refits per task" )
+    parser.add_argument( "-o", "--outprefix", default="hubbleresample",
+                         help=( "Write {outprefix}_{datafile}_bootstrap.csv, _bootstrap_cov.csv, "
+                                "_jackknife.csv, _jackknife_cov.csv, and {outprefix}_summary.csv" ) )
+    args = parser.parse_args()
+
+    rows = []
+    for datafile in args.datafiles:
+        stem = pathlib.Path( datafile ).stem
+        df = read_data( datafile )
+        if not args.no_reject:
+            df = df[ popovic_cuts( df ) ]
+        full = fit_dint( df ) if args.intrinsic_dm is None else fit( df, dint=args.intrinsic_dm )
+        _logger.info( f"{datafile}: {full}" )
+
+        bootcov = None
+        jackcov = None
+        if args.method in ( "bootstrap", "both" ):
+            samples = bootstrap( df, nprocs=args.nprocs, seed=args.seed, maxsamples=args.max_samples,
+                                 minsamples=args.min_samples, chunksize=args.chunksize, tol=args.tol,
+                                 window=args.window,
+                                 dint=args.intrinsic_dm, full=full )
+            bootcov = covariance_table( samples )
+            samples.to_csv( f"{args.outprefix}_{stem}_bootstrap.csv", index=False )
+            bootcov.to_csv( f"{args.outprefix}_{stem}_bootstrap_cov.csv" )
+        if args.method in ( "jackknife", "both" ):
+            influence = jackknife( df, nprocs=args.nprocs, dint=args.intrinsic_dm, full=full )
+            jackcov = covariance_table( influence[ samplecols ].values, jackknife=True )
+            influence.to_csv( f"{args.outprefix}_{stem}_jackknife.csv", index=False )
+            jackcov.to_csv( f"{args.outprefix}_{stem}_jackknife_cov.csv" )
+            worst = influence.reindex( influence['d_beta'].abs().sort_values( ascending=False ).index ).head( 5 )
+            for row in worst.itertuples():
+                _logger.info( f"{stem}: dropping {row.sn} changes α by {row.d_alpha:+.4f}, "
+                              f"β by {row.d_beta:+.4f}, M by {row.d_scriptm:+.4f}" )
+        rows.append( summary_row( stem, full, bootcov, jackcov ) )
+
+    summary = pandas.DataFrame( rows ).set_index( 'datafile' )
+    summary.to_csv( f"{args.outprefix}_summary.csv" )
+    with pandas.option_context( 'display.width', 200, 'display.max_columns', None ):
+        print( summary.T.to_string( float_format=lambda x: f"{x:.4f}" ) )
+
+# ======================================================================
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+import io
+import abc
+import sys
+import pathlib
+import logging
+
+import numpy
+import pandas
+
+_libdir = str( pathlib.Path( __file__ ).parent.parent / "lib" )
+if _libdir not in sys.path:
+    sys.path.insert( 0, _libdir )
+
+from host_association import candidate_pairs, separation
+
+_logger = logging.getLogger( __name__ )
+if not _logger.hasHandlers():
+    _logout = logging.StreamHandler( sys.stderr )
+    _logger.addHandler( _logout )
+    _logout.setFormatter( logging.Formatter( f'[%(asctime)s - %(levelname)s] - %(message)s' ) )
+_logger.setLevel( logging.INFO )
+
+# ======================================================================
+
+class ObjectLookup( abc.ABC ):
+    """Batched lookups of SNe in an object table by position.
+
+    Subclasses implement find, define_missing, and update_z for all the
+    SNe at once, instead of one database round trip per SN.
+    CurveballObjectLookup talks to the curveball database;
+    LocalObjectLookup is an in-memory stand-in with the same interface,
+    for benchmarking and for trying things out without a database.
+    find, define_missing, and update_z are abstract, so a subclass
+    missing one fails when it's instantiated, not partway through a
+    transaction.
+
+    """
+
+    _findcols = [ 'name', 'object_id', 'object_name', 'object_z', 'sep' ]
+
+    def __init__( self, radius=1., logger=None ):
+        """radius — match radius in arcsec"""
+        self.radius = radius
+        self.logger = _logger if logger is None else logger
+
+    @abc.abstractmethod
+    def find( self, names, ra, dec ):
+        """Find existing objects near positions.
+
+        names, ra, dec — arrays of SN names and positions (degrees)
+
+        Returns a dataframe with one row for each (SN, object) pair
+        within radius: name (the SN name passed), object_id,
+        object_name, object_z, sep (arcsec); sorted by name and sep.
+        SNe with no object aren't in it.
+
+        """
+
+    @abc.abstractmethod
+    def define_missing( self, sne ):
+        """Define objects for SNe that aren't in the table.
+
+        sne — dataframe with columns ZTFID, RA, Dec, peakt (MJD), redshift
+
+        Returns the number of objects defined.
+
+        """
+
+    @abc.abstractmethod
+    def update_z( self, object_ids, z ):
+        """Set the z of the objects object_ids to z (arrays of the same length)."""
+
+    def commit( self ):
+        pass
+
+    def rollback( self ):
+        pass
+
+# ======================================================================
+
+class CurveballObjectLookup( ObjectLookup ):
+    """ObjectLookup against the object table of the curveball database.
+
+    dbo — a curveball db.DB object (e.g. from db.DB.get()); everything
+          happens in its transaction, so commit or roll back through
+          this object or dbo.
+
+    find uploads all the positions into a temp table with one COPY
+    and does a single q3c_join against object.  update_z is one COPY
+    and one UPDATE.  define_missing still calls curveball's
+    define_object for each SN (it does more than insert a row), but
+    only for the SNe that find didn't find, all in one transaction.
+
+    """
+
+    def __init__( self, dbo, radius=1., logger=None ):
+        super().__init__( radius=radius, logger=logger )
+        self.dbo = dbo
+
+    def _cursor( self ):
+        return self.dbo.db.connection().connection.cursor()
+
+    def find( self, names, ra, dec ):
+        pos = pandas.DataFrame( { 'name': numpy.asarray( names ).astype( str ),
+                                  'ra': numpy.asarray( ra, dtype=float ),
+                                  'dec': numpy.asarray( dec, dtype=float ) } )
+        cursor = self._cursor()
+        cursor.execute( "CREATE TEMP TABLE lookup_positions( name text, ra double precision, dec double precision ) "
+                        "ON COMMIT DROP" )
+        buf = io.StringIO()
+        pos.to_csv( buf, header=False, index=False )
+        buf.seek( 0 )
+        cursor.copy_expert( "COPY lookup_positions(name,ra,dec) FROM STDIN WITH ( FORMAT csv )", buf )
+        cursor.execute( "ANALYZE lookup_positions" )
+        cursor.execute( "SELECT p.name,o.id,o.name,o.z,q3c_dist(p.ra,p.dec,o.ra,o.dec)*3600. "
+                        "FROM lookup_positions p "
+                        "INNER JOIN object o ON q3c_join(p.ra,p.dec,o.ra,o.dec,%(radius)s)",
+                        { 'radius': self.radius / 3600. } )
+        found = pandas.DataFrame( cursor.fetchall(), columns=self._findcols )
+        cursor.execute( "DROP TABLE lookup_positions" )
+        self.logger.info( f"{found['name'].nunique()} of {len(pos)} SNe have an object within {self.radius}\"" )
+        return found.sort_values( [ 'name', 'sep' ] ).reset_index( drop=True )
+
+    def define_missing( self, sne ):
+        from define_object import define_object
+        for row in sne.itertuples():
+            self.logger.info( f'{row.ZTFID} not yet defined in curveball database, defining object' )
+            define_object( row.ZTFID, row.RA, row.Dec, row.peakt, z=row.redshift, curdb=self.dbo )
+        return len( sne )
+
+    def update_z( self, object_ids, z ):
+        upd = pandas.DataFrame( { 'id': numpy.asarray( object_ids ), 'z': numpy.asarray( z, dtype=float ) } )
+        if len( upd ) == 0:
+            return
+        cursor = self._cursor()
+        cursor.execute( "CREATE TEMP TABLE lookup_z( id bigint, z double precision ) ON COMMIT DROP" )
+        buf = io.StringIO()
+        upd.to_csv( buf, header=False, index=False, na_rep='' )
+        buf.seek( 0 )
+        cursor.copy_expert( "COPY lookup_z(id,z) FROM STDIN WITH ( FORMAT csv, NULL '' )", buf )
+        cursor.execute( "UPDATE object o SET z=u.z FROM lookup_z u WHERE o.id=u.id" )
+        self.logger.info( f"Updated z of {cursor.rowcount} objects" )
+        cursor.execute( "DROP TABLE lookup_z" )
+
+    def commit( self ):
+        self.dbo.db.commit()
+
+    def rollback( self ):
+        self.dbo.db.rollback()
+
+# ======================================================================
+
+class LocalObjectLookup( ObjectLookup ):
+    """In-memory ObjectLookup over a dataframe of objects.
+
+    objects — dataframe with columns id, name, ra, dec, z (e.g. a dump
+              of the curveball object table)
+
+    commit and rollback do what they say to the dataframe.
+
+    """
+
+    def __init__( self, objects, radius=1., logger=None ):
+        super().__init__( radius=radius, logger=logger )
+        self.objects = objects[ [ 'id', 'name', 'ra', 'dec', 'z' ] ].reset_index( drop=True )
+        self._committed = self.objects.copy()
+
+    def find( self, names, ra, dec ):
+        names = numpy.asarray( names ).astype( str )
+        ra = numpy.asarray( ra, dtype=float )
+        dec = numpy.asarray( dec, dtype=float )
+        objs = self.objects
+        sndex, objdex = candidate_pairs( ra, dec, objs['ra'].values, objs['dec'].values, self.radius )
+        sep = separation( ra[sndex], dec[sndex], objs['ra'].values[objdex], objs['dec'].values[objdex] )
+        ok = sep <= self.radius
+        found = pandas.DataFrame( { 'name': names[sndex][ok],
+                                    'object_id': objs['id'].values[objdex][ok],
+                                    'object_name': objs['name'].values[objdex][ok],
+                                    'object_z': objs['z'].values[objdex][ok],
+                                    'sep': sep[ok] } )
+        self.logger.info( f"{found['name'].nunique()} of {len(names)} SNe have an object within {self.radius}\"" )
+        return found.sort_values( [ 'name', 'sep' ] ).reset_index( drop=True )
+
+    def define_missing( self, sne ):
+        nextid = ( self.objects['id'].max() + 1 ) if len( self.objects ) > 0 else 1
+        new = pandas.DataFrame( { 'id': numpy.arange( nextid, nextid + len(sne) ),
+                                  'name': sne['ZTFID'].values, 'ra': sne['RA'].values, 'dec': sne['Dec'].values,
+                                  'z': sne['redshift'].values } )
+        self.objects = pandas.concat( [ self.objects, new ], ignore_index=True )
+        return len( sne )
+
+    def update_z( self, object_ids, z ):
+        newz = pandas.Series( numpy.asarray( z, dtype=float ), index=numpy.asarray( object_ids ) )
+        w = self.objects['id'].isin( newz.index )
+        self.objects.loc[ w, 'z' ] = self.objects.loc[ w, 'id' ].map( newz ).values
+
+    def commit( self ):
+        self._committed = self.objects.copy()
+
+    def rollback( self ):
+        self.objects = self._committed.copy()